@@ -0,0 +1,191 @@
+"""
+    Multi-account sync for snsync (--accounts), one process for many Simplenote accounts
+
+    Each account has its own config ([snsync:name] section or config file),
+    notes folder, database, log & metrics; the keep-alive connections
+    (Transport) and the API rate budget (Scheduler) are shared.
+"""
+# pylint: disable=W0718
+# pylint: disable=C0301
+
+import os
+import sys
+import queue
+import logging
+import threading
+
+from .config import Config, accounts
+from .db import Database, DatabaseError
+from .notes import Note, NoteError
+from .simplenote import Simplenote
+from .engine import SyncEngine, SyncError
+from . import metrics
+from .version import __version__
+
+
+LEVELS = {'debug': logging.DEBUG,
+          'info': logging.INFO,
+          'warning': logging.WARNING,
+          'error': logging.ERROR,
+          'critical': logging.CRITICAL}
+
+
+class AccountError(Exception):
+    """
+        The accounts can't be synced together (i.e. two share a notes folder)
+    """
+
+
+def account_configs(config_files):
+    """
+        (name, Config) of every account: the [snsync:name] sections of each file, a file without any is one account
+    """
+    configs = []
+    for config_file in config_files:
+        names = accounts(config_file)
+        if not names:
+            names = [os.path.splitext(os.path.basename(config_file))[0].lstrip('.') or config_file]
+        configs.extend((name, Config(config_file, account=name)) for name in names)
+    return configs
+
+
+def check_accounts(configs):
+    """
+        Raise AccountError unless every account has credentials & its own folder, database, log & metrics files
+    """
+    if not configs:
+        raise AccountError('No accounts found')
+
+    seen = {}
+    for name, config in configs:
+        if config.get_config('sn_username') == '' or config.get_config('sn_password') == '':
+            raise AccountError('Simplenote Username/Password not set for account %s' % name)
+
+        for option in ('account', 'cfg_nt_path', 'cfg_db_path', 'cfg_log_path', 'cfg_metrics_json', 'cfg_metrics_prom'):
+            value = name if option == 'account' else config.get_config(option)
+            if value in ('', 'DISABLED'):
+                continue
+            if option != 'account':
+                value = os.path.abspath(os.path.expanduser(value))
+            if (option, value) in seen:
+                raise AccountError('Accounts %s and %s have the same %s (%s), try %%(account)s in the path' % (seen[(option, value)], name, option, value))
+            seen[(option, value)] = name
+
+
+def account_logger(name, config):
+    """
+        Logger of one account, to its own cfg_log_path (or the console, with the account name)
+    """
+    logger = logging.getLogger('snsync.accounts.' + name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    log_file = config.get_config('cfg_log_path')
+    if log_file == "DISABLED":
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] ' + name + ': %(message)s'))
+    else:
+        handler = logging.FileHandler(log_file, delay=True) # the folder may not exist until Note() makes it
+        handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+    handler.setLevel(LEVELS.get(config.get_config('cfg_log_level'), logging.INFO))
+    logger.addHandler(handler)
+    return logger
+
+
+class Account:
+    """
+        One account of a multi-account sync
+
+        The notes folder & database are set up on the thread that syncs the
+        account (SQLite connections stay on the thread that opened them) and
+        closed when it's done.
+    """
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.log = account_logger(name, config)
+        self.result = None # SyncResult, failed syncs too
+        self.error = None
+
+    def sync(self, transport, scheduler, fast_sync=None, dry_run=False, download_only=False):
+        """
+            Sync the account once, returns True if it worked
+        """
+        self.log.info('--[ START Version %s, account %s ]--', __version__, self.name)
+        try:
+            note = Note(self.config, self.log)
+            db = Database(self.config, self.log)
+        except (NoteError, DatabaseError):
+            self.error = 'Setup failed, see the log'
+            return False
+
+        try:
+            db.load_snapshot()
+            simplenote = Simplenote(self.config.get_config('sn_username'), self.config.get_config('sn_password'),
+                                    transport, scheduler, api_url=self.config.get_config('cfg_api_url'))
+            engine = SyncEngine(self.config, db, note, simplenote, self.log, dry_run=dry_run, download_only=download_only)
+            if fast_sync is None:
+                fast_sync = self.config.get_config_bool('cfg_sync_fast')
+
+            try:
+                self.result = engine.sync(fast_sync)
+            except SyncError as e:
+                self.log.critical("%s", e)
+                self.error = str(e)
+                self.result = e.result
+        except Exception:
+            self.log.critical("Sync failed: %s", sys.exc_info()[1])
+            self.log.debug("Exception:", exc_info=True)
+            self.error = 'Sync failed: %s' % sys.exc_info()[1]
+        finally:
+            db.disconnect()
+
+        if self.result is not None:
+            self.log.info('Changes: %s Requests: %s Time Taken: %.3fs', self.result.changes, self.result.counters['requests'], self.result.timings['total'])
+            metrics.export(self.result, self.config.get_config('cfg_metrics_json'), self.config.get_config('cfg_metrics_prom'),
+                           labels={'account': self.name}, logger=self.log)
+        return self.error is None
+
+
+def sync_accounts(account_list, transport, scheduler, parallel=4, stop=None, **options):
+    """
+        Sync accounts, parallel of them at a time, options are Account.sync()'s
+
+        Once stop (threading.Event) is set no more accounts are started, the
+        ones already syncing finish. Returns the accounts that were synced.
+    """
+    if stop is None:
+        stop = threading.Event()
+
+    todo = queue.Queue()
+    for account in account_list:
+        todo.put(account)
+    done = []
+
+    def runner():
+        """
+            Sync accounts until there are none left (or we're stopped)
+        """
+        while not stop.is_set():
+            try:
+                account = todo.get_nowait()
+            except queue.Empty:
+                return
+            account.sync(transport, scheduler, **options)
+            done.append(account)
+
+    threads = [threading.Thread(target=runner, name='snsync-account-%s' % i) for i in range(max(1, min(int(parallel), len(account_list))))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except BaseException: # Ctrl-C, SIGTERM: let the running syncs finish (non-daemon threads), start no more
+        stop.set()
+        raise
+
+    return done
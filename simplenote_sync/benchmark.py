@@ -0,0 +1,232 @@
+"""
+    Sync benchmarks for snsync - full, incremental & no-op syncs against the mock Simperium server
+
+    python3 -m simplenote_sync.benchmark --json=before.json
+    No network is needed (or used), everything runs in a temporary folder.
+"""
+# pylint: disable=W0718
+# pylint: disable=C0301
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import getopt
+import logging
+import tempfile
+import resource
+
+from .config import Config
+from .db import Database
+from .notes import Note
+from .simplenote import Simplenote, custom_user_agent
+from .transport import Transport
+from .scheduler import Scheduler
+from .engine import SyncEngine
+from .mockserver import MockSimperium, mock_note
+from .version import __version__
+
+
+def usage():
+    """
+        Print Help / Usage
+    """
+    print('''
+Usage: python3 -m simplenote_sync.benchmark [OPTIONS]
+
+OPTIONS:
+ -h, --help             Help!
+ -n, --notes=           Corpus sizes, comma separated (default: 1000,10000,100000)
+ -c, --changes=         Percent of notes changed (each side) for the incremental sync (default: 1)
+ -w, --workers=         Sync workers / HTTP connections (default: 4)
+ -r, --rate=            API requests per second, 0 = no limit (default: 0)
+ -l, --latency=         Mock server seconds per request (default: 0)
+ -t, --throttle=        Fraction of mock requests answered 429 (default: 0)
+ -j, --json=            Also write the results to this file
+ -k, --keep             Keep the temporary folders
+
+Version: %s
+''' % __version__)
+    sys.exit(0)
+
+
+def max_rss():
+    """
+        Peak memory of this process so far, MB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # bytes, not KB
+        rss = rss / 1024
+    return rss / 1024
+
+
+class Benchmark:
+    """
+        One corpus: a mock server, a note folder & DB, and an engine to time syncs with
+    """
+
+    def __init__(self, notes, workers=4, rate=0, latency=0.0, throttle=0.0, keep=False, logger=None):
+        self.notes = notes
+        self.keep = keep
+        self.log = logger if logger is not None else logging.getLogger('snsync.benchmark')
+
+        self.mock = MockSimperium(latency=latency, throttle=throttle, retry_after=0).start()
+        self.mock.populate(notes)
+
+        self.folder = tempfile.mkdtemp(prefix='snsync-bench-')
+        config_file = os.path.join(self.folder, 'snsync.ini')
+        with open(config_file, 'w', encoding='utf-8') as f:
+            f.write('[snsync]\n')
+            f.write('cfg_sn_username = bench@example.com\n')
+            f.write('cfg_sn_password = benchmark\n')
+            f.write('cfg_nt_path = %s\n' % os.path.join(self.folder, 'notes'))
+            f.write('cfg_db_path = %s\n' % os.path.join(self.folder, 'snsync.sqlite'))
+            f.write('cfg_log_path = DISABLED\n')
+            f.write('cfg_sync_workers = %s\n' % workers)
+            f.write('cfg_api_url = %s\n' % self.mock.url)
+
+        self.config = Config(config_file)
+        self.note = Note(self.config, self.log)
+        self.db = Database(self.config, self.log)
+        self.db.load_snapshot()
+        self.transport = Transport(pool_size=workers, user_agent=custom_user_agent)
+        self.scheduler = Scheduler(rate=rate, concurrency=workers, logger=self.log)
+        self.simplenote = Simplenote(self.config.get_config('sn_username'), self.config.get_config('sn_password'),
+                                     self.transport, self.scheduler, api_url=self.mock.url)
+        self.engine = SyncEngine(self.config, self.db, self.note, self.simplenote, self.log)
+
+    def sync(self, name, fast_sync):
+        """
+            Time one sync, returns a results dict
+        """
+        mock_requests = self.mock.counters['requests']
+        cpu_start = time.process_time()
+        result = self.engine.sync(fast_sync)
+        cpu = time.process_time() - cpu_start
+
+        return {'notes': self.notes, 'sync': name, 'seconds': round(result.timings['total'], 3),
+                'cpu_seconds': round(cpu, 3), 'notes_per_second': round(self.notes / max(result.timings['total'], 0.001), 1),
+                'requests': self.mock.counters['requests'] - mock_requests, 'changes': result.changes,
+                'http_errors': result.counters['http_errors'], 'throttled': result.counters['throttled'],
+                'max_rss_mb': round(max_rss(), 1)}
+
+    def change(self, percent, seed=1):
+        """
+            Edit percent of the notes on Simplenote, edit (& add) as many local files
+        """
+        rand = random.Random(seed)
+        count = max(1, int(self.notes * percent / 100))
+        now = time.time()
+
+        keys = sorted(self.mock.notes)
+        for key in rand.sample(keys, count):
+            version, data = self.mock.get(key)
+            data['content'] += 'remote edit %s\n' % version
+            data['modificationDate'] = now
+            self.mock.put(key, data)
+
+        path = self.config.get_config('cfg_nt_path')
+        files = sorted(name for name in os.listdir(path) if name.endswith('.' + self.config.get_config('cfg_nt_ext')))
+        for filename in rand.sample(files, min(count, len(files))):
+            with open(os.path.join(path, filename), 'a', encoding='utf-8') as f:
+                f.write('local edit\n')
+            os.utime(os.path.join(path, filename), (now + 60, now + 60)) # newer than any remote edit
+        for i in range(count):
+            with open(os.path.join(path, 'bench new %06d.txt' % i), 'w', encoding='utf-8') as f:
+                f.write(mock_note('bench new %06d\nadded locally\n' % i)['content'])
+
+    def run(self, changes):
+        """
+            Full sync (empty folder), no-op full & fast syncs, then an incremental (fast) sync
+        """
+        results = [self.sync('full', False),
+                   self.sync('no-op full', False),
+                   self.sync('no-op fast', True)]
+        self.change(changes)
+        results.append(self.sync('incremental', True))
+        return results
+
+    def close(self):
+        """
+            Tear down (the folder too, unless keep)
+        """
+        self.transport.close()
+        self.db.disconnect()
+        self.mock.stop()
+        if self.keep:
+            print('Kept %s' % self.folder)
+        else:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def main(argv=sys.argv[1:]):
+    """
+        Run the benchmarks & print a table
+    """
+    sizes = [1000, 10000, 100000]
+    changes = 1.0
+    workers = 4
+    rate = 0
+    latency = 0.0
+    throttle = 0.0
+    json_file = None
+    keep = False
+
+    try:
+        opts, args = getopt.getopt(argv, 'hn:c:w:r:l:t:j:k',
+                                   ['help', 'notes=', 'changes=', 'workers=', 'rate=', 'latency=', 'throttle=', 'json=', 'keep'])
+        for opt, arg in opts:
+            if opt in ['-h', '--help']:
+                usage()
+            elif opt in ['-n', '--notes']:
+                sizes = [int(size) for size in arg.split(',')]
+            elif opt in ['-c', '--changes']:
+                changes = float(arg)
+            elif opt in ['-w', '--workers']:
+                workers = int(arg)
+            elif opt in ['-r', '--rate']:
+                rate = float(arg)
+            elif opt in ['-l', '--latency']:
+                latency = float(arg)
+            elif opt in ['-t', '--throttle']:
+                throttle = float(arg)
+            elif opt in ['-j', '--json']:
+                json_file = arg
+            elif opt in ['-k', '--keep']:
+                keep = True
+    except (getopt.GetoptError, ValueError):
+        usage()
+
+    # sn_* environment variables override config files, don't let them point the benchmark at real notes
+    for name in list(os.environ):
+        if name.startswith('sn_'):
+            del os.environ[name]
+
+    logger = logging.getLogger('snsync.benchmark')
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.ERROR)
+
+    columns = ('notes', 'sync', 'seconds', 'cpu_seconds', 'notes_per_second', 'requests', 'changes', 'http_errors', 'throttled', 'max_rss_mb')
+    print(' '.join('%14s' % column for column in columns))
+
+    results = []
+    for size in sizes:
+        bench = Benchmark(size, workers, rate, latency, throttle, keep, logger)
+        try:
+            for row in bench.run(changes):
+                print(' '.join('%14s' % row[column] for column in columns))
+                results.append(row)
+        finally:
+            bench.close()
+
+    if json_file is not None:
+        with open(json_file, 'w', encoding='utf-8') as f:
+            json.dump({'version': __version__, 'created': time.time(), 'workers': workers, 'rate': rate,
+                       'latency': latency, 'throttle': throttle, 'changes': changes, 'results': results}, f, indent=1)
+        print('Results saved to %s' % json_file)
+
+
+if __name__ == '__main__':
+    main()
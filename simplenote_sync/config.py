@@ -8,14 +8,31 @@ import os
 import collections
 import configparser
 
+ACCOUNT_SECTION = 'snsync:' # multi-account config files, [snsync:name] for each account
+
+def accounts(custom_file=None):
+    """
+        Account names of a multi-account config file (its [snsync:name] sections)
+    """
+    cp = configparser.ConfigParser()
+    if custom_file is not None:
+        cp.read([custom_file])
+    else:
+        cp.read([os.path.join(os.path.expanduser('~'), '.snsync')])
+    return [section[len(ACCOUNT_SECTION):] for section in cp.sections() if section.startswith(ACCOUNT_SECTION)]
+
 class Config:
     """
         Config Object
     """
 
-    def __init__(self, custom_file=None):
+    def __init__(self, custom_file=None, account=None):
         """
             Defult settings and the like.
+
+            With an account (multi-account mode) its [snsync:account] section
+            is read, [snsync] has the settings shared by all accounts, and
+            environment variables are ignored.
         """
         self.home = os.path.abspath(os.path.expanduser('~'))
         # Static Defaults
@@ -27,20 +44,49 @@ class Config:
             'cfg_nt_path'       : os.path.join(self.home, 'Simplenote'),
             'cfg_nt_trashpath'       : '.trash',
             'cfg_nt_filenamelen'       : '60',
-            'cfg_log_level'       : 'info'
+            'cfg_log_level'       : 'info',
+            'cfg_sync_fast'       : 'no',
+            'cfg_sync_workers'       : '4',
+            'cfg_sync_tags'          : '',
+            'cfg_sync_accounts'      : '4',
+            'cfg_http_pool_size'       : '4',
+            'cfg_http_timeout'       : '60',
+            'cfg_api_rate'           : '10',
+            'cfg_api_retries'        : '5',
+            'cfg_api_url'            : '',
+            'cfg_watch_interval'     : '60',
+            'cfg_token_cache'        : 'yes',
+            'cfg_metrics_json'       : '',
+            'cfg_metrics_prom'       : '',
+            'cfg_db_batch_size'       : '500',
+            'cfg_db_batch_seconds'       : '5',
+            'cfg_db_journal'       : 'delete',
+            'cfg_db_synchronous'       : 'full'
         }
 
+        if custom_file is None:
+            custom_file = os.path.join(self.home, '.snsync')
+
         cp = configparser.ConfigParser(defaults)
-        if custom_file is not None:
-            self.configs_read = cp.read([custom_file])
-        else:
-            self.configs_read = cp.read([os.path.join(self.home, '.snsync')])
+        self.configs_read = cp.read([custom_file])
 
         cfg_sec = 'snsync'
 
         if not cp.has_section(cfg_sec):
             cp.add_section(cfg_sec)
 
+        environ = os.environ
+        self.account = account
+        if account is not None:
+            environ = {} # one environment, many accounts
+            if cp.has_section(ACCOUNT_SECTION + account):
+                cp = configparser.ConfigParser(dict(cp.items(cfg_sec, raw=True))) # [snsync] is the default for each account
+                cp.read([custom_file])
+                cfg_sec = ACCOUNT_SECTION + account
+            cp.set(cfg_sec, 'account', account) # i.e. cfg_nt_path = /srv/notes/%(account)s
+        elif not cp.has_option(cfg_sec, 'account'):
+            cp.set(cfg_sec, 'account', '')
+
         self.configs = collections.OrderedDict()
 
         #
@@ -49,65 +95,167 @@ class Config:
         #    Envs are sn_abc
         #
 
-        if os.environ.get('sn_username') is None:
+        if environ.get('sn_username') is None:
             val_sn_username = cp.get(cfg_sec, 'cfg_sn_username', raw=True)
         else:
-            val_sn_username = os.environ.get('sn_username')
+            val_sn_username = environ.get('sn_username')
         self.configs['sn_username'] = [val_sn_username, 'Simplenote Username']
 
-        if os.environ.get('sn_password') is None:
+        if environ.get('sn_password') is None:
             val_sn_passowrd = cp.get(cfg_sec, 'cfg_sn_password', raw=True)
         else:
-            val_sn_passowrd = os.environ.get('sn_password')
+            val_sn_passowrd = environ.get('sn_password')
         self.configs['sn_password'] = [val_sn_passowrd, 'Simplenote Password']
 
-        if os.environ.get('sn_nt_ext') is None:
+        if environ.get('sn_nt_ext') is None:
             val_sn_nt_ext = cp.get(cfg_sec, 'cfg_nt_ext')
         else:
-            val_sn_nt_ext = os.environ.get('sn_nt_ext')
+            val_sn_nt_ext = environ.get('sn_nt_ext')
         self.configs['cfg_nt_ext'] = [val_sn_nt_ext, 'Note file extension']
 
-        if os.environ.get('sn_nt_path') is None:
+        if environ.get('sn_nt_path') is None:
             val_sn_nt_path = cp.get(cfg_sec, 'cfg_nt_path')
         else:
-            val_sn_nt_path = os.environ.get('sn_nt_path')
+            val_sn_nt_path = environ.get('sn_nt_path')
         self.configs['cfg_nt_path'] = [val_sn_nt_path, 'Note storage path']
 
-        if os.environ.get('sn_nt_trashpath') is None:
+        if environ.get('sn_nt_trashpath') is None:
             val_sn_nt_trashpath = cp.get(cfg_sec, 'cfg_nt_trashpath')
         else:
-            val_sn_nt_trashpath = os.environ.get('sn_nt_trashpath')
+            val_sn_nt_trashpath = environ.get('sn_nt_trashpath')
         self.configs['cfg_nt_trashpath'] = [val_sn_nt_trashpath, 'Note Trash Bin Folder for deleted notes']
 
-        if os.environ.get('sn_nt_filenamelen') is None:
+        if environ.get('sn_nt_filenamelen') is None:
             val_sn_nt_filenamelen = cp.get(cfg_sec, 'cfg_nt_filenamelen')
         else:
-            val_sn_nt_filenamelen = os.environ.get('sn_nt_filenamelen')
+            val_sn_nt_filenamelen = environ.get('sn_nt_filenamelen')
         self.configs['cfg_nt_filenamelen'] = [val_sn_nt_filenamelen, 'Length of Filename']
 
-        if os.environ.get('sn_log_level') is None:
+        if environ.get('sn_log_level') is None:
             val_sn_log_level = cp.get(cfg_sec, 'cfg_log_level')
         else:
-            val_sn_log_level = os.environ.get('sn_log_level')
+            val_sn_log_level = environ.get('sn_log_level')
         self.configs['cfg_log_level'] = [val_sn_log_level, 'snsync log level']
 
+        if environ.get('sn_sync_fast') is None:
+            val_sn_sync_fast = cp.get(cfg_sec, 'cfg_sync_fast')
+        else:
+            val_sn_sync_fast = environ.get('sn_sync_fast')
+        self.configs['cfg_sync_fast'] = [val_sn_sync_fast, 'Fast (delta) sync using the last Simperium cursor']
+
+        if environ.get('sn_sync_workers') is None:
+            val_sn_sync_workers = cp.get(cfg_sec, 'cfg_sync_workers')
+        else:
+            val_sn_sync_workers = environ.get('sn_sync_workers')
+        self.configs['cfg_sync_workers'] = [val_sn_sync_workers, 'Number of concurrent Simplenote API requests']
+
+        if environ.get('sn_sync_tags') is None:
+            val_sn_sync_tags = cp.get(cfg_sec, 'cfg_sync_tags')
+        else:
+            val_sn_sync_tags = environ.get('sn_sync_tags')
+        self.configs['cfg_sync_tags'] = [val_sn_sync_tags, 'Only sync notes with these tags (comma separated), each in its own folder']
+
+        if environ.get('sn_sync_accounts') is None:
+            val_sn_sync_accounts = cp.get(cfg_sec, 'cfg_sync_accounts')
+        else:
+            val_sn_sync_accounts = environ.get('sn_sync_accounts')
+        self.configs['cfg_sync_accounts'] = [val_sn_sync_accounts, 'Number of accounts synced at the same time (multi-account mode)']
+
+        if environ.get('sn_http_pool_size') is None:
+            val_sn_http_pool_size = cp.get(cfg_sec, 'cfg_http_pool_size')
+        else:
+            val_sn_http_pool_size = environ.get('sn_http_pool_size')
+        self.configs['cfg_http_pool_size'] = [val_sn_http_pool_size, 'Number of idle keep-alive connections kept per Simperium host']
+
+        if environ.get('sn_http_timeout') is None:
+            val_sn_http_timeout = cp.get(cfg_sec, 'cfg_http_timeout')
+        else:
+            val_sn_http_timeout = environ.get('sn_http_timeout')
+        self.configs['cfg_http_timeout'] = [val_sn_http_timeout, 'Simplenote API connect/read timeout (seconds)']
+
+        if environ.get('sn_api_rate') is None:
+            val_sn_api_rate = cp.get(cfg_sec, 'cfg_api_rate')
+        else:
+            val_sn_api_rate = environ.get('sn_api_rate')
+        self.configs['cfg_api_rate'] = [val_sn_api_rate, 'Maximum Simplenote API requests per second (0 no limit)']
+
+        if environ.get('sn_api_retries') is None:
+            val_sn_api_retries = cp.get(cfg_sec, 'cfg_api_retries')
+        else:
+            val_sn_api_retries = environ.get('sn_api_retries')
+        self.configs['cfg_api_retries'] = [val_sn_api_retries, 'Number of retries for throttled Simplenote API requests']
+
+        if environ.get('sn_api_url') is None:
+            val_sn_api_url = cp.get(cfg_sec, 'cfg_api_url')
+        else:
+            val_sn_api_url = environ.get('sn_api_url')
+        self.configs['cfg_api_url'] = [val_sn_api_url, 'Simplenote API server (blank for Simperium), i.e. a local mock']
+
+        if environ.get('sn_watch_interval') is None:
+            val_sn_watch_interval = cp.get(cfg_sec, 'cfg_watch_interval')
+        else:
+            val_sn_watch_interval = environ.get('sn_watch_interval')
+        self.configs['cfg_watch_interval'] = [val_sn_watch_interval, 'Watch mode, seconds between checks for Simplenote changes']
+
+        if environ.get('sn_token_cache') is None:
+            val_sn_token_cache = cp.get(cfg_sec, 'cfg_token_cache')
+        else:
+            val_sn_token_cache = environ.get('sn_token_cache')
+        self.configs['cfg_token_cache'] = [val_sn_token_cache, 'Keep the Simplenote API token in the DB between runs']
+
+        if environ.get('sn_metrics_json') is None:
+            val_sn_metrics_json = cp.get(cfg_sec, 'cfg_metrics_json')
+        else:
+            val_sn_metrics_json = environ.get('sn_metrics_json')
+        self.configs['cfg_metrics_json'] = [val_sn_metrics_json, 'Write the metrics of each sync to this JSON file (blank: no)']
+
+        if environ.get('sn_metrics_prom') is None:
+            val_sn_metrics_prom = cp.get(cfg_sec, 'cfg_metrics_prom')
+        else:
+            val_sn_metrics_prom = environ.get('sn_metrics_prom')
+        self.configs['cfg_metrics_prom'] = [val_sn_metrics_prom, 'Write the metrics of each sync to this Prometheus textfile (blank: no)']
+
+        if environ.get('sn_db_batch_size') is None:
+            val_sn_db_batch_size = cp.get(cfg_sec, 'cfg_db_batch_size')
+        else:
+            val_sn_db_batch_size = environ.get('sn_db_batch_size')
+        self.configs['cfg_db_batch_size'] = [val_sn_db_batch_size, 'Database writes per transaction']
+
+        if environ.get('sn_db_batch_seconds') is None:
+            val_sn_db_batch_seconds = cp.get(cfg_sec, 'cfg_db_batch_seconds')
+        else:
+            val_sn_db_batch_seconds = environ.get('sn_db_batch_seconds')
+        self.configs['cfg_db_batch_seconds'] = [val_sn_db_batch_seconds, 'Maximum age (seconds) of uncommitted database writes']
+
+        if environ.get('sn_db_journal') is None:
+            val_sn_db_journal = cp.get(cfg_sec, 'cfg_db_journal')
+        else:
+            val_sn_db_journal = environ.get('sn_db_journal')
+        self.configs['cfg_db_journal'] = [val_sn_db_journal, 'SQLite journal mode (delete, wal, ...)']
+
+        if environ.get('sn_db_synchronous') is None:
+            val_sn_db_synchronous = cp.get(cfg_sec, 'cfg_db_synchronous')
+        else:
+            val_sn_db_synchronous = environ.get('sn_db_synchronous')
+        self.configs['cfg_db_synchronous'] = [val_sn_db_synchronous, 'SQLite synchronous setting (off, normal, full, extra)']
+
         # Dynamic Defaults
-        if os.environ.get('sn_db_path') is None:
+        if environ.get('sn_db_path') is None:
             if cp.has_option(cfg_sec, 'cfg_db_path'):
                 val_sn_db_path = cp.get(cfg_sec, 'cfg_db_path')
             else:
                 val_sn_db_path = os.path.join(cp.get(cfg_sec, 'cfg_nt_path'), '.snsync.sqlite')
         else:
-            val_sn_db_path = os.environ.get('sn_db_path')
+            val_sn_db_path = environ.get('sn_db_path')
         self.configs['cfg_db_path'] = [val_sn_db_path, 'snsync database location']
 
-        if os.environ.get('sn_log_path') is None:
+        if environ.get('sn_log_path') is None:
             if cp.has_option(cfg_sec, 'cfg_log_path'):
                 val_sn_log_path = cp.get(cfg_sec, 'cfg_log_path')
             else:
                 val_sn_log_path = os.path.join(cp.get(cfg_sec, 'cfg_nt_path'), '.snsync.log')
         else:
-            val_sn_log_path = os.environ.get('sn_log_path')
+            val_sn_log_path = environ.get('sn_log_path')
         self.configs['cfg_log_path'] = [val_sn_log_path, 'snsync log location']
 
 
@@ -117,6 +265,12 @@ class Config:
         """
         return self.configs[name][0]
 
+    def get_config_bool(self, name):
+        """
+            Return a config setting as True/False (yes/no, on/off, true/false, 1/0)
+        """
+        return str(self.configs[name][0]).strip().lower() in ('1', 'yes', 'true', 'on')
+
     def get_config_descr(self, name):
         """
             Return a config description (future use in docs)
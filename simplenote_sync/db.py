@@ -3,13 +3,23 @@
 """
 import os
 import sys
+import stat
 import sqlite3
 import json
+import time
+import hashlib
+import itertools
 # pylint: disable=W0718
 # pylint: disable=C0301
 
 
-db_version = int("2") # Increment this with DB/Schema updates.
+db_version = int("7") # Increment this with DB/Schema updates.
+
+class DatabaseError(Exception):
+    """
+        The local database can't be set up/used
+    """
+
 
 class Database:
     """
@@ -22,12 +32,28 @@ class Database:
         """
 
         filename = config.get_config('cfg_db_path')
+        self.filename = filename
         self.log = logger
+        self.snapshot = None # In memory copy of the simplenote & notefile tables, see load_snapshot()
+
+        # Writes are queued and committed in batches, by count or age
+        self.pending = []
+        self.last_commit = time.monotonic()
+        try:
+            self.batch_size = max(1, int(config.get_config('cfg_db_batch_size')))
+            self.batch_seconds = float(config.get_config('cfg_db_batch_seconds'))
+        except ValueError:
+            self.log.warning("Invalid cfg_db_batch_size or cfg_db_batch_seconds, committing every write")
+            self.batch_size = 1
+            self.batch_seconds = 0.0
+        self.journal_mode = config.get_config('cfg_db_journal')
+        self.synchronous = config.get_config('cfg_db_synchronous')
 
         if not self.isSQLite3(filename):
             self.log.warning("404 DB not found: %s", filename)
             self.dbconn, self.db = self.connect(filename)
-            self.createdb_schmea_2()
+            self.createdb_schmea_3()
+            self.upgradedb(3, config)
         else:
             self.dbconn, self.db = self.connect(filename)
 
@@ -35,12 +61,14 @@ class Database:
             version = self.get_schema_version()
             if version == db_version:
                 self.log.debug("File Version: %s  Our Version: %s", version, db_version)
-            elif (version == 1) and (db_version == 2):
+            elif 1 <= version < db_version:
                 self.log.info("File Version: %s  Our Version: %s", version, db_version)
-                self.upgradedb_schmea_1to2()
+                self.upgradedb(version, config)
             else:
                 self.log.critical("Database Version/Schemea Mismatch! - File Version: %s  Our Version: %s", version, db_version)
-                sys.exit(1)
+                raise DatabaseError("Database Version/Schemea Mismatch! - File Version: %s  Our Version: %s" % (version, db_version))
+
+        self.fts = self.create_search() # Full-text search needs SQLite FTS5, not every build has it
 
     def isSQLite3(self, filename):
         """"
@@ -65,20 +93,94 @@ class Database:
         self.log.debug("Connecting DB: %s", filename)
         conn = sqlite3.connect(filename)
         c = conn.cursor()
+
+        # Journal mode & sync level, i.e. durability vs. fsync cost
+        journal_mode = str(self.journal_mode).lower()
+        if journal_mode in ('delete', 'truncate', 'persist', 'memory', 'wal', 'off'):
+            mode = conn.execute('PRAGMA journal_mode=%s' % journal_mode).fetchone()[0]
+            self.log.debug("DB Journal Mode: %s", mode)
+        else:
+            self.log.warning("Unknown DB journal mode: %s", self.journal_mode)
+
+        synchronous = str(self.synchronous).lower()
+        if synchronous in ('off', 'normal', 'full', 'extra'):
+            conn.execute('PRAGMA synchronous=%s' % synchronous)
+            self.log.debug("DB Synchronous: %s", synchronous)
+        else:
+            self.log.warning("Unknown DB synchronous setting: %s", self.synchronous)
+
         return conn, c
 
+    def queue(self, sql, params):
+        """
+            Queue a write, commit the batch if it's big (or old) enough
+        """
+        self.pending.append((sql, params))
+        if len(self.pending) >= self.batch_size or time.monotonic() - self.last_commit >= self.batch_seconds:
+            self.commit()
+
+    def flush(self):
+        """
+            Execute (but don't commit) queued writes, in order.
+            Runs of the same statement go through executemany, all in one
+            savepoint: if any write fails none of them are applied, they stay
+            queued and DatabaseError is raised.
+        """
+        if not self.pending:
+            return True
+
+        pending = self.pending
+        self.pending = []
+        sql = None
+        savepoint = False
+        try:
+            if not self.dbconn.in_transaction:
+                self.db.execute('BEGIN') # the savepoint must not be the outermost transaction (RELEASE would commit it)
+            self.db.execute('SAVEPOINT snsync_flush')
+            savepoint = True
+            for sql, writes in itertools.groupby(pending, key=lambda write: write[0]):
+                self.db.executemany(sql, [params for _, params in writes])
+            self.db.execute('RELEASE snsync_flush')
+            return True
+        except sqlite3.Error as e:
+            if savepoint:
+                self.db.execute('ROLLBACK TO snsync_flush')
+                self.db.execute('RELEASE snsync_flush')
+            self.pending = pending + self.pending
+            self.log.error("Unable to update local database: %s", e)
+            self.log.debug("Failed statement: %s", sql)
+            raise DatabaseError("Unable to update local database: %s" % e) from e
+
     def commit(self):
         """
-            Commit to DB
+            Commit to DB, nothing is committed unless every queued write worked (DatabaseError)
+        """
+        if self.flush():
+            self.dbconn.commit()
+            self.last_commit = time.monotonic()
+
+    def discard(self):
+        """
+            Back to the last commit (i.e. after a DatabaseError), queued & uncommitted writes are dropped
         """
-        self.dbconn.commit()
+        self.log.critical("Local database changes since the last commit were not saved")
+        self.pending = []
+        self.dbconn.rollback()
+        if self.snapshot is not None:
+            self.load_snapshot() # the snapshot had the dropped writes
 
     def disconnect(self):
         """
             Connection teardown
         """
-        self.dbconn.commit()
+        if self.dbconn is None:
+            return # Already disconnected
+        try:
+            self.commit()
+        except DatabaseError:
+            self.discard()
         self.dbconn.close()
+        self.dbconn = None
         self.log.debug("Disconnecting DB")
 
     def get_schema_version(self):
@@ -129,7 +231,7 @@ class Database:
         except sqlite3.OperationalError:
             self.log.error("Unabled to setup local database")
             self.log.debug("Exception: %s", sys.exc_info()[1])
-            sys.exit(1)
+            raise DatabaseError("Unabled to setup local database")
 
     def createdb_schmea_2(self):
         """
@@ -165,7 +267,7 @@ class Database:
         except sqlite3.OperationalError:
             self.log.error("Unabled to setup local database")
             self.log.debug("Exception: %s", sys.exc_info()[1])
-            sys.exit(1)
+            raise DatabaseError("Unabled to setup local database")
 
     def upgradedb_schmea_1to2(self):
         """
@@ -201,14 +303,342 @@ class Database:
         except sqlite3.OperationalError:
             self.log.error("Unabled to setup local database")
             self.log.debug("Exception: %s", sys.exc_info()[1])
-            sys.exit(1)
+            raise DatabaseError("Unabled to setup local database")
+
+    def createdb_schmea_3(self):
+        """
+            Create a DB (Schema Version 3)
+
+            Numeric dates & flags, indexes for filename and modify date look-ups
+        """
+        self.log.info("Creating new version 3 database")
+        version = int("3")
+
+        try:
+            self.dbconn.execute('CREATE TABLE simplenote (\
+                key TEXT PRIMARY KEY,\
+                createdate REAL,\
+                deleted INTEGER,\
+                modifydate REAL,\
+                systemtags TEXT,\
+                tags TEXT,\
+                version INTEGER\
+                )')
+            self.dbconn.execute('CREATE TABLE notefile (\
+                key TEXT PRIMARY KEY,\
+                createdate REAL,\
+                deleted INTEGER,\
+                modifydate REAL,\
+                filename TEXT\
+                )')
+            self.dbconn.execute('CREATE TABLE snsync (\
+                name TEXT PRIMARY KEY,\
+                value BLOB\
+                )')
+            self.dbconn.execute('CREATE INDEX notefile_filename ON notefile (filename)')
+            self.dbconn.execute('CREATE INDEX simplenote_modifydate ON simplenote (modifydate)')
+            self.set_schema_version(version)
+        except sqlite3.OperationalError:
+            self.log.error("Unabled to setup local database")
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            raise DatabaseError("Unabled to setup local database")
+
+    def upgradedb_schmea_2to3(self, nt_path):
+        """
+            Upgrade Version 2 DB to Version 3
+
+            Dates become REAL, deleted/version INTEGER & new indexes.
+            Older versions saved the full path of new notes as the filename,
+            those become relative to the note path (nt_path) again.
+        """
+        self.log.info("Upgrading to Version 3 Database")
+        version = int("3")
+
+        try:
+
+            self.dbconn.execute('ALTER TABLE simplenote RENAME TO simplenote_v2')
+            self.dbconn.execute('ALTER TABLE notefile RENAME TO notefile_v2')
+
+            self.dbconn.execute('CREATE TABLE simplenote (\
+                key TEXT PRIMARY KEY,\
+                createdate REAL,\
+                deleted INTEGER,\
+                modifydate REAL,\
+                systemtags TEXT,\
+                tags TEXT,\
+                version INTEGER\
+                )')
+            self.dbconn.execute('CREATE TABLE notefile (\
+                key TEXT PRIMARY KEY,\
+                createdate REAL,\
+                deleted INTEGER,\
+                modifydate REAL,\
+                filename TEXT\
+                )')
+
+            self.dbconn.execute("INSERT INTO simplenote (\
+                key,createdate,deleted,modifydate,systemtags,tags,version\
+                ) SELECT key,CAST(createdate AS REAL),\
+                CASE WHEN deleted IN ('1', 'True', 'true') THEN 1 ELSE 0 END,\
+                CAST(modifydate AS REAL),systemtags,tags,CAST(version AS INTEGER)\
+                FROM simplenote_v2\
+            ")
+            self.dbconn.execute("INSERT INTO notefile (\
+                key,createdate,deleted,modifydate,filename\
+                ) SELECT key,CAST(createdate AS REAL),\
+                CASE WHEN deleted IN ('1', 'True', 'true') THEN 1 ELSE 0 END,\
+                CAST(modifydate AS REAL),filename\
+                FROM notefile_v2\
+            ")
+
+            nt_prefix = nt_path.rstrip("/") + "/"
+            self.dbconn.execute('UPDATE notefile SET filename = substr(filename, ?)\
+                WHERE substr(filename, 1, ?) = ?', (len(nt_prefix) + 1, len(nt_prefix), nt_prefix,))
+
+            self.dbconn.execute('DROP TABLE simplenote_v2')
+            self.dbconn.execute('DROP TABLE notefile_v2')
+
+            self.dbconn.execute('CREATE INDEX notefile_filename ON notefile (filename)')
+            self.dbconn.execute('CREATE INDEX simplenote_modifydate ON simplenote (modifydate)')
+
+            self.set_schema_version(version)
+            self.dbconn.commit()
+
+        except sqlite3.OperationalError:
+            self.log.error("Unabled to setup local database")
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            raise DatabaseError("Unabled to setup local database")
+
+    def upgradedb(self, version, config):
+        """
+            Upgrade a DB from version to the current db_version, one schema at a time
+        """
+        if version == 1:
+            self.upgradedb_schmea_1to2()
+        if version <= 2:
+            self.upgradedb_schmea_2to3(config.get_config('cfg_nt_path'))
+        if version <= 3:
+            self.upgradedb_schmea_3to4()
+        if version <= 4:
+            self.upgradedb_schmea_4to5()
+        if version <= 5:
+            self.upgradedb_schmea_5to6()
+        if version <= 6:
+            self.upgradedb_schmea_6to7()
+
+    def upgradedb_schmea_3to4(self):
+        """
+            Upgrade Version 3 DB to Version 4
+
+            Adds the filestate table, local file stats as of the last sync.
+        """
+        self.log.info("Upgrading to Version 4 Database")
+        version = int("4")
+
+        try:
+
+            self.dbconn.execute('CREATE TABLE filestate (\
+                filename TEXT PRIMARY KEY,\
+                inode INTEGER,\
+                size INTEGER,\
+                mtime_ns INTEGER\
+                )')
+
+            self.set_schema_version(version)
+            self.dbconn.commit()
+
+        except sqlite3.OperationalError:
+            self.log.error("Unabled to setup local database")
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            raise DatabaseError("Unabled to setup local database")
+
+    def upgradedb_schmea_4to5(self):
+        """
+            Upgrade Version 4 DB to Version 5
+
+            Adds the notefile digest, a hash of the content last synced.
+        """
+        self.log.info("Upgrading to Version 5 Database")
+        version = int("5")
+
+        try:
+
+            self.dbconn.execute('ALTER TABLE notefile ADD COLUMN digest TEXT')
+
+            self.set_schema_version(version)
+            self.dbconn.commit()
+
+        except sqlite3.OperationalError:
+            self.log.error("Unabled to setup local database")
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            raise DatabaseError("Unabled to setup local database")
+
+    def upgradedb_schmea_5to6(self):
+        """
+            Upgrade Version 5 DB to Version 6
+
+            Adds the outbox table, local changes queued for Simplenote. Journalled
+            uploads (snsync sn_journal_*) move into it.
+        """
+        self.log.info("Upgrading to Version 6 Database")
+        version = int("6")
+
+        try:
+
+            self.dbconn.execute('CREATE TABLE outbox (\
+                key TEXT PRIMARY KEY,\
+                op TEXT,\
+                filename TEXT,\
+                queued REAL,\
+                attempts INTEGER DEFAULT 0\
+                )')
+            self.dbconn.execute("INSERT INTO outbox (key, op, filename, queued) \
+                SELECT substr(name, 12), 'add', value, 0 FROM snsync WHERE substr(name, 1, 11)='sn_journal_'")
+            self.dbconn.execute("DELETE FROM snsync WHERE substr(name, 1, 11)='sn_journal_'")
+
+            self.set_schema_version(version)
+            self.dbconn.commit()
+
+        except sqlite3.OperationalError:
+            self.log.error("Unabled to setup local database")
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            raise DatabaseError("Unabled to setup local database")
+
+    def upgradedb_schmea_6to7(self):
+        """
+            Upgrade Version 6 DB to Version 7
+
+            Adds the notesearch (FTS5) table, a full-text index of the synced
+            notes. If this SQLite can't do FTS5 the upgrade goes ahead without
+            it, the table is created if a later run can.
+        """
+        self.log.info("Upgrading to Version 7 Database")
+        version = int("7")
+
+        try:
+
+            self.create_search()
+
+            self.set_schema_version(version)
+            self.dbconn.commit()
+
+        except sqlite3.OperationalError:
+            self.log.error("Unabled to setup local database")
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            raise DatabaseError("Unabled to setup local database")
+
+    def create_search(self):
+        """
+            Create the notesearch table if it's missing, returns False if SQLite has no FTS5
+        """
+        try:
+            self.dbconn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS notesearch USING fts5(\
+                key UNINDEXED,\
+                filename,\
+                tags,\
+                content,\
+                tokenize='unicode61 remove_diacritics 2'\
+                )")
+        except sqlite3.OperationalError:
+            self.log.warning("SQLite FTS5 not available, note search disabled")
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            return False
+        return True
+
+    def sn_row(self, key_row):
+        """
+            simplenote table row -> dict
+        """
+        note = {}
+        note['key'] = key_row[0]
+        note['createdate'] = key_row[1]
+        note['deleted'] = key_row[2]
+        note['modifydate'] = key_row[3]
+        note['systemtags'] = key_row[4]
+        note['tags'] = key_row[5]
+        note['version'] = key_row[6]
+        return note
+
+    def nf_row(self, key_row):
+        """
+            notefile table row -> dict
+        """
+        note = {}
+        note['key'] = key_row[0]
+        note['createdate'] = key_row[1]
+        note['deleted'] = key_row[2]
+        note['modifydate'] = key_row[3]
+        note['filename'] = key_row[4]
+        note['digest'] = key_row[5]
+        return note
+
+    def as_real(self, value):
+        """
+            Value for a REAL column, i.e. a date
+        """
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return value
+
+    def as_int(self, value):
+        """
+            Value for an INTEGER column, i.e. a flag or version
+        """
+        if isinstance(value, str) and value in ('True', 'true', 'False', 'false'):
+            return 1 if value in ('True', 'true') else 0
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+
+    def load_snapshot(self):
+        """
+            Load the simplenote & notefile tables into memory (one query each)
+
+            Once loaded the find_* lookups are dictionary look-ups and the
+            snapshot is kept up to date by sn(), nf() & del_nf().
+        """
+        snapshot = {'sn': {}, 'nf': {}, 'nf_name': {}}
+        self.flush()
+
+        try:
+            self.db.execute('SELECT * FROM simplenote')
+            for key_row in self.db.fetchall():
+                snapshot['sn'][key_row[0]] = self.sn_row(key_row)
+
+            self.db.execute('SELECT * FROM notefile')
+            for key_row in self.db.fetchall():
+                note = self.nf_row(key_row)
+                snapshot['nf'][note['key']] = note
+                snapshot['nf_name'][note['filename']] = note
+        except sqlite3.OperationalError:
+            self.log.error("Unable to load local database")
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            return False
+
+        self.snapshot = snapshot
+        self.log.debug("Snapshot loaded: %s SN, %s NF", len(snapshot['sn']), len(snapshot['nf']))
+        return True
+
+    def snapshot_del_nf(self, key):
+        """
+            Forget a notefile in the snapshot
+        """
+        note = self.snapshot['nf'].pop(key, None)
+        if note is not None and self.snapshot['nf_name'].get(note['filename']) is note:
+            del self.snapshot['nf_name'][note['filename']]
 
     def find_sn_by_key(self, key):
         """
             Find a simple note by key
         """
 
+        if self.snapshot is not None:
+            return self.snapshot['sn'].get(key, False)
+
         self.log.debug("Looking for SN: %s", key)
+        self.flush()
 
         try:
             self.db.execute('SELECT * FROM simplenote WHERE key=?', (key,))
@@ -224,49 +654,93 @@ class Database:
             self.log.debug("404 Not Found: %s", key)
             return False
         else:
-            note = {}
-            note['key'] = key_row[0]
-            note['createdate'] = key_row[1]
-            note['deleted'] = key_row[2]
-            note['modifydate'] = key_row[3]
-            note['systemtags'] = key_row[4]
-            note['tags'] = key_row[5]
-            note['version'] = key_row[6]
+            note = self.sn_row(key_row)
             self.log.debug("SIMPLENOTE: %s", note)
             return note
 
+    def count_sn(self):
+        """
+            Number of cached simplenotes
+        """
+        if self.snapshot is not None:
+            return len(self.snapshot['sn'])
+
+        self.flush()
+        try:
+            self.db.execute('SELECT COUNT(*) FROM simplenote')
+            return self.db.fetchone()[0]
+        except sqlite3.OperationalError:
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            return 0
+
+    def sn_entry(self, cached_note):
+        """
+            Cached simple note (find_sn_by_key) -> dict shaped like a Simplenote index entry
+        """
+        note = dict(cached_note)
+        note['deleted'] = 1 if str(cached_note['deleted']) in ('1', 'True', 'true') else 0
+        try:
+            note['systemtags'] = json.loads(cached_note['systemtags'])
+            note['tags'] = json.loads(cached_note['tags'])
+        except (TypeError, ValueError):
+            note['systemtags'] = []
+            note['tags'] = []
+        note['systemTags'] = note['systemtags']
+        return note
+
+    def find_sn_all(self):
+        """
+            Return every cached simple note, shaped like a Simplenote index entry
+            (used by fast sync for notes that have not changed on the server)
+        """
+
+        self.log.debug("Loading SN cache")
+        notes = []
+
+        if self.snapshot is not None:
+            cached = self.snapshot['sn'].values()
+        else:
+            self.flush()
+            try:
+                self.db.execute('SELECT * FROM simplenote')
+                cached = [self.sn_row(key_row) for key_row in self.db.fetchall()]
+            except sqlite3.OperationalError:
+                self.log.debug("Exception: %s", sys.exc_info()[1])
+                return notes
+
+        for cached_note in cached:
+            notes.append(self.sn_entry(cached_note))
+
+        self.log.debug("SN cache: %s notes", len(notes))
+        return notes
+
     def sn(self, note):
         """
             Insert a note to the DB from an existing Simplenote
             - or replace (for updates)
         """
-        try:
-            self.log.debug("Updating SN Database: %s", note)
+        self.log.debug("Updating SN Database: %s", note)
 
-            self.db.execute('INSERT OR REPLACE INTO Simplenote \
-                (key, createdate, deleted, modifydate, systemtags, tags, version) \
-                VALUES (?, ?, ?, ?, ?, ?, ?)', (\
-                note['key'],note['createdate'],note['deleted'],\
-                note['modifydate'],\
-                json.dumps(note['systemtags']),json.dumps(note['tags']),note['version'],)\
-                )
-            return True
-        except sqlite3.OperationalError:
-            self.log.debug("Exception: %s", sys.exc_info()[1])
-            return False
+        key_row = (\
+            note['key'],self.as_real(note['createdate']),self.as_int(note['deleted']),\
+            self.as_real(note['modifydate']),\
+            json.dumps(note['systemtags']),json.dumps(note['tags']),self.as_int(note['version']),)
+
+        self.queue('INSERT OR REPLACE INTO Simplenote \
+            (key, createdate, deleted, modifydate, systemtags, tags, version) \
+            VALUES (?, ?, ?, ?, ?, ?, ?)', key_row)
+        if self.snapshot is not None:
+            self.snapshot['sn'][note['key']] = self.sn_row(key_row)
+        return True
 
     def update_snsync(self, name, value):
         """
             Add or updated meta data in snsync table
         """
-        try:
-            self.log.debug("Updating %s -> %s", name, value)
-            self.db.execute('INSERT OR REPLACE INTO snsync (name, value) VALUES (?,?)', \
-                (name, value,))
-            return True
-        except sqlite3.OperationalError:
-            self.log.debug("Exception: %s", sys.exc_info()[1])
-            return False
+        self.log.debug("Updating %s -> %s", name, value)
+        self.queue('INSERT OR REPLACE INTO snsync (name, value) VALUES (?,?)', \
+            (name, value,))
+        return True
 
     def get_snsync_meta(self, name):
         """
@@ -274,6 +748,7 @@ class Database:
         """
 
         self.log.debug("Looking for Meta %s", name)
+        self.flush()
 
         try:
             self.db.execute('SELECT * FROM snsync WHERE name=?', (name,))
@@ -297,38 +772,58 @@ class Database:
         """
             Insert a note file meta to the local DB
         """
-        try:
-            self.log.debug("Updating Note File DB: %s", nf_meta)
+        self.log.debug("Updating Note File DB: %s", nf_meta)
 
-            self.db.execute('INSERT OR REPLACE INTO notefile \
-                (key, createdate, deleted, modifydate, filename) \
-                VALUES (?, ?, ?, ?, ?)', (\
-                nf_meta['key'],nf_meta['createdate'],nf_meta['deleted'],\
-                nf_meta['modifydate'],nf_meta['filename'],)\
-                )
-            return True
-        except sqlite3.OperationalError:
-            self.log.debug("Exception: %s", sys.exc_info()[1])
-            return False
+        key_row = (\
+            nf_meta['key'],self.as_real(nf_meta['createdate']),self.as_int(nf_meta['deleted']),\
+            self.as_real(nf_meta['modifydate']),nf_meta['filename'],nf_meta.get('digest'),)
+
+        self.queue('INSERT OR REPLACE INTO notefile \
+            (key, createdate, deleted, modifydate, filename, digest) \
+            VALUES (?, ?, ?, ?, ?, ?)', key_row)
+        if self.snapshot is not None:
+            self.snapshot_del_nf(nf_meta['key'])
+            note = self.nf_row(key_row)
+            self.snapshot['nf'][note['key']] = note
+            self.snapshot['nf_name'][note['filename']] = note
+        return True
 
     def del_nf(self, key):
         """
             Delete Notefile Meta - to "forget a file"
         """
+        self.log.debug("Deleting NF Meta for : %s", key)
+        self.queue("DELETE FROM notefile WHERE key=?", (key,))
+        if self.snapshot is not None:
+            self.snapshot_del_nf(key)
+        self.search_del(key) # forgotten files aren't found either
+        return True
+
+    def find_nf_all(self):
+        """
+            Return every note file meta
+        """
+        if self.snapshot is not None:
+            return list(self.snapshot['nf'].values())
+
+        self.flush()
         try:
-            self.log.debug("Deleting NF Meta for : %s", key)
-            self.db.execute("DELETE FROM notefile WHERE key=?", (key,))
-            return True
+            self.db.execute('SELECT * FROM notefile')
+            return [self.nf_row(key_row) for key_row in self.db.fetchall()]
         except sqlite3.OperationalError:
             self.log.debug("Exception: %s", sys.exc_info()[1])
-            return False
+            return []
 
     def find_nf_by_key(self, key):
         """
             Find a note file by key
         """
 
+        if self.snapshot is not None:
+            return self.snapshot['nf'].get(key, False)
+
         self.log.debug("Looking for NF: %s", key)
+        self.flush()
 
         try:
             self.db.execute('SELECT * FROM notefile WHERE key=?', (key,))
@@ -344,12 +839,7 @@ class Database:
             self.log.debug("404 NF Not Found: %s", key)
             return False
         else:
-            note = {}
-            note['key'] = key_row[0]
-            note['createdate'] = key_row[1]
-            note['deleted'] = key_row[2]
-            note['modifydate'] = key_row[3]
-            note['filename'] = key_row[4]
+            note = self.nf_row(key_row)
             self.log.debug("NOTEFILE: %s", note)
             return note
 
@@ -358,7 +848,11 @@ class Database:
             Find a note file by name (filename)
         """
 
+        if self.snapshot is not None:
+            return self.snapshot['nf_name'].get(filename, False)
+
         self.log.debug("Looking for NF META: %s", filename)
+        self.flush()
 
         try:
             self.db.execute('SELECT * FROM notefile WHERE filename=?', (filename,))
@@ -374,11 +868,279 @@ class Database:
             self.log.debug("404 NF Meta Not Found: %s", filename)
             return False
         else:
-            note = {}
-            note['key'] = key_row[0]
-            note['createdate'] = key_row[1]
-            note['deleted'] = key_row[2]
-            note['modifydate'] = key_row[3]
-            note['filename'] = key_row[4]
+            note = self.nf_row(key_row)
             self.log.debug("NOTEFILE: %s", note)
             return note
+
+    def get_filestate(self):
+        """
+            Local file stats as of the last sync, returns dict: filename -> (inode, size, mtime_ns)
+        """
+        file_state = {}
+        self.flush()
+
+        try:
+            self.db.execute('SELECT filename, inode, size, mtime_ns FROM filestate')
+            for row in self.db.fetchall():
+                file_state[row[0]] = (row[1], row[2], row[3])
+        except sqlite3.OperationalError:
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+
+        self.log.debug("File state: %s files", len(file_state))
+        return file_state
+
+    def save_filestate(self, old_state, new_state):
+        """
+            Save local file stats, only rows that changed are written
+        """
+        for filename, state in new_state.items():
+            if old_state.get(filename) != state:
+                self.queue('INSERT OR REPLACE INTO filestate (filename, inode, size, mtime_ns) \
+                    VALUES (?, ?, ?, ?)', (filename, state[0], state[1], state[2],))
+
+        for filename in old_state:
+            if filename not in new_state:
+                self.queue('DELETE FROM filestate WHERE filename=?', (filename,))
+
+    def get_snsync_prefix(self, prefix):
+        """
+            Get all snsync meta data with names starting prefix, returns dict: name -> value
+        """
+        meta = {}
+        self.flush()
+
+        try:
+            self.db.execute('SELECT name, value FROM snsync WHERE substr(name, 1, ?)=?', (len(prefix), prefix,))
+            for row in self.db.fetchall():
+                meta[row[0]] = row[1]
+        except sqlite3.OperationalError:
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+
+        return meta
+
+    def del_snsync_prefix(self, prefix):
+        """
+            Delete snsync meta data with names starting prefix
+        """
+        self.log.debug("Deleting Meta %s*", prefix)
+        self.queue('DELETE FROM snsync WHERE substr(name, 1, ?)=?', (len(prefix), prefix,))
+        return True
+
+    def get_resume(self):
+        """
+            Checkpoint of an interrupted note list/sync, returns dict (False if there's none)
+
+            since, started, pages, mark (None once the list is complete) &
+            current, the cursor as of the last page.
+        """
+        resume = self.get_snsync_meta('sn_resume')
+        if not resume:
+            return False
+
+        try:
+            resume = json.loads(resume)
+            resume['pages'] = int(resume['pages'])
+        except (ValueError, KeyError, TypeError):
+            self.log.warning("Sync checkpoint is invalid, ignoring it")
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            return False
+
+        return resume
+
+    def iter_resume_pages(self, resume):
+        """
+            Checkpointed pages of the note list, one at a time, each a list of (key, version)
+        """
+        self.flush()
+        for page in range(resume['pages']):
+            try:
+                self.db.execute('SELECT value FROM snsync WHERE name=?', ('sn_resume_page_%s' % page,))
+                row = self.db.fetchone()
+            except sqlite3.OperationalError:
+                self.log.debug("Exception: %s", sys.exc_info()[1])
+                row = None
+            self.log.debug("Checkpoint: page %s", page)
+            if row is not None:
+                # Older checkpoints kept whole notes
+                yield [(n['key'], n['version']) if isinstance(n, dict) else tuple(n) for n in json.loads(row[0])]
+
+    def save_resume_page(self, resume, notes):
+        """
+            Checkpoint a page of the note list (committed straight away)
+
+            Only the key & version of each note are kept, not the notes
+            themselves, a resumed sync takes them from the cache (or fetches
+            them again if they weren't synced).
+        """
+        self.log.debug("Checkpoint: page %s, %s notes, next mark %s", resume['pages'], len(notes), resume['mark'])
+        self.queue('INSERT OR REPLACE INTO snsync (name, value) VALUES (?,?)', \
+            ('sn_resume_page_%s' % resume['pages'], json.dumps([[n['key'], n['version']] for n in notes]),))
+        resume['pages'] += 1
+        self.update_snsync('sn_resume', json.dumps(resume))
+        self.commit()
+
+    def clear_resume(self):
+        """
+            Forget the note list checkpoint, the sync finished
+        """
+        self.del_snsync_prefix('sn_resume')
+
+    def get_outbox(self):
+        """
+            Queued local changes (outbound operations), oldest first
+            returns list of dicts: key, op (add, update or trash), filename, queued & attempts
+        """
+        outbox = []
+        self.flush()
+
+        try:
+            self.db.execute('SELECT key, op, filename, queued, attempts FROM outbox ORDER BY queued, rowid')
+            for row in self.db.fetchall():
+                outbox.append({'key': row[0], 'op': row[1], 'filename': row[2], 'queued': row[3], 'attempts': row[4] or 0})
+        except sqlite3.OperationalError:
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+
+        self.log.debug("Outbox: %s queued", len(outbox))
+        return outbox
+
+    def outbox_add(self, key, op, filename):
+        """
+            Queue a local change before it's sent, one per note key: the latest
+            op wins, except a note that's still to be added stays an add.
+            Adds are committed straight away (an interrupted upload is matched up next time)
+        """
+        self.log.debug("Outbox: %s %s [%s]", op, filename, key)
+        self.queue("INSERT INTO outbox (key, op, filename, queued, attempts) VALUES (?, ?, ?, ?, 0) \
+            ON CONFLICT(key) DO UPDATE SET filename=excluded.filename, \
+            op=CASE WHEN outbox.op='add' AND excluded.op='update' THEN 'add' ELSE excluded.op END", \
+            (key, op, filename, time.time(),))
+        if op == 'add':
+            self.commit()
+
+    def outbox_done(self, key):
+        """
+            Local change sent (or no longer needed), remove it from the queue
+        """
+        self.queue('DELETE FROM outbox WHERE key=?', (key,))
+
+    def outbox_failed(self, key):
+        """
+            Local change didn't make it, it stays queued for the next sync
+        """
+        self.queue('UPDATE outbox SET attempts=attempts+1 WHERE key=?', (key,))
+
+    def get_token(self, username):
+        """
+            Cached Simplenote API token for username, None if there isn't one
+        """
+        value = self.get_snsync_meta('sn_token')
+        if not value:
+            return None
+
+        try:
+            cached = json.loads(value)
+        except ValueError:
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            return None
+
+        if cached.get('username') != username: # someone else's
+            return None
+        return cached.get('token')
+
+    def save_token(self, username, token):
+        """
+            Cache the Simplenote API token, the DB is made private (0600) as it's a password
+
+            SQLite's -journal/-wal/-shm files hold DB pages (the token too) and
+            are created with the DB file's permissions, ones that already exist
+            are made private as well.
+        """
+        self.log.debug("Caching API token for %s", username)
+        for filename in (self.filename, self.filename + '-journal', self.filename + '-wal', self.filename + '-shm'):
+            if filename != self.filename and not os.path.exists(filename):
+                continue
+            try:
+                os.chmod(filename, stat.S_IRUSR | stat.S_IWUSR)
+            except OSError:
+                self.log.warning("Unable to make the DB private: %s", filename)
+                self.log.debug("Exception: %s", sys.exc_info()[1])
+        self.update_snsync('sn_token', json.dumps({'username': username, 'token': token}))
+
+    def del_token(self):
+        """
+            Forget the cached Simplenote API token
+        """
+        self.queue('DELETE FROM snsync WHERE name=?', ('sn_token',))
+
+    def search_rowid(self, key):
+        """
+            notesearch rowid of a note, from its key (so a note is updated in place, no key look-up)
+        """
+        return int(hashlib.md5(str(key).encode('utf-8')).hexdigest()[:15], 16)
+
+    def search_add(self, key, filename, content, tags):
+        """
+            Add (or replace) a note in the full-text index
+        """
+        if not self.fts:
+            return False
+        if isinstance(tags, str): # as cached
+            try:
+                tags = json.loads(tags)
+            except ValueError:
+                tags = []
+        self.queue('INSERT OR REPLACE INTO notesearch (rowid, key, filename, tags, content) VALUES (?, ?, ?, ?, ?)', \
+            (self.search_rowid(key), key, filename, ' '.join(tags or []), content,))
+        return True
+
+    def search_rename(self, key, filename):
+        """
+            New filename of an indexed note
+        """
+        if not self.fts:
+            return False
+        self.queue('UPDATE notesearch SET filename=? WHERE rowid=?', (filename, self.search_rowid(key),))
+        return True
+
+    def search_del(self, key):
+        """
+            Remove a note from the full-text index
+        """
+        if not self.fts:
+            return False
+        self.queue('DELETE FROM notesearch WHERE rowid=?', (self.search_rowid(key),))
+        return True
+
+    def search_keys(self):
+        """
+            Keys of the indexed notes
+        """
+        if not self.fts:
+            return set()
+        self.flush()
+        self.db.execute('SELECT key FROM notesearch')
+        return set(row[0] for row in self.db.fetchall())
+
+    def search(self, query, limit=20):
+        """
+            Full-text search, returns list of dicts: key, filename, snippet & rank (best first)
+
+            query is FTS5 syntax (i.e. hello AND world, "hello world", hell*,
+            tags:work), if it isn't valid each word is searched for as is.
+        """
+        if not self.fts:
+            return []
+        self.flush()
+
+        sql = "SELECT key, filename, snippet(notesearch, 3, '[', ']', '...', 12), bm25(notesearch, 0.0, 10.0, 5.0, 1.0) AS rank \
+            FROM notesearch WHERE notesearch MATCH ? ORDER BY rank LIMIT ?"
+        try:
+            self.db.execute(sql, (query, int(limit),))
+        except sqlite3.OperationalError: # FTS5 syntax error, i.e. a hyphen or colon
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            words = ' '.join('"%s"' % word.replace('"', '""') for word in query.split())
+            if not words:
+                return []
+            self.db.execute(sql, (words, int(limit),))
+
+        return [{'key': row[0], 'filename': row[1], 'snippet': row[2], 'rank': row[3]} for row in self.db.fetchall()]
@@ -0,0 +1,451 @@
+"""
+    Sync engine for snsync - one Simplenote <-> note folder sync, for the CLI or embedding
+"""
+# pylint: disable=W0718
+# pylint: disable=C0301
+
+import sys
+import time
+import datetime
+import logging
+import itertools
+import contextlib
+
+from .notes import file_state
+from .plan import Planner, KINDS
+from .executor import Executor
+from .workers import WorkerPool
+from .progress import Progress
+from .simplenote import SimplenoteLoginFailed
+
+
+RESUME_MAX_AGE = 86400 # seconds, older checkpoints are too stale to carry on from
+OUTBOX_MAX_ATTEMPTS = 10 # syncs a queued local change is tried in
+
+
+def counted(items, progress):
+    """
+        items, counting each one on the progress bar
+    """
+    for item in items:
+        progress.update()
+        yield item
+
+
+class SyncError(Exception):
+    """
+        A sync could not be completed, result is the SyncResult of the work done so far
+    """
+
+    result = None
+
+
+class SyncLoginFailed(SyncError):
+    """
+        Simplenote login (or the first request) failed
+    """
+
+
+class SyncListFailed(SyncError):
+    """
+        The Simplenote list could not be fetched, work done so far is saved
+    """
+
+
+class SyncResult:
+    """
+        Outcome of a sync: counters, operations (by kind), timings (seconds),
+        API request stats (latency & status by endpoint) & retries (by reason)
+
+        A dry run also has the plan (SyncPlan) that would have been carried out,
+        a failed sync the error.
+    """
+
+    def __init__(self, fast_sync):
+        self.fast_sync = fast_sync
+        self.counters = {'modified': 0, 'added': 0, 'deleted': 0, 'http_errors': 0, 'throttled': 0, 'requests': 0}
+        self.operations = dict.fromkeys(KINDS, 0)
+        # auth & index are time spent in those requests (part of replay/loop 1), the rest are phases
+        self.timings = {'auth': 0.0, 'index': 0.0, 'replay': 0.0, 'loop1': 0.0, 'commit': 0.0, 'loop2': 0.0, 'total': 0.0}
+        self.requests = None
+        self.retries = {}
+        self.plan = None
+        self.error = None
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+            Time a phase of the sync (adds to timings[name])
+        """
+        span_start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.monotonic() - span_start
+
+    @property
+    def changes(self):
+        """
+            Number of notes changed (either way)
+        """
+        return self.counters['modified'] + self.counters['added'] + self.counters['deleted']
+
+    def as_dict(self):
+        """
+            Result as a plain dict (i.e. for JSON)
+        """
+        return {'fast_sync': self.fast_sync, 'started': self.started, 'error': self.error, 'changes': self.changes,
+                'counters': dict(self.counters), 'operations': dict(self.operations), 'timings': dict(self.timings),
+                'requests': self.requests, 'retries': dict(self.retries)}
+
+
+class SyncEngine:
+    """
+        Syncs Simplenote with the local note folder
+
+        Uses the Config, Database, Note & Simplenote objects it's given (so a
+        long running process can keep them open between syncs), sync()
+        returns a SyncResult and failures raise SyncError; nothing here exits
+        the process, installs signal handlers or configures logging.
+    """
+
+    def __init__(self, config, db, note, simplenote, logger=None, dry_run=False, download_only=False, silent=True):
+        """
+            silent=False prints progress (CLI)
+        """
+        self.config = config
+        self.db = db
+        self.note = note
+        self.simplenote = simplenote
+        self.log = logger if logger is not None else logging.getLogger("snsync")
+        self.dry_run = dry_run
+        self.download_only = download_only
+        self.silent = silent
+
+        self.saved_token = None # API token as cached in the DB
+
+    def load_token(self):
+        """
+            Use the API token of an earlier run (cfg_token_cache), saves a login request
+        """
+        if not self.config.get_config_bool('cfg_token_cache'):
+            if not self.dry_run:
+                self.db.del_token()
+            return
+
+        if self.simplenote.token is None:
+            self.simplenote.token = self.db.get_token(self.simplenote.username)
+            if self.simplenote.token is not None:
+                self.log.debug('Using cached API token')
+        self.saved_token = self.simplenote.token
+
+    def save_token(self):
+        """
+            Cache the API token if it's new (i.e. the cached one expired)
+        """
+        token = self.simplenote.token
+        if self.dry_run or token is None or token == self.saved_token or not self.config.get_config_bool('cfg_token_cache'):
+            return
+        self.db.save_token(self.simplenote.username, token if isinstance(token, str) else str(token, 'utf-8'))
+        self.saved_token = token
+
+    def note_pages(self, since=None):
+        """
+            Simplenote list a page at a time, checkpointed so an interrupted sync carries on where it stopped
+        """
+        resume = self.db.get_resume()
+        if resume and (resume['since'] != since or time.time() - resume['started'] > RESUME_MAX_AGE):
+            self.log.info('Sync checkpoint is out of date, starting again')
+            resume = False
+
+        if resume:
+            self.log.info('Resuming interrupted sync, %s pages of Simplenotes already listed', resume['pages'])
+            for page in self.db.iter_resume_pages(resume):
+                notes, status = self.resumed_page(page)
+                yield notes, status
+                if status != 0:
+                    return
+            if resume['mark'] is None: # The list was complete
+                self.simplenote.current = resume['current']
+                return
+        else:
+            resume = {'since': since, 'started': time.time(), 'mark': None, 'current': None, 'pages': 0}
+
+        resume_mark = resume['mark']
+        for page, status in self.simplenote.iter_note_list(since=since, mark=resume_mark):
+            if status == 0:
+                resume['mark'] = self.simplenote.mark
+                resume['current'] = self.simplenote.current
+                if not self.dry_run:
+                    self.db.save_resume_page(resume, page)
+            elif resume_mark is not None and resume['mark'] == resume_mark and getattr(page, 'code', None) is not None:
+                self.log.warning('Simplenote list could not be resumed, the next sync will start again')
+                if not self.dry_run:
+                    self.db.clear_resume()
+            yield page, status
+
+    def resumed_page(self, page):
+        """
+            Notes of a checkpointed page ((key, version) pairs), returns (notes, status) like a page of the list
+
+            A note already synced at that version comes from the cache, the
+            others (i.e. downloads cut short) are fetched again.
+        """
+        notes = []
+        for key, version in page:
+            cached = self.db.find_sn_by_key(key)
+            if cached and str(cached['version']) == str(version):
+                notes.append(self.db.sn_entry(cached))
+                continue
+
+            note, status = self.simplenote.get_note(key)
+            if status == 0:
+                notes.append(note)
+            elif getattr(note, 'code', None) == 404: # deleted for good since
+                self.log.info('SN %s is no longer on Simplenote, skipped', key)
+            else:
+                return note, status
+        return notes, 0
+
+    def replay(self, planner, executor):
+        """
+            Send the outbound queue, local changes that didn't make it to Simplenote last time (oldest first)
+        """
+        if self.download_only: # kept for a sync that pushes
+            return
+
+        outbox = self.db.get_outbox()
+        if not outbox:
+            return
+
+        self.log.info('Outbox: %s queued local changes', len(outbox))
+        entries = []
+        for entry in outbox:
+            if entry['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+                self.log.error('Outbox: giving up on %s %s [%s] after %s attempts', entry['op'], entry['filename'], entry['key'], entry['attempts'])
+            else:
+                entries.append(entry)
+
+        operations = list(planner.outbox_operations(entries))
+
+        if not self.dry_run:
+            queued = set(op.key for op in operations)
+            for entry in outbox:
+                if entry['key'] not in queued: # sent, given up on or no longer needed
+                    self.db.outbox_done(entry['key'])
+
+        executor.run(operations)
+
+    def sync(self, fast_sync=None, sync_start=None):
+        """
+            One sync, 2 loops (planned by the Planner, carried out by the
+            Executor). Returns a SyncResult, raises SyncError if the sync failed
+
+            fast_sync=None uses the cfg_sync_fast setting, sync_start is the
+            time.monotonic() the timings start from (default: now).
+        """
+        if fast_sync is None:
+            fast_sync = self.config.get_config_bool('cfg_sync_fast')
+        if sync_start is None:
+            sync_start = time.monotonic()
+
+        self.load_token()
+
+        result = SyncResult(fast_sync)
+        counters = result.counters
+        self.simplenote.stats.reset() # request stats of this sync (the transport & scheduler may be shared, see accounts)
+
+        filetime = datetime.datetime.now().strftime("%y%m%d-%H%M%S") # timestamp for files
+
+        sync_cursor = False
+        if fast_sync:
+            sync_cursor = self.db.get_snsync_meta("sn_cursor") # Simperium cursor from the last sync
+            if not sync_cursor:
+                self.log.info('No sync cursor found, running a full sync')
+
+        # Local files, one directory read
+        local_files = self.note.scan()
+
+        # Operations are planned one at a time (i.e. as the list arrives), the executor carries them out (or records them, dry run).
+        planner = Planner(self.db, self.note, self.log, local_files, filetime)
+        pool = WorkerPool(self.config.get_config('cfg_sync_workers'), self.log) # API requests run on a pool of workers
+        executor = Executor(self.db, self.note, self.simplenote, pool, result, self.log, local_files, planner.in_sync, filetime,
+                            dry_run=self.dry_run, download_only=self.download_only)
+
+        def finish():
+            """
+                Request counters, stats & timings of the sync
+            """
+            stats = self.simplenote.stats
+            result.requests = stats.as_dict()
+            retries = result.requests['retries']
+            counters['requests'] = stats.request_count()
+            counters['throttled'] = retries.get('throttled', 0)
+            result.retries = {'throttled': counters['throttled'], 'token': retries.get('token', 0), 'reconnect': retries.get('reconnect', 0)}
+            result.timings['auth'] = stats.seconds('auth')
+            result.timings['index'] = stats.seconds('index')
+            result.timings['total'] = time.monotonic() - sync_start
+
+        def stopped(error):
+            """
+                The sync can't carry on, keep the work done so far. Returns error (to raise)
+            """
+            pool.shutdown()
+            self.save_token()
+            with result.span('commit'):
+                self.db.commit()
+            finish()
+            result.error = str(error)
+            error.result = result
+            return error
+
+        # Local changes queued by an earlier sync go first, the list then reflects them
+        with result.span('replay'):
+            self.replay(planner, executor)
+
+        try:
+            if sync_cursor:
+                self.log.info('Fast Sync: Simplenotes changed since cursor %s', sync_cursor)
+                pages = self.note_pages(since=sync_cursor)
+                first_page = next(pages)
+                if first_page[1] != 0:
+                    self.log.warning('Sync cursor rejected, falling back to full sync')
+                    sync_cursor = False
+            if not sync_cursor:
+                pages = self.note_pages() # the mac daddy important bit!
+                first_page = next(pages)
+        except Exception as e:
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            raise stopped(SyncLoginFailed('Simplenote Login Failed')) from e
+
+        if first_page[1] != 0:
+            self.log.debug('API Result: %s', first_page)
+            raise stopped(SyncListFailed('Simplenote LIST Request FAILED'))
+
+        result.fast_sync = bool(sync_cursor)
+
+        list_failed = False
+
+        def note_stream():
+            """
+                Notes as the pages of the list arrive, only one page is held in memory
+            """
+            nonlocal list_failed
+            changed_keys = set()
+
+            for page, status in itertools.chain([first_page], pages):
+                if status != 0:
+                    self.log.debug('API Result: %s', page)
+                    list_failed = True
+                    return
+                for n in page:
+                    changed_keys.add(n['key'])
+                    yield n
+
+            if sync_cursor:
+                # Unchanged notes come from the local cache, local changes still need checking
+                self.log.info('Fast Sync: %s changed Simplenotes', len(changed_keys))
+                for n in self.db.find_sn_all():
+                    if n['key'] not in changed_keys:
+                        yield n
+
+        if self.download_only:
+            self.log.info('Download Only Mode')
+            if not self.silent:
+                print('Download Only Mode')
+
+        if not self.silent:
+            print("Scanning Simplenotes")
+
+        progress = Progress('Simplenotes', self.db.count_sn(), 'notes', self.silent, self.simplenote.stats.request_count) # total is a guess, the list is still arriving
+
+        # Loop 1
+        try:
+            with result.span('loop1'):
+                executor.run(planner.remote_operations(counted(note_stream(), progress))) # Loop 2 needs the notefile meta of every download
+        except SimplenoteLoginFailed as e: # the token expired & a new login was refused, mid list
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            raise stopped(SyncLoginFailed('Simplenote Login Failed')) from e
+
+        progress.finish()
+
+        if list_failed: # Keep what's done, the next sync carries on from the checkpoint
+            raise stopped(SyncListFailed('Simplenote LIST Request FAILED'))
+
+        if not self.dry_run:
+            with result.span('commit'):
+                if counters['http_errors'] == 0:
+                    self.db.update_snsync("sn_cursor", self.simplenote.current) # next fast sync starts here
+                else:
+                    self.log.info('Download errors, sync cursor not updated')
+                self.db.clear_resume() # the Simplenote list is done with
+                self.db.commit()
+
+        # Loop 2
+        if not self.download_only:
+            if not self.silent:
+                print("Scanning %s local files" % len(local_files))
+
+            progress = Progress('Local files', len(local_files), 'files', self.silent, self.simplenote.stats.request_count)
+
+            with result.span('loop2'):
+                executor.run(planner.local_operations(counted(local_files.items(), progress))) # local search for new files
+
+            progress.finish()
+
+        if self.dry_run:
+            result.plan = executor.plan
+
+        pool.shutdown()
+        self.save_token()
+        self.build_search()
+
+        with result.span('commit'):
+            if not self.dry_run:
+                self.db.save_filestate(planner.last_file_state, planner.in_sync) # stat snapshot for the next run
+                self.db.update_snsync("sn_last_sync", time.time()) # record last sync
+            self.db.commit()
+
+        finish()
+        return result
+
+    def build_search(self):
+        """
+            Add the notes synced before there was a search index (once), after that the executor keeps it up to date
+        """
+        if self.dry_run or not self.db.fts or self.db.get_snsync_meta('sn_search_built'):
+            return
+
+        indexed = self.db.search_keys()
+        count = 0
+        for nf_meta in self.db.find_nf_all():
+            if nf_meta['key'] in indexed:
+                continue
+            notefile_full = self.note.open(nf_meta['filename'])
+            if not notefile_full:
+                continue
+            cached = self.db.find_sn_by_key(nf_meta['key'])
+            self.db.search_add(nf_meta['key'], nf_meta['filename'], notefile_full['content'], cached['tags'] if cached else [])
+            count += 1
+
+        self.log.info('Search index built, %s notes added', count)
+        self.db.update_snsync('sn_search_built', time.time())
+
+    def local_changes(self, filenames):
+        """
+            Watch mode - any files changed since the last sync? (our own writes aren't changes)
+        """
+        if '' in filenames: # lost track, assume so
+            return True
+
+        last_file_state = self.db.get_filestate()
+        for filename in filenames:
+            fstat = self.note.stat(filename)
+            if fstat:
+                if last_file_state.get(filename) != file_state(fstat):
+                    return True
+            elif filename in last_file_state: # deleted
+                return True
+        return False
+
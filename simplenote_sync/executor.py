@@ -0,0 +1,394 @@
+"""
+    Sync executor for snsync - carries out the operations of a sync plan
+"""
+# pylint: disable=W0718
+# pylint: disable=C0301
+
+import os
+import sys
+import functools
+
+from .notes import file_state, content_digest
+from .plan import SyncPlan, DOWNLOAD, UPLOAD, TRASH_LOCAL, TRASH_REMOTE, CONFLICT, CACHE, RENAME, MOVE, SKIP
+
+
+class Executor:
+    """
+        Carries out sync operations
+
+        Operations that only touch the note folder & DB run straight away,
+        API requests are batched on the worker pool and run concurrently;
+        their results (DB & file writes) are handled on this thread, one at
+        a time. run() takes any iterable of operations, i.e. the planner's
+        generator, so requests start while the Simplenote list is still
+        arriving. A dry run only records the operations in self.plan.
+    """
+
+    def __init__(self, db, note, simplenote, pool, result, logger, local_files, in_sync, filetime, dry_run=False, download_only=False):
+        """
+            result is the SyncResult to count into, in_sync (filename ->
+            file_state()) collects the files in sync with Simplenote &
+            filetime is the timestamp for trashed files.
+        """
+        self.db = db
+        self.note = note
+        self.simplenote = simplenote
+        self.pool = pool
+        self.result = result
+        self.counters = result.counters
+        self.log = logger
+        self.local_files = local_files
+        self.in_sync = in_sync
+        self.filetime = filetime
+        self.dry_run = dry_run
+        self.download_only = download_only
+
+        self.path = note.config.get_config('cfg_nt_path')
+        self.trash_path = note.config.get_config('cfg_nt_trashpath')
+        self.plan = SyncPlan()
+        self.journal = dict((entry['key'], entry['filename']) for entry in db.get_outbox() if entry['op'] == 'add') # Uploads of an interrupted sync, the notes may be on Simplenote already
+
+        self.actions = {DOWNLOAD: self.download,
+                        UPLOAD: self.upload,
+                        TRASH_LOCAL: self.trash_local,
+                        TRASH_REMOTE: self.trash_remote,
+                        CONFLICT: self.conflict,
+                        CACHE: self.cache,
+                        RENAME: self.rename,
+                        MOVE: self.move,
+                        SKIP: self.skip}
+
+    def run(self, operations):
+        """
+            Count & carry out (or record) operations, returns once all of them are done
+        """
+        for op in operations:
+            self.result.operations[op.kind] += 1
+            if op.counter is not None:
+                self.counters[op.counter] += 1
+
+            if self.dry_run:
+                self.plan.add(op)
+            else:
+                self.actions[op.kind](op)
+
+        self.pool.drain()
+
+    def synced(self, filename, fstat=None):
+        """
+            Record a local file as in sync with Simplenote
+        """
+        if fstat is None:
+            fstat = self.note.stat(filename)
+        if fstat:
+            self.in_sync[filename] = file_state(fstat)
+
+    def adopt(self, key, content, tags=None):
+        """
+            New Simplenote that's already a local file (interrupted upload or download), returns filename & file digest
+        """
+        filename = self.journal.get(key)
+        if filename is None:
+            filename = self.note.get_filename(content, self.note.folder(tags))
+
+        if not filename or filename not in self.local_files or self.db.find_nf_by_name(filename):
+            return False, None
+
+        notefile_full = self.note.open(filename)
+        if not notefile_full:
+            return False, None
+
+        if key not in self.journal and notefile_full['digest'] != content_digest(content):
+            return False, None # just the same name
+
+        self.log.info('Resuming interrupted sync, %s is Simplenote %s', filename, key)
+        return filename, notefile_full['digest']
+
+    def download(self, op):
+        """
+            Get the latest note (index payload, or download)
+        """
+        if op.new: # Cached once written, an interrupted download is still new next time.
+            self.pool.submit(self.simplenote.get_note_from_index, (op.note,), functools.partial(self.sn_added, op.note))
+        else:
+            self.pool.submit(self.simplenote.get_note_from_index, (op.note,), functools.partial(self.sn_downloaded, op.note, op.filename))
+
+    def upload(self, op):
+        """
+            Push a modified (or new) note file to Simplenote
+        """
+        if op.new:
+            self.add(op)
+            return
+
+        notefile_full = self.note.open(op.filename)
+
+        if notefile_full and notefile_full['digest'] == op.meta['digest']: # Only the mtime changed, don't upload
+            self.log.info('NF %s content unchanged, skipping upload', op.filename)
+            self.counters['modified'] -= 1
+            nf_meta = dict(op.meta) # refresh meta only
+            nf_meta['modifydate'] = notefile_full['modifydate']
+            self.db.nf(nf_meta)
+            self.db.outbox_done(op.key)
+            self.in_sync[op.filename] = notefile_full['state']
+
+        elif notefile_full:
+            nf = {}
+            nf['key'] = op.key
+            nf['content'] = notefile_full['content']
+            nf['modifydate'] = notefile_full['modifydate']
+            nf['version'] = op.note['version']
+            nf['tags'] = op.note['tags']
+            nf['systemTags'] = op.note['systemTags']
+
+            self.db.outbox_add(op.key, 'update', op.filename) # queued until Simplenote has it
+            self.pool.submit(self.simplenote.update_note, (nf,), functools.partial(self.nf_uploaded, op.note, op.filename, notefile_full))
+
+    def add(self, op):
+        """
+            Push a new note file to Simplenote
+        """
+        if self.db.find_nf_by_name(op.filename): # adopted by a download of this sync
+            self.log.debug('NF %s is already a Simplenote', op.filename)
+            self.counters['added'] -= 1
+            return
+
+        nf_meta = op.meta
+        nf_detail = self.note.open(op.filename)
+        if not nf_detail:
+            self.counters['added'] -= 1
+            return
+
+        new_sn_object = {}
+        new_sn_object['key'] = nf_meta['key']
+        new_sn_object['createdate'] = nf_meta['createdate']
+        new_sn_object['modifydate'] = nf_meta['modifydate']
+        new_sn_object['content'] = nf_detail['content']
+        tag = self.note.folder_tag(op.filename)
+        if tag:
+            new_sn_object['tags'] = [tag] # selective sync, the tag of its folder
+        nf_meta['digest'] = nf_detail['digest']
+
+        self.db.outbox_add(nf_meta['key'], 'add', op.filename) # Simplenote key is from the filename, an interrupted upload can be matched up next time
+
+        self.pool.submit(self.simplenote.add_note, (new_sn_object,), functools.partial(self.nf_added, nf_meta, file_state(op.fstat))) # Add the note!
+
+    def trash_local(self, op):
+        """
+            Simplenote trashed, move the note file to the trash folder
+        """
+        n = op.note
+        self.db.del_nf(n['key']) # delete nofile meta (forget the file)
+        self.db.sn(n) # update simplenote cache
+
+        old_fqdn = self.path + "/" + op.filename
+        new_fqdn = self.path + "/" + self.trash_path + "/" + self.filetime + "_" + op.filename.replace("/", "_")
+
+        try:
+            os.rename(old_fqdn, new_fqdn)
+            self.log.debug("TRASH | Old: %s New: %s", old_fqdn, new_fqdn)
+        except Exception:
+            self.log.error("Failed to move file  %s -> %s", old_fqdn, new_fqdn)
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+
+    def trash_remote(self, op):
+        """
+            Note file deleted, trash the Simplenote
+        """
+        if not self.download_only:
+            self.db.outbox_add(op.key, 'trash', op.filename)
+            note = op.note or self.db.find_sn_by_key(op.key) # latest version we know of, saves a GET
+            self.pool.submit(self.simplenote.trash_note, (op.key, note['version'] if note else None), functools.partial(self.sn_trashed, op.key))
+
+    def conflict(self, op):
+        """
+            Both sides modified, move the note file out of the way (the download replaces it)
+        """
+        old_fqdn = self.path + "/" + op.filename
+        new_fqdn = self.path + "/" + op.target
+
+        self.log.debug("DUP | Old: %s New: %s", old_fqdn, new_fqdn)
+        try:
+            os.rename(old_fqdn, new_fqdn)
+        except Exception:
+            self.log.error("Failed to move file  %s -> %s", old_fqdn, new_fqdn)
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+
+    def cache(self, op):
+        """
+            Trashed Simplenote, cache it so it isn't new next time
+        """
+        self.db.sn(op.note)
+
+    def rename(self, op):
+        """
+            Note file renamed, the notefile meta follows it (nothing changes on Simplenote)
+        """
+        nf_meta = dict(op.meta)
+        nf_meta['filename'] = op.target
+        self.db.nf(nf_meta)
+        self.db.search_rename(op.key, op.target)
+
+    def move(self, op):
+        """
+            Simplenote re-tagged, move the note file to its tag's folder (the content is downloaded only if it changed too)
+        """
+        old_fqdn = self.path + "/" + op.filename
+        new_fqdn = self.path + "/" + op.target
+
+        self.log.debug("MOVE | Old: %s New: %s", old_fqdn, new_fqdn)
+        try:
+            os.rename(old_fqdn, new_fqdn)
+        except Exception:
+            self.log.error("Failed to move file  %s -> %s", old_fqdn, new_fqdn)
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            return
+
+        self.rename(op)
+        cached = self.db.find_sn_by_key(op.key)
+        if cached:
+            self.db.sn(dict(self.db.sn_entry(cached), tags=op.note['tags'])) # only the tags, the content may still be on its way
+
+    def skip(self, op):
+        """
+            Simplenote without a synced tag, cache it (and forget its file, if it had one)
+        """
+        if op.meta:
+            self.db.del_nf(op.key)
+        self.db.sn(op.note)
+
+    def sn_trashed(self, key, trash_note):
+        """
+            Loop 1 - Local file deleted, Simplenote trash request done.
+        """
+        self.log.debug('API Result: %s', trash_note)
+
+        if trash_note[1] == 0:
+            self.db.sn(trash_note[0])
+            self.db.del_nf(key)
+            self.db.outbox_done(key)
+            self.log.info('SN Deleted [%s]', key)
+        elif getattr(trash_note[0], 'code', None) == 404: # Not on Simplenote (i.e. a queued add that never made it)
+            self.db.del_nf(key)
+            self.db.outbox_done(key)
+            self.log.info('SN Not Found [%s], nothing to delete', key)
+        else:
+            self.log.error('Simplenote DELETE Request Failed [%s]', key)
+            self.db.outbox_failed(key)
+            self.counters['http_errors'] += 1
+            self.counters['deleted'] -= 1 # giveth and taketh away!
+
+    def sn_downloaded(self, n, nf_filename, thisnote_full):
+        """
+            Loop 1 - Simplenote modified, latest note ready to write to file.
+        """
+        self.log.debug('API Result: %s', thisnote_full)
+
+        if thisnote_full[1] == 0:
+            if not nf_filename: # Catch critial AWOL Files
+                nf_filename = self.note.get_filename(thisnote_full[0]['content'], self.note.folder(n['tags']))
+
+            # Generate new notefile meta
+            nf_meta = {}
+            nf_meta['filename'] = nf_filename
+            nf_meta['key'] = n['key']
+            nf_meta['createdate'] = n['createdate']
+            nf_meta['modifydate'] = n['modifydate']
+            nf_meta['deleted'] = n['deleted']
+            nf_meta['digest'] = content_digest(thisnote_full[0]['content'])
+
+            self.db.sn(n) # Update simplenote Cache
+
+            if nf_filename:
+                self.db.nf(nf_meta) # Update notefile meta
+                if self.note.update(thisnote_full[0], nf_meta): # Write to file
+                    self.synced(nf_filename)
+                    self.db.search_add(n['key'], nf_filename, thisnote_full[0]['content'], thisnote_full[0].get('tags', n['tags']))
+            else:
+                self.counters['modified'] -= 1
+        else:
+            self.log.error('Simplenote DOWNLOAD Request FAILED [%s]', n['key'])
+            self.counters['http_errors'] += 1
+            self.counters['modified'] -= 1 # so far yet so close ;)
+
+    def nf_uploaded(self, n, nf_filename, notefile_full, note_update):
+        """
+            Loop 1 - Local note modified, Simplenote update request done.
+        """
+        self.log.debug('API Result: %s', note_update)
+
+        if note_update[1] == 0:
+            self.in_sync[nf_filename] = notefile_full['state'] # the file as it was uploaded
+            nf_meta = {} # update meta
+            nf_meta['filename'] = nf_filename
+            nf_meta['key'] = note_update[0]['key']
+            nf_meta['createdate'] = note_update[0]['createdate']
+            nf_meta['modifydate'] = note_update[0]['modifydate']
+            nf_meta['deleted'] = note_update[0]['deleted']
+            nf_meta['digest'] = notefile_full['digest']
+
+            self.db.sn(note_update[0])
+            self.db.nf(nf_meta)
+            self.db.outbox_done(n['key'])
+            self.db.search_add(n['key'], nf_filename, notefile_full['content'], note_update[0].get('tags', n['tags']))
+
+            self.log.info('SN Updated [%s] from %s', n['key'], nf_filename)
+        else:
+            self.log.error('Simplenote UPDATE Request FAILED [%s] <- %s', n['key'], nf_filename)
+            self.db.outbox_failed(n['key'])
+            self.counters['http_errors'] += 1
+            self.counters['modified'] -= 1
+
+    def sn_added(self, n, thisnote_full):
+        """
+            Loop 1 - New Simplenote, note ready to write to a new file.
+        """
+        self.log.debug('API Result: %s', thisnote_full)
+
+        if thisnote_full[1] == 0:  # success
+            self.db.sn(n) # Update simplenote Cache
+
+            thisnote_file, file_digest = self.adopt(n['key'], thisnote_full[0]['content'], n['tags'])
+            if thisnote_file:
+                self.db.outbox_done(n['key'])
+            else:
+                thisnote_file = self.note.new(thisnote_full[0])
+
+            if thisnote_file:
+                nf_meta = {}
+                nf_meta['filename'] = thisnote_file
+                nf_meta['key'] = n['key']
+                nf_meta['createdate'] = n['createdate']
+                nf_meta['modifydate'] = n['modifydate']
+                nf_meta['deleted'] = n['deleted']
+                nf_meta['digest'] = content_digest(thisnote_full[0]['content'])
+                self.db.nf(nf_meta)
+                if file_digest in (None, nf_meta['digest']): # an adopted file that's been edited still needs uploading
+                    self.synced(thisnote_file)
+                self.db.search_add(n['key'], thisnote_file, thisnote_full[0]['content'], thisnote_full[0].get('tags', n['tags']))
+            else:
+                self.log.error("Failed to write note: %s", n['key'])
+
+        else:
+            self.log.error('Simplenote DOWNLOAD Request FAILED [%s]', n['key'])
+            self.counters['http_errors'] += 1
+            self.counters['added'] -= 1
+
+    def nf_added(self, nf_meta, nf_state, new_sn):
+        """
+            Loop 2 - New local file, Simplenote add request done.
+        """
+        self.log.debug('API Result: %s', new_sn)
+
+        if new_sn[1] == 0:
+            self.log.debug('New Simplenote Created: %s', new_sn)
+            self.db.sn(new_sn[0]) # Update simplenote Cache
+            self.db.nf(nf_meta) # Update notefile meta
+            self.db.outbox_done(nf_meta['key'])
+            self.in_sync[nf_meta['filename']] = nf_state
+            self.db.search_add(nf_meta['key'], nf_meta['filename'], new_sn[0].get('content', ''), new_sn[0].get('tags', []))
+        else:
+            self.log.error('Simplenote ADD Request FAILED [%s]', new_sn)
+            self.db.outbox_failed(nf_meta['key'])
+            self.counters['http_errors'] += 1
+            self.counters['added'] -= 1
@@ -0,0 +1,226 @@
+"""
+    Sync metrics for snsync - API request latency histograms, JSON & Prometheus textfile export
+"""
+# pylint: disable=W0718
+# pylint: disable=C0301
+
+import os
+import json
+import bisect
+import tempfile
+import threading
+import itertools
+
+from .version import __version__
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # seconds, upper bounds
+
+
+class Histogram:
+    """
+        Request latencies, counted in buckets (Prometheus style, le = less than or equal)
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+            Count one value
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        """
+            Histogram as a plain dict, bucket counts are cumulative
+        """
+        bounds = [str(le) for le in self.buckets] + ['+Inf']
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'buckets': dict(zip(bounds, itertools.accumulate(self.counts)))}
+
+
+class RequestStats:
+    """
+        Simplenote API requests of a sync, shared by the workers
+
+        Every HTTP request (retries included) is timed per endpoint (auth,
+        index, note_get, note_update, note_delete) along with its status
+        (HTTP code, or "error" if there was no response); retries are
+        counted by reason.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {} # endpoint -> Histogram
+        self.statuses = {} # endpoint -> {status: count}
+        self.retries = {} # reason -> count
+        self.requests = 0
+
+    def reset(self):
+        """
+            Start again (i.e. a new sync)
+        """
+        with self.lock:
+            self.latency = {}
+            self.statuses = {}
+            self.retries = {}
+            self.requests = 0
+
+    def observe(self, endpoint, status, seconds):
+        """
+            One request finished
+        """
+        with self.lock:
+            histogram = self.latency.get(endpoint)
+            if histogram is None:
+                histogram = self.latency[endpoint] = Histogram()
+            histogram.observe(seconds)
+            statuses = self.statuses.setdefault(endpoint, {})
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            self.requests += 1
+
+    def retry(self, reason):
+        """
+            A request is being sent again
+        """
+        with self.lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+
+    def request_count(self):
+        """
+            Number of requests sent (retries included)
+        """
+        return self.requests
+
+    def seconds(self, endpoint):
+        """
+            Total time spent in requests to endpoint
+        """
+        with self.lock:
+            histogram = self.latency.get(endpoint)
+            return histogram.sum if histogram is not None else 0.0
+
+    def as_dict(self):
+        """
+            Stats as a plain dict (i.e. for JSON)
+        """
+        with self.lock:
+            return {'latency': {endpoint: histogram.as_dict() for endpoint, histogram in self.latency.items()},
+                    'statuses': {endpoint: dict(statuses) for endpoint, statuses in self.statuses.items()},
+                    'retries': dict(self.retries)}
+
+
+def write_file(path, text):
+    """
+        Replace path with text in one go, readers (node_exporter) never see half a file
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.snsync-', suffix='.tmp', dir=folder)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def to_json(result, labels=None):
+    """
+        SyncResult as JSON (labels, i.e. the account, are added as they are)
+    """
+    metrics = result.as_dict()
+    metrics['version'] = __version__
+    if labels:
+        metrics.update(labels)
+    return json.dumps(metrics, indent=1)
+
+
+def label_value(value):
+    """
+        Escape a Prometheus label value
+    """
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def to_prometheus(result, labels=None):
+    """
+        SyncResult in the Prometheus text format (for the node_exporter textfile collector)
+
+        Values are for the last sync, labels (dict) are added to every sample.
+    """
+    lines = []
+    base = dict(labels or {})
+
+    def sample(name, extra, value):
+        """
+            One sample line
+        """
+        sample_labels = dict(base, **extra)
+        if sample_labels:
+            lines.append('%s{%s} %s' % (name, ','.join('%s="%s"' % (k, label_value(v)) for k, v in sample_labels.items()), value))
+        else:
+            lines.append('%s %s' % (name, value))
+
+    def metric(name, metric_type, help_text, samples=()):
+        """
+            HELP, TYPE & (extra labels, value) samples of one metric
+        """
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for extra, value in samples:
+            sample(name, extra, value)
+
+    metric('snsync_info', 'gauge', 'snsync version', [({'version': __version__}, 1)])
+    metric('snsync_last_sync_timestamp_seconds', 'gauge', 'When the last sync started', [({}, round(result.started, 3))])
+    metric('snsync_last_sync_success', 'gauge', 'Whether the last sync completed (1) or failed (0)', [({}, int(result.error is None))])
+    metric('snsync_last_sync_fast', 'gauge', 'Whether the last sync was a fast (delta) sync', [({}, int(bool(result.fast_sync)))])
+    metric('snsync_sync_phase_seconds', 'gauge', 'Time spent in each phase of the last sync',
+           [({'phase': phase}, round(seconds, 6)) for phase, seconds in result.timings.items()])
+    metric('snsync_sync_changes', 'gauge', 'Notes changed by the last sync',
+           [({'change': change}, result.counters[change]) for change in ('added', 'modified', 'deleted')])
+    metric('snsync_sync_operations', 'gauge', 'Operations of the last sync by kind',
+           [({'op': kind}, count) for kind, count in result.operations.items()])
+    metric('snsync_sync_http_errors', 'gauge', 'Failed Simplenote API requests in the last sync', [({}, result.counters['http_errors'])])
+    metric('snsync_sync_requests', 'gauge', 'Simplenote API requests sent by the last sync', [({}, result.counters['requests'])])
+    metric('snsync_api_retries', 'gauge', 'Simplenote API requests retried in the last sync, by reason',
+           [({'reason': reason}, count) for reason, count in sorted(result.retries.items())])
+
+    requests = result.requests or {'latency': {}, 'statuses': {}}
+    metric('snsync_api_responses', 'gauge', 'Simplenote API responses in the last sync, by endpoint & status',
+           [({'endpoint': endpoint, 'status': status}, count)
+            for endpoint, statuses in sorted(requests['statuses'].items()) for status, count in sorted(statuses.items())])
+
+    name = 'snsync_api_request_duration_seconds'
+    metric(name, 'histogram', 'Simplenote API request latency in the last sync')
+    for endpoint, histogram in sorted(requests['latency'].items()):
+        for le, count in histogram['buckets'].items():
+            sample(name + '_bucket', {'endpoint': endpoint, 'le': le}, count)
+        sample(name + '_sum', {'endpoint': endpoint}, histogram['sum'])
+        sample(name + '_count', {'endpoint': endpoint}, histogram['count'])
+
+    return '\n'.join(lines) + '\n'
+
+
+def export(result, json_path='', prom_path='', labels=None, logger=None):
+    """
+        Write the metrics of a sync (cfg_metrics_json / cfg_metrics_prom), returns False if a file could not be written
+    """
+    ok = True
+    for path, render in ((json_path, lambda r: to_json(r, labels)), (prom_path, lambda r: to_prometheus(r, labels))):
+        if not path:
+            continue
+        try:
+            write_file(path, render(result))
+        except OSError as e:
+            ok = False
+            if logger is not None:
+                logger.error('Metrics not saved to %s: %s', path, e)
+    return ok
@@ -0,0 +1,386 @@
+"""
+    Mock Simperium (Simplenote API) server for snsync - benchmarks & trying changes out without the real service
+
+    python3 -m simplenote_sync.mockserver --notes=1000 --port=8080
+    then sync against it with cfg_api_url = http://127.0.0.1:8080
+"""
+# pylint: disable=W0718
+# pylint: disable=C0301
+
+import re
+import sys
+import json
+import time
+import gzip
+import uuid
+import random
+import getopt
+import threading
+import http.server
+import urllib.parse
+
+from .simplenote import API_URL_PATHS
+
+
+AUTH_PATH, DATA_PATH = API_URL_PATHS
+NOTE_PATH = re.compile(r'^/i/([^/]+)(?:/v/(\d+))?$')
+WORDS = ('alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike november oscar papa '
+         'quebec romeo sierra tango uniform victor whiskey xray yankee zulu').split()
+
+
+def mock_note(content, tags=(), deleted=False, modified=None):
+    """
+        Note data as Simperium stores it
+    """
+    modified = time.time() if modified is None else modified
+    return {'content': content, 'tags': list(tags), 'systemTags': [], 'deleted': deleted,
+            'creationDate': modified, 'modificationDate': modified, 'shareURL': '', 'publishURL': ''}
+
+
+def corpus(count, seed=0, lines=8, modified=None):
+    """
+        Synthetic notes, (key, note data) pairs. Same seed, same notes
+    """
+    rand = random.Random(seed)
+    modified = time.time() - 86400 if modified is None else modified
+    for i in range(count):
+        title = 'Note %06d %s %s' % (i, rand.choice(WORDS), rand.choice(WORDS))
+        body = '\n'.join(' '.join(rand.choice(WORDS) for _ in range(rand.randint(4, 12))) for _ in range(lines))
+        tags = [rand.choice(WORDS)] if rand.random() < 0.3 else []
+        yield 'mock%08x' % i, mock_note(title + '\n' + body + '\n', tags, modified=modified - rand.randint(0, 86400 * 365))
+
+
+class MockSimperium:
+    """
+        In memory Simperium note bucket behind a local HTTP server
+
+        Implements what snsync uses: POST /authorize/, GET /index (paged
+        with mark, since & data) and GET/POST/DELETE /i/<key>[/v/<version>].
+        Updates are last write wins. latency (seconds added to every
+        request) & throttle (fraction of requests answered 429 with a
+        Retry-After) make it behave more like a real, busy, service.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, throttle=0.0, retry_after=1, password=None, logger=None):
+        """
+            password=None accepts any login, port=0 picks a free port
+        """
+        self.latency = float(latency)
+        self.throttle = float(throttle)
+        self.retry_after = retry_after
+        self.password = password
+        self.log = logger
+
+        self.lock = threading.Lock()
+        self.notes = {} # key -> [version, data, change number]
+        self.cv = 0 # change number of the latest change (the index "current" cursor)
+        self.token = uuid.uuid4().hex
+        self.counters = {'requests': 0, 'throttled': 0, 'logins': 0}
+        self.random = random.Random()
+
+        self.server = http.server.ThreadingHTTPServer((host, port), MockHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.thread = None
+
+    @property
+    def url(self):
+        """
+            Base URL for cfg_api_url / Simplenote(api_url=)
+        """
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def start(self):
+        """
+            Serve on a background thread, returns self
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mocksimperium', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+            Stop serving
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def populate(self, count, seed=0):
+        """
+            Add count synthetic notes (see corpus())
+        """
+        for key, data in corpus(count, seed):
+            self.put(key, data)
+
+    def put(self, key, data):
+        """
+            Create/replace a note, returns its new version
+        """
+        with self.lock:
+            self.cv += 1
+            version = self.notes[key][0] + 1 if key in self.notes else 1
+            self.notes[key] = [version, dict(data), self.cv]
+            return version
+
+    def get(self, key):
+        """
+            (version, data) of a note, None if there's no such note
+        """
+        with self.lock:
+            if key not in self.notes:
+                return None
+            version, data, _ = self.notes[key]
+            return version, dict(data)
+
+    def delete(self, key):
+        """
+            Delete a note for good
+        """
+        with self.lock:
+            self.cv += 1
+            self.notes.pop(key, None)
+
+    def index(self, since, mark, limit, data):
+        """
+            A page of the index: notes changed after change number since, in key order from after mark
+        """
+        with self.lock:
+            keys = sorted(key for key, note in self.notes.items() if note[2] > since and (mark is None or key > mark))
+            page = keys[:limit]
+            entries = []
+            for key in page:
+                version, note, _ = self.notes[key]
+                entries.append({'id': key, 'v': version, 'd': dict(note) if data else {}})
+            response = {'index': entries, 'current': str(self.cv)}
+            if len(keys) > limit:
+                response['mark'] = page[-1]
+        return response
+
+    def count(self):
+        """
+            Count a request, returns True if it's to be throttled
+        """
+        with self.lock:
+            self.counters['requests'] += 1
+            if self.throttle > 0 and self.random.random() < self.throttle:
+                self.counters['throttled'] += 1
+                return True
+        return False
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    """
+        Simperium API requests for MockSimperium (server.mock)
+    """
+
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real thing
+
+    def log_message(self, format, *args): # pylint: disable=W0622
+        log = self.server.mock.log
+        if log is not None:
+            log.debug("Mock Simperium: " + format, *args)
+
+    def reply(self, code, obj=None, headers=None):
+        """
+            JSON response (gzipped if the client accepts it)
+        """
+        body = b'' if obj is None else json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        if obj is not None and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header('Content-Encoding', 'gzip')
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.api('GET')
+
+    def do_POST(self):
+        self.api('POST')
+
+    def do_DELETE(self):
+        self.api('DELETE')
+
+    def api(self, method):
+        """
+            Route a request
+        """
+        mock = self.server.mock
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b'' # always read, the connection is reused
+
+        if mock.latency > 0:
+            time.sleep(mock.latency)
+        if mock.count():
+            self.reply(429, {'error': 'slow down'}, {'Retry-After': mock.retry_after})
+            return
+
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == AUTH_PATH and method == 'POST':
+            self.authorize(body)
+            return
+
+        if not url.path.startswith(DATA_PATH + '/'):
+            self.reply(404, {'error': 'not found'})
+            return
+
+        if self.headers.get('X-Simperium-Token') != mock.token:
+            self.reply(401, {'error': 'invalid token'})
+            return
+
+        path = url.path[len(DATA_PATH):]
+        if path == '/index' and method == 'GET':
+            self.index(query)
+            return
+
+        match = NOTE_PATH.match(path)
+        if match is None:
+            self.reply(404, {'error': 'not found'})
+        elif method == 'GET':
+            self.get_note(match.group(1))
+        elif method == 'POST':
+            self.post_note(match.group(1), match.group(2), body, query)
+        else:
+            mock.delete(match.group(1))
+            self.reply(200, {})
+
+    def authorize(self, body):
+        """
+            POST /authorize/ - username & password -> access_token
+        """
+        mock = self.server.mock
+        try:
+            login = json.loads(body.decode('utf-8'))
+        except ValueError:
+            self.reply(400, {'error': 'bad request'})
+            return
+
+        if not login.get('username') or (mock.password is not None and login.get('password') != mock.password):
+            self.reply(401, {'error': 'invalid password'})
+            return
+
+        with mock.lock:
+            mock.counters['logins'] += 1
+        self.reply(200, {'access_token': mock.token, 'username': login['username'], 'userid': uuid.uuid5(uuid.NAMESPACE_DNS, login['username']).hex})
+
+    def index(self, query):
+        """
+            GET /index?limit=&since=&mark=&data=
+        """
+        try:
+            limit = max(1, min(int(query.get('limit', ['100'])[0]), 1000))
+            since = int(query.get('since', ['0'])[0])
+        except ValueError:
+            self.reply(400, {'error': 'bad request'})
+            return
+
+        if since > self.server.mock.cv: # a cursor we never gave out
+            self.reply(400, {'error': 'invalid cursor'})
+            return
+
+        mark = query.get('mark', [None])[-1]
+        data = query.get('data', ['false'])[0] == 'true'
+        self.reply(200, self.server.mock.index(since, mark, limit, data))
+
+    def get_note(self, key):
+        """
+            GET /i/<key>
+        """
+        note = self.server.mock.get(key)
+        if note is None:
+            self.reply(404, {'error': 'not found'})
+            return
+        self.reply(200, note[1], {'X-Simperium-Version': note[0]})
+
+    def post_note(self, key, version, body, query):
+        """
+            POST /i/<key>[/v/<version>] - create/update (fields sent replace the stored ones),
+            as Simperium does a change to an older version is merged into the latest one
+        """
+        try:
+            fields = json.loads(body.decode('utf-8'))
+        except ValueError:
+            self.reply(400, {'error': 'bad request'})
+            return
+
+        mock = self.server.mock
+        note = mock.get(key)
+        if version is not None and note is None:
+            self.reply(404, {'error': 'not found'})
+            return
+        data = note[1] if note is not None else mock_note('')
+        data.update(fields)
+        version = mock.put(key, data)
+
+        if query.get('response', ['0'])[0] == '1':
+            self.reply(200, data, {'X-Simperium-Version': version})
+        else:
+            self.reply(200, None, {'X-Simperium-Version': version})
+
+
+def usage():
+    """
+        Print Help / Usage
+    """
+    print('''
+Usage: python3 -m simplenote_sync.mockserver [OPTIONS]
+
+OPTIONS:
+ -h, --help             Help!
+ -p, --port=            Port to listen on (default: 8080)
+ -n, --notes=           Number of synthetic notes to start with (default: 100)
+ -l, --latency=         Seconds added to each request (default: 0)
+ -t, --throttle=        Fraction of requests answered 429 (default: 0)
+ -P, --password=        Only accept this password (default: any)
+''')
+    sys.exit(0)
+
+
+def main(argv=sys.argv[1:]):
+    """
+        Run a mock server until Ctrl-C
+    """
+    port = 8080
+    notes = 100
+    latency = 0.0
+    throttle = 0.0
+    password = None
+
+    try:
+        opts, args = getopt.getopt(argv, 'hp:n:l:t:P:', ['help', 'port=', 'notes=', 'latency=', 'throttle=', 'password='])
+        for opt, arg in opts:
+            if opt in ['-h', '--help']:
+                usage()
+            elif opt in ['-p', '--port']:
+                port = int(arg)
+            elif opt in ['-n', '--notes']:
+                notes = int(arg)
+            elif opt in ['-l', '--latency']:
+                latency = float(arg)
+            elif opt in ['-t', '--throttle']:
+                throttle = float(arg)
+            elif opt in ['-P', '--password']:
+                password = arg
+    except (getopt.GetoptError, ValueError):
+        usage()
+
+    mock = MockSimperium(port=port, latency=latency, throttle=throttle, password=password)
+    mock.populate(notes)
+    print('Mock Simperium with %s notes on %s (cfg_api_url), Ctrl-C to stop' % (notes, mock.url))
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    mock.server.server_close()
+    print('Requests: %(requests)s Throttled: %(throttled)s Logins: %(logins)s' % mock.counters)
+
+
+if __name__ == '__main__':
+    main()
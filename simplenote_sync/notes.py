@@ -20,6 +20,34 @@ def file_birthtime(fstat_record):
         return fstat_record.st_ctime
 
 
+def file_state(fstat_record):
+    # Where fstat_record is result from os.stat(), a file that's not been touched has the same state
+    return (fstat_record.st_ino, fstat_record.st_size, fstat_record.st_mtime_ns)
+
+
+def content_digest(content):
+    # Where content is the note text, notes with the same content have the same digest
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def prefix_filename(filename, prefix):
+    # Where filename may be in a (tag) folder, i.e. work/hello.txt -> work/DUP_hello.txt
+    folder, name = os.path.split(filename)
+    return os.path.join(folder, prefix + name) if folder else prefix + name
+
+
+def safe_name(text):
+    # Where text is a tag (folder names) or line of a note (filenames)
+    safechars = string.ascii_letters + string.digits + " -_."
+    return ''.join(c for c in text if c in safechars)
+
+
+class NoteError(Exception):
+    """
+        The note folder can't be set up
+    """
+
+
 class Note:
     """
         Main Note File (local file) object
@@ -41,7 +69,7 @@ class Note:
             except Exception:
                 self.log.critical("Error creating directory %s", self.config.get_config('cfg_nt_path'))
                 self.log.debug("Exception: %s", sys.exc_info()[1])
-                sys.exit(1)
+                raise NoteError("Error creating directory %s" % self.config.get_config('cfg_nt_path'))
 
         # Try to create Recycle Bin (Trash) - cfg_nt_trashpath
         if not os.path.exists(self.config.get_config('cfg_nt_path') + "/" + self.config.get_config('cfg_nt_trashpath')):
@@ -51,7 +79,51 @@ class Note:
             except Exception:
                 self.log.critical("Error creating directory %s/%s", self.config.get_config('cfg_nt_path'), self.config.get_config('cfg_nt_trashpath'))
                 self.log.debug("Exception: %s", sys.exc_info()[1])
-                sys.exit(1)
+                raise NoteError("Error creating directory %s/%s" % (self.config.get_config('cfg_nt_path'), self.config.get_config('cfg_nt_trashpath')))
+
+        # Selective sync, only notes with these tags & each tag in its own folder (first match wins)
+        self.tag_folders = {} # tag (lower case) -> folder
+        for tag in self.config.get_config('cfg_sync_tags').split(','):
+            folder = safe_name(tag.strip()).strip(' .')
+            if folder and tag.strip().lower() not in self.tag_folders and folder != self.config.get_config('cfg_nt_trashpath'):
+                self.tag_folders[tag.strip().lower()] = folder
+        self.folder_tags = dict((folder, tag) for tag, folder in self.tag_folders.items())
+
+        for folder in self.tag_folders.values():
+            if not os.path.exists(self.config.get_config('cfg_nt_path') + "/" + folder):
+                try:
+                    os.mkdir(self.config.get_config('cfg_nt_path') + "/" + folder)
+                    self.log.info("Creating directory %s/%s", self.config.get_config('cfg_nt_path'), folder)
+                except Exception:
+                    self.log.critical("Error creating directory %s/%s", self.config.get_config('cfg_nt_path'), folder)
+                    self.log.debug("Exception: %s", sys.exc_info()[1])
+                    raise NoteError("Error creating directory %s/%s" % (self.config.get_config('cfg_nt_path'), folder))
+
+    def folders(self):
+        """
+            Folders (under cfg_nt_path) of the synced notes, '' is cfg_nt_path itself
+        """
+        if not self.tag_folders:
+            return ['']
+        return list(self.tag_folders.values())
+
+    def folder(self, tags):
+        """
+            Folder for a note with tags, None if the note isn't synced (not one of cfg_sync_tags)
+        """
+        if not self.tag_folders:
+            return ''
+        tags = set(str(tag).lower() for tag in tags or [])
+        for tag, folder in self.tag_folders.items():
+            if tag in tags:
+                return folder
+        return None
+
+    def folder_tag(self, filename):
+        """
+            Tag of the folder a note file is in (None if it's not in a tag folder)
+        """
+        return self.folder_tags.get(os.path.dirname(filename))
 
     def write(self, note, filename, access_time):
         self.log.debug('Filename: %s ', filename)
@@ -73,24 +145,25 @@ class Note:
             Create a new note file, returns filename
         """
         path = self.config.get_config('cfg_nt_path')
-        filename = self.get_filename(note['content'])
+        filename = self.get_filename(note['content'], self.folder(note.get('tags')))
         access_time = time.time()
         filetime = datetime.datetime.now().strftime("%y%m%d-%H%M%S")
 
         if filename:
             if os.path.isfile(path + "/" + filename):
-                filename = filetime + "_" + filename  # Don't blast over files with same name, i.e. same first line.
+                filename = prefix_filename(filename, filetime + "_")  # Don't blast over files with same name, i.e. same first line.
 
-            result = self.write(note, path + "/" + filename, access_time)
-            return result
+            if self.write(note, path + "/" + filename, access_time):
+                return filename # notefile meta stores the name, not the full path
+            return False
         else:
             self.log.error("Error generating filename for note: %s", note['key'])
 
         return False
 
-    def get_filename(self, content):
+    def get_filename(self, content, folder=''):
         """
-            Generate Safe Filename from Note Content
+            Generate Safe Filename from Note Content (in folder, see folder())
         """
         note_data = str.splitlines(content)
         try:
@@ -117,8 +190,7 @@ class Note:
 
         # http://stackoverflow.com/a/295146
         try:
-            safechars = string.ascii_letters + string.digits + " -_."
-            safename = ''.join(c for c in line_one if c in safechars)
+            safename = safe_name(line_one)
 
             if len(safename) >= filename_len: # truncate long names
                 safename = safename[:filename_len]
@@ -129,14 +201,50 @@ class Note:
 
             self.log.debug("Make Safe In: %s Out: %s", line_one, safename)
             filename = safename.strip() + "." + file_ext
+            if folder:
+                filename = folder + "/" + filename
             return filename
         except Exception:
             self.log.debug("Exception: %s", sys.exc_info()[1])
             return False
 
-    def gen_meta(self, filename):
+    def scan(self):
+        """
+            List the note files with one directory read (per folder), returns Dict: filename -> os.stat()
+        """
+        path = self.config.get_config('cfg_nt_path')
+        file_ext = self.config.get_config('cfg_nt_ext')
+        files = {}
+
+        for folder in self.folders():
+            prefix = folder + "/" if folder else ""
+            try:
+                with os.scandir(path + "/" + folder if folder else path) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(file_ext) and entry.is_file():
+                            files[prefix + entry.name] = entry.stat()
+            except OSError:
+                self.log.error("Failed to scan directory %s/%s", path, folder)
+                self.log.debug("Exception: %s", sys.exc_info()[1])
+
+        self.log.debug("Scanned %s note files", len(files))
+        return files
+
+    def stat(self, filename):
+        """
+            os.stat() a notefile, returns False if it's missing
+        """
+        path = self.config.get_config('cfg_nt_path')
+        try:
+            return os.stat(path + "/" + filename)
+        except OSError:
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            return False
+
+    def gen_meta(self, filename, fstat=None):
         """
             Generate notefile meta from filename - returns dict
+            (fstat, the file's os.stat(), if you already have it)
         """
         nf_meta = {}
         nf_meta['filename'] = filename
@@ -147,12 +255,14 @@ class Note:
         self.log.debug("Note File Meta Key: %s", nf_meta['key'])
 
         path = self.config.get_config('cfg_nt_path')
+        if fstat is None:
+            fstat = os.stat(path + "/" + filename)
 
         # WARNING THIS IS PLATFORM SPECIFIC
-        nf_meta['createdate'] = file_birthtime(os.stat(path + "/" + filename))
+        nf_meta['createdate'] = file_birthtime(fstat)
         self.log.debug("Note File Meta Created: %s [%s]", nf_meta['createdate'], time.ctime(nf_meta['createdate']))
 
-        nf_meta['modifydate'] = os.stat(path + "/" + filename).st_mtime
+        nf_meta['modifydate'] = fstat.st_mtime
         self.log.debug("Note File Meta Modified: %s [%s]", nf_meta['modifydate'], time.ctime(nf_meta['modifydate']))
 
         return nf_meta
@@ -172,28 +282,30 @@ class Note:
 
     def open(self, filename):
         """
-            Open a notefile, returns Dict: content & modifydate
+            Open a notefile, returns Dict: content, digest, modifydate, createdate & state
         """
         notefile = {}
         path = self.config.get_config('cfg_nt_path')
 
-        if os.path.isfile(path + "/" + filename):
-            try:
-                f = open(path + "/" + filename, 'r', encoding='utf-8')
+        try:
+            with open(path + "/" + filename, 'r', encoding='utf-8') as f:
                 notefile['content'] = f.read()
-                f.close()
-            except Exception:
-                self.log.error("Failed to OPEN/READ: %s", path + "/" + filename)
-                self.log.debug("Exception: %s", sys.exc_info()[1])
-                return False
-        else:
+                fstat = os.fstat(f.fileno()) # stats of the file we've read
+        except FileNotFoundError:
             self.log.error("Notefile not found: %s", path + "/" + filename)
             return False
+        except Exception:
+            self.log.error("Failed to OPEN/READ: %s", path + "/" + filename)
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            return False
+
+        notefile['digest'] = content_digest(notefile['content'])
+        notefile['state'] = file_state(fstat)
 
-        notefile['modifydate'] = os.stat(path + "/" + filename).st_mtime
+        notefile['modifydate'] = fstat.st_mtime
         self.log.debug("Note File Modified: %s [%s]", notefile['modifydate'], time.ctime(notefile['modifydate']))
 
-        notefile['createdate'] = file_birthtime(os.stat(path + "/" + filename))
+        notefile['createdate'] = file_birthtime(fstat)
         self.log.debug("Note File Created: %s [%s]", notefile['createdate'], time.ctime(notefile['createdate']))
 
         return notefile
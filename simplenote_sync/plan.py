@@ -0,0 +1,388 @@
+"""
+    Sync planner for snsync - what a sync has to do, as a list of typed operations
+"""
+# pylint: disable=W0718
+# pylint: disable=C0301
+
+import os
+import json
+import time
+
+from .notes import file_state, prefix_filename
+
+
+# Operation kinds
+DOWNLOAD = 'download'         # Simplenote -> note file (new or modified Simplenote)
+UPLOAD = 'upload'             # note file -> Simplenote (new or modified file)
+TRASH_LOCAL = 'trash-local'   # Simplenote trashed, move the file to the trash folder
+TRASH_REMOTE = 'trash-remote' # Note file deleted, trash the Simplenote
+CONFLICT = 'conflict'         # Both changed, the file is kept as a DUP_ copy (uploaded as a new note)
+CACHE = 'cache'               # Trashed Simplenote we've never seen, only the cache is updated
+RENAME = 'rename'             # Note file renamed locally, only the notefile meta changes
+MOVE = 'move'                 # Simplenote re-tagged, the note file moves to its tag's folder
+SKIP = 'skip'                 # Simplenote without a synced tag (cfg_sync_tags), only the cache is updated
+
+KINDS = (DOWNLOAD, UPLOAD, TRASH_LOCAL, TRASH_REMOTE, CONFLICT, CACHE, RENAME, MOVE, SKIP)
+
+
+class Operation:
+    """
+        One thing a sync will do
+    """
+
+    def __init__(self, kind, key=None, filename=None, new=False, note=None, meta=None, fstat=None, target=None, reason='', version=None):
+        """
+            note is the Simplenote (list entry), meta the notefile meta (DB),
+            fstat the file's os.stat() & target the new filename of a conflict.
+            version is the Simplenote's (taken from note if not given).
+        """
+        self.kind = kind
+        self.key = key
+        self.filename = filename
+        self.new = new
+        self.note = note
+        self.meta = meta
+        self.fstat = fstat
+        self.target = target
+        self.reason = reason
+        self.version = version if version is not None or note is None else note.get('version')
+
+    @property
+    def counter(self):
+        """
+            SyncResult counter the operation adds to (None if it's not counted)
+        """
+        if self.kind in (DOWNLOAD, UPLOAD):
+            return 'added' if self.new else 'modified'
+        if self.kind in (TRASH_LOCAL, TRASH_REMOTE):
+            return 'deleted'
+        if self.kind == CACHE:
+            return 'added'
+        return None
+
+    def as_dict(self):
+        """
+            Operation as a plain dict (no note content)
+        """
+        op = {'op': self.kind, 'key': self.key, 'filename': self.filename, 'new': self.new}
+        if self.version is not None:
+            op['version'] = self.version
+        if self.target is not None:
+            op['target'] = self.target
+        if self.reason:
+            op['reason'] = self.reason
+        return op
+
+    def summary(self):
+        """
+            Copy of the operation for reports, without the note (content), meta & file stat
+        """
+        return Operation(self.kind, self.key, self.filename, new=self.new, target=self.target, reason=self.reason, version=self.version)
+
+    def __repr__(self):
+        return 'Operation(%s)' % ', '.join('%s=%r' % item for item in self.as_dict().items())
+
+
+class SyncPlan:
+    """
+        Operations of a sync, in the order they were planned
+    """
+
+    def __init__(self):
+        self.operations = []
+        self.created = time.time()
+
+    def add(self, op):
+        """
+            Append an operation, only its summary() is kept so a plan doesn't hold every note
+        """
+        self.operations.append(op.summary())
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def counts(self):
+        """
+            Number of operations of each kind
+        """
+        counts = dict.fromkeys(KINDS, 0)
+        for op in self.operations:
+            counts[op.kind] += 1
+        return counts
+
+    def as_dict(self):
+        """
+            Plan as a plain dict (i.e. for JSON)
+        """
+        return {'created': self.created, 'counts': self.counts(), 'operations': [op.as_dict() for op in self.operations]}
+
+    def to_json(self, indent=1):
+        """
+            Plan as JSON (dry run report)
+        """
+        return json.dumps(self.as_dict(), indent=indent)
+
+
+class Planner:
+    """
+        Works out what a sync has to do
+
+        The Simplenote list is compared with the local cache (the Database,
+        how things were after the last sync) and the note folder. Nothing is
+        changed here, so a dry run plans exactly what a real run carries out.
+        Operations are generated as the list arrives, one note at a time.
+    """
+
+    def __init__(self, db, note, logger, local_files, filetime):
+        """
+            local_files is the note folder scan (filename -> os.stat()), filetime the timestamp for new filenames
+        """
+        self.db = db
+        self.note = note
+        self.log = logger
+        self.local_files = local_files
+        self.filetime = filetime
+
+        # Files that haven't changed since the last sync (same inode, size & mtime) skip the upload checks.
+        self.last_file_state = db.get_filestate()
+        self.in_sync = {} # filename -> file_state(), files with nothing to do
+
+        # Rename detection, files without notefile meta by file_state() & by digest (built when first needed)
+        self.new_by_state = None
+        self.new_by_digest = None
+        self.renamed = set() # new filenames of renamed files, not new notes
+        self.duplicates = set() # DUP_ files of this sync
+
+        self.folders = set(note.folders()) # the folders scanned, cfg_nt_path or the tag folders
+
+    def outbox_operations(self, outbox):
+        """
+            Operations for the queued local changes (Database outbox) that still need sending
+        """
+        for entry in outbox:
+            key = entry['key']
+            filename = entry['filename']
+
+            if entry['op'] == 'trash':
+                if filename not in self.local_files and self.db.find_nf_by_key(key):
+                    yield Operation(TRASH_REMOTE, key, filename, reason='queued')
+                continue
+
+            fstat = self.local_files.get(filename)
+            if not fstat: # gone since, loop 1 sorts it out
+                continue
+
+            if entry['op'] == 'add':
+                if not self.db.find_nf_by_name(filename):
+                    nf_meta = self.note.gen_meta(filename, fstat)
+                    yield Operation(UPLOAD, nf_meta['key'], filename, new=True, meta=nf_meta, fstat=fstat, reason='queued')
+                continue
+
+            thisnote = self.db.find_sn_by_key(key)
+            thisfile = self.db.find_nf_by_key(key)
+            if thisnote and thisfile and thisfile['filename'] == filename:
+                yield Operation(UPLOAD, key, filename, note=self.db.sn_entry(thisnote), meta=thisfile, fstat=fstat, reason='queued')
+
+    def new_files(self):
+        """
+            Scanned files without notefile meta (new or renamed), by file_state()
+        """
+        if self.new_by_state is None:
+            self.new_by_state = {}
+            for filename, fstat in self.local_files.items():
+                if filename not in self.duplicates and not self.db.find_nf_by_name(filename):
+                    self.new_by_state[file_state(fstat)] = filename
+        return self.new_by_state
+
+    def find_rename(self, filename, thisfile):
+        """
+            New name of a missing note file, None if it really is gone
+
+            A file without notefile meta is the missing one renamed if it
+            has the same inode, size & mtime as the missing file did at the
+            last sync, or (i.e. copied elsewhere, then moved back) the same
+            content as was last synced. Each file can only be claimed once.
+        """
+        new_by_state = self.new_files()
+        if not new_by_state:
+            return None
+
+        last_state = self.last_file_state.get(filename)
+        new_filename = new_by_state.get(last_state) if last_state is not None else None
+
+        if new_filename is None and thisfile.get('digest'):
+            if self.new_by_digest is None: # only read if a rename isn't obvious from the stats
+                self.new_by_digest = {}
+                for name in new_by_state.values():
+                    notefile_full = self.note.open(name)
+                    if notefile_full:
+                        self.new_by_digest.setdefault(notefile_full['digest'], name)
+            new_filename = self.new_by_digest.get(thisfile['digest'])
+
+        if new_filename is None or new_filename in self.renamed or new_filename not in self.local_files:
+            return None
+
+        self.renamed.add(new_filename)
+        new_by_state.pop(file_state(self.local_files[new_filename]), None)
+        return new_filename
+
+    def same_content(self, filename, thisfile):
+        """
+            True if a note file has the content last synced (its digest), i.e. only its mtime changed
+        """
+        if not thisfile.get('digest'):
+            return False
+        notefile_full = self.note.open(filename)
+        return bool(notefile_full) and notefile_full['digest'] == thisfile['digest']
+
+    def remote_operations(self, notes):
+        """
+            Loop 1 - operations for each note in the Simplenote list
+        """
+        for n in notes:
+            yield from self.plan_note(n)
+
+    def plan_note(self, n):
+        """
+            Operations for one Simplenote, returns a list
+        """
+        thisnote = self.db.find_sn_by_key(n['key'])
+        folder = self.note.folder(n['tags']) # None if the note has none of the synced tags
+
+        if not thisnote: # New Note Added/Found in Simplenote
+            self.log.info('Adding SN NOTE: %s to Local DB', n['key'])
+            if n['deleted'] == 0 and folder is not None:
+                return [Operation(DOWNLOAD, n['key'], new=True, note=n, reason='new Simplenote')]
+            if n['deleted'] == 0:
+                return [Operation(SKIP, n['key'], note=n, reason='no synced tag')] # Cached, tags decide if it's synced later
+            return [Operation(CACHE, n['key'], note=n, reason='trashed Simplenote')] # Don't save deleted notes!
+
+        thisfile = self.db.find_nf_by_key(n['key']) # Note File Meta
+
+        if not thisfile: # No file meta
+            if n['deleted'] == 0 and folder is not None and self.note.tag_folders: # skipped until now
+                self.log.info("SN %s tagged for sync", n['key'])
+                return [Operation(DOWNLOAD, n['key'], new=True, note=n, reason='synced tag added')] # a new file, as for a new Simplenote
+            if n['deleted'] == 0 and folder is not None: # Exists in Simple note, but no meta
+                self.log.critical("File Meta AWOL - %s", n['key'])
+                return [Operation(DOWNLOAD, n['key'], note=n, reason='file meta missing')] # Generate new local file
+            if n['deleted'] == 0 and str(n['version']) != str(thisnote['version']):
+                return [Operation(SKIP, n['key'], note=n, reason='no synced tag')] # keep the cached tags up to date
+            self.log.debug("No file meta for deleted file simplenote, probably never written to disk")
+            return []
+
+        filename = thisfile['filename']
+        last_state = self.last_file_state.get(filename)
+        ops = []
+
+        if os.path.dirname(filename) not in self.folders: # synced before cfg_sync_tags changed, not scanned
+            if folder is None or n['deleted'] == 1:
+                self.log.info('Forgetting NF: %s [%s], no synced tag', filename, n['key'])
+                return [Operation(SKIP, n['key'], filename, note=n, meta=thisfile, reason='no synced tag')] # the file is left where it is
+            file_stat = self.note.stat(filename)
+            if file_stat:
+                self.local_files[filename] = file_stat # moved to its folder below
+
+        elif folder is None and n['deleted'] == 0: # Tag removed
+            if filename in self.local_files:
+                self.log.info('Removing File: %s, no synced tag', filename)
+                del self.local_files[filename] # moved to the trash, not a new file for loop 2
+                return [Operation(TRASH_LOCAL, n['key'], filename, note=n, meta=thisfile, reason='no synced tag')]
+            return [Operation(SKIP, n['key'], filename, note=n, meta=thisfile, reason='no synced tag')]
+
+        if filename not in self.local_files:
+            new_filename = self.find_rename(filename, thisfile)
+            if new_filename is not None: # Same note, no API requests
+                self.log.info('Renamed NF: %s -> %s [%s]', filename, new_filename, n['key'])
+                ops.append(Operation(RENAME, n['key'], filename, note=n, meta=thisfile, target=new_filename, reason='file renamed'))
+                filename = new_filename
+                thisfile = dict(thisfile, filename=filename)
+
+        if n['deleted'] == 1: # Seen and Deleted SN
+            if filename in self.local_files:
+                self.log.info('Deleting File: %s', filename)
+                del self.local_files[filename] # moved to the trash, not a new file for loop 2
+                ops.append(Operation(TRASH_LOCAL, n['key'], filename, note=n, meta=thisfile, reason='trashed on Simplenote'))
+            return ops
+
+        if filename not in self.local_files:
+            self.log.critical("Local File [%s] DELETED but not marked for deletion locally, assuming delete SN -> [%s]", filename, n['key'])
+            return [Operation(TRASH_REMOTE, n['key'], filename, note=n, meta=thisfile, reason='file deleted')]
+
+        if os.path.dirname(filename) != folder: # Tags changed, the file follows
+            new_filename = os.path.join(folder, os.path.basename(filename))
+            if new_filename in self.local_files or self.note.stat(new_filename):
+                new_filename = prefix_filename(new_filename, self.filetime + "_") # Don't blast over files with same name
+            self.log.info('Moving NF: %s -> %s [%s]', filename, new_filename, n['key'])
+            ops.append(Operation(MOVE, n['key'], filename, note=n, meta=thisfile, target=new_filename, reason='not in its tag folder'))
+            self.local_files[new_filename] = self.local_files.pop(filename)
+            self.renamed.add(new_filename)
+            filename = new_filename
+            thisfile = dict(thisfile, filename=filename)
+
+        # Modified S-Notes
+        file_stat = self.local_files[filename]
+        file_unchanged = last_state == file_state(file_stat) # Not touched since the last sync
+
+        # Dates are compared in whole seconds
+        sn_modifyseconds = int(float(n['modifydate'])) # Simple Note Modify Time
+        self.log.debug('SN Modified: %s [%s]', sn_modifyseconds, time.ctime(sn_modifyseconds))
+
+        sncache_modifyseconds = int(float(thisnote['modifydate'])) # Last known Simple Note Time
+        self.log.debug('SN (cached) Modified: %s [%s]', sncache_modifyseconds, time.ctime(sncache_modifyseconds))
+
+        nf_modifyseconds = int(file_stat.st_mtime) # Note File modify Time
+        self.log.debug('NF Modified: %s [%s]', nf_modifyseconds, time.ctime(nf_modifyseconds))
+
+        sn_modify = sn_modifyseconds > sncache_modifyseconds
+        if sn_modify:
+            self.log.debug('SN %s is newer than NF %s', n['key'], filename)
+
+        nf_modify = nf_modifyseconds > sn_modifyseconds and not file_unchanged
+        if nf_modify and sn_modify and self.same_content(filename, thisfile): # only touched, no conflict (the upload path checks in the Executor)
+            self.log.info('NF %s content unchanged since the last sync, not a conflict', filename)
+            nf_modify = False
+        if nf_modify:
+            self.log.debug('NF %s is newer than SN %s', filename, n['key'])
+
+        if nf_modify and sn_modify:
+            self.log.error('DUP! Modified Date Clash %s', filename)
+            dup_filename = prefix_filename(filename, "DUP_" + self.filetime + "_")
+            self.log.info('Duplicate File Created %s', dup_filename)
+            self.local_files[dup_filename] = file_stat # Loop 2 uploads the duplicate
+            self.duplicates.add(dup_filename)
+
+            self.log.info('[SN] > [NF] | %s -> %s', n['key'], filename)
+            return ops + [Operation(CONFLICT, n['key'], filename, note=n, meta=thisfile, fstat=file_stat, target=dup_filename, reason='modified on both sides'),
+                          Operation(DOWNLOAD, n['key'], filename, note=n, meta=thisfile, reason='Simplenote modified')]
+
+        if sn_modify:
+            self.log.info('[SN] > [NF] | %s -> %s', n['key'], filename)
+            return ops + [Operation(DOWNLOAD, n['key'], filename, note=n, meta=thisfile, reason='Simplenote modified')]
+
+        if nf_modify:
+            self.log.info('[SN] < [NF] | %s <- %s', n['key'], filename)
+            return ops + [Operation(UPLOAD, n['key'], filename, note=n, meta=thisfile, fstat=file_stat, reason='file modified')]
+
+        self.log.debug('No changes required for %s [%s]', filename, n['key'])
+        self.in_sync[filename] = file_state(file_stat)
+        return ops
+
+    def local_operations(self, files):
+        """
+            Loop 2 - operations for new local files, files is (filename, os.stat()) pairs
+        """
+        for notefile, notefile_stat in files:
+            if notefile in self.in_sync or notefile in self.renamed: # dealt with in loop 1, can't be new
+                continue
+
+            self.log.debug('Checking NF: %s', notefile)
+            if self.db.find_nf_by_name(notefile): # If there's no meta, this must be a new file
+                continue
+
+            self.log.info('NEW notefile for upload: %s', notefile)
+            nf_meta = self.note.gen_meta(notefile, notefile_stat)
+            yield Operation(UPLOAD, nf_meta['key'], notefile, new=True, meta=nf_meta, fstat=notefile_stat, reason='new file')
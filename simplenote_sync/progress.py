@@ -0,0 +1,88 @@
+"""
+    Progress bar for snsync (manual runs)
+"""
+# pylint: disable=C0301
+
+import sys
+import time
+import datetime
+
+
+class Progress:
+    """
+        Throttled progress bar
+
+        update() is cheap, the bar is only redrawn a few times a second so
+        the sync is never slowed down (or blocked) by the console.
+    """
+
+    def __init__(self, label, total, unit='notes', silent=False, requests=None, fps=10, stream=None):
+        """
+            requests is an optional callable returning the number of API
+            requests made so far (for the requests/s figure).
+        """
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.silent = silent
+        self.requests = requests
+        self.interval = 1.0 / fps
+        self.stream = stream if stream is not None else sys.stdout
+        self.count = 0
+        self.width = 30
+        self.start = time.monotonic()
+        self.start_requests = self.requests() if self.requests is not None else 0
+        self.last_draw = self.start
+        self.last_len = 0
+
+    def update(self, count=1):
+        """
+            Count progress, redraw if it's time to
+        """
+        self.count += count
+        if self.total and self.count > self.total: # the total was an estimate
+            self.total = self.count
+        if self.silent:
+            return
+        now = time.monotonic()
+        if now - self.last_draw >= self.interval:
+            self.last_draw = now
+            self.draw(now)
+
+    def draw(self, now):
+        """
+            Render the bar, rates & ETA on one line
+        """
+        elapsed = max(now - self.start, 0.001)
+        rate = self.count / elapsed
+
+        if self.total:
+            done = min(self.count, self.total)
+            filled = int(self.width * done / self.total)
+            bar = "[%s%s] %s/%s" % ("#" * filled, " " * (self.width - filled), done, self.total)
+        else:
+            bar = "%s" % self.count
+
+        line = "%s %s %.1f %s/s" % (self.label, bar, rate, self.unit)
+
+        if self.requests is not None:
+            line += " %.1f req/s" % ((self.requests() - self.start_requests) / elapsed)
+
+        if self.total and rate > 0 and self.count < self.total:
+            eta = datetime.timedelta(seconds=int((self.total - self.count) / rate))
+            line += " ETA %s" % eta
+
+        padding = " " * max(self.last_len - len(line), 0) # clear leftovers of a longer line
+        self.last_len = len(line)
+        self.stream.write("\r" + line + padding)
+        self.stream.flush()
+
+    def finish(self):
+        """
+            Final redraw and end the line
+        """
+        if self.silent:
+            return
+        self.draw(time.monotonic())
+        self.stream.write("\n")
+        self.stream.flush()
@@ -0,0 +1,161 @@
+"""
+    Request scheduler for snsync - rate limiting, backoff & adaptive concurrency
+"""
+# pylint: disable=W0718
+# pylint: disable=C0301
+
+import time
+import random
+import datetime
+import threading
+import email.utils
+
+
+RETRY_CODES = (429, 503) # Throttled / temporarily unavailable, worth trying again
+
+
+def retry_after_seconds(value):
+    """
+        Retry-After header (seconds or HTTP date) -> seconds, None if missing/invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class Scheduler:
+    """
+        Decides when Simplenote API requests are sent
+
+        * token bucket, at most rate requests a second (bursts of up to burst)
+        * at most limit requests in flight, halved when the API throttles us
+          and raised by one after a run of successful requests (up to concurrency)
+        * throttled requests (429/503) pause all requests for Retry-After
+          seconds, or a jittered exponential backoff, then try again.
+    """
+
+    def __init__(self, rate=10, concurrency=4, retries=5, backoff=1.0, max_backoff=60.0, burst=None, logger=None, clock=time.monotonic):
+        """
+            rate is requests per second (0 means no limit), retries is the
+            number of times a throttled request is tried again. clock is
+            seconds (monotonic), timed waits go through pause().
+        """
+        self.rate = float(rate)
+        self.concurrency = max(1, int(concurrency))
+        self.retries = max(0, int(retries))
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.burst = float(burst) if burst is not None else max(1.0, self.rate)
+        self.log = logger
+        self.clock = clock
+
+        self.cond = threading.Condition()
+        self.tokens = self.burst
+        self.last_refill = self.clock()
+        self.limit = self.concurrency # requests allowed in flight right now
+        self.active = 0
+        self.successes = 0 # since the limit last changed
+        self.paused_until = 0.0
+        self.throttled_count = 0 # for the logs
+
+    def acquire(self):
+        """
+            Wait until a request may be sent
+        """
+        with self.cond:
+            while True:
+                now = self.clock()
+
+                if now < self.paused_until:
+                    self.pause(self.paused_until - now)
+                    continue
+
+                if self.active >= self.limit:
+                    self.cond.wait()
+                    continue
+
+                if self.rate > 0:
+                    self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                    self.last_refill = now
+                    if self.tokens < 1:
+                        self.pause((1 - self.tokens) / self.rate)
+                        continue
+                    self.tokens -= 1
+
+                self.active += 1
+                return
+
+    def pause(self, seconds):
+        """
+            Wait up to seconds (the condition is held), other requests finishing wake us up early
+        """
+        self.cond.wait(seconds)
+
+    def release(self, ok=True):
+        """
+            Request finished (not throttled), successes slowly raise the concurrency limit
+        """
+        with self.cond:
+            self.active -= 1
+            if ok:
+                self.successes += 1
+                if self.limit < self.concurrency and self.successes >= self.limit * 4:
+                    self.limit += 1
+                    self.successes = 0
+                    if self.log is not None:
+                        self.log.debug("Scheduler: concurrency raised to %s", self.limit)
+            self.cond.notify_all()
+
+    def throttled(self, attempt, retry_after=None):
+        """
+            Request throttled, back off (everyone) & lower the concurrency limit. Returns the delay
+        """
+        delay = retry_after_seconds(retry_after)
+        if delay is None:
+            delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+            delay = delay / 2 + random.uniform(0, delay / 2) # jitter, don't retry in lock-step
+
+        with self.cond:
+            self.active -= 1
+            self.throttled_count += 1
+            self.limit = max(1, self.limit // 2)
+            self.successes = 0
+            self.paused_until = max(self.paused_until, self.clock() + delay)
+            self.cond.notify_all()
+
+        if self.log is not None:
+            self.log.warning("Simplenote API throttled, retrying in %.1fs (concurrency %s)", delay, self.limit)
+        return delay
+
+    def run(self, send, request, retry_codes=RETRY_CODES, retried=None):
+        """
+            send(request) when the scheduler allows, throttled requests are retried (retried('throttled') is called for each)
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                response = send(request)
+            except Exception as e:
+                code = getattr(e, 'code', None)
+                if code in retry_codes and attempt < self.retries:
+                    headers = getattr(e, 'headers', None)
+                    self.throttled(attempt, headers.get('Retry-After') if headers is not None else None)
+                    if retried is not None:
+                        retried('throttled')
+                    attempt += 1
+                    continue
+                self.release(ok=False)
+                raise
+            self.release()
+            return response
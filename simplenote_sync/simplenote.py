@@ -25,11 +25,16 @@ import base64
 import time
 import datetime
 import uuid
+import threading
 
 # crappy hack for inserting user-agent into Simplenote requests
 from .version import __version__ as snsync_version
 custom_user_agent = 'snsync/' + snsync_version + '(https://github.com/linickx/snsync)'
 
+from .transport import Transport
+from .scheduler import Scheduler
+from .metrics import RequestStats
+
 try:
     import json
 except ImportError:
@@ -47,6 +52,7 @@ API_KEY  = base64.b64decode('YzhjMmI4NjMzNzE1NGNkYWJjOTg5YjIzZTMwYzZiZjQ=')
 BUCKET   = 'note'
 AUTH_URL = 'https://auth.simperium.com/1/%s/authorize/' % (APP_ID)
 DATA_URL = 'https://api.simperium.com/1/%s/%s' % (APP_ID, BUCKET)
+API_URL_PATHS = ('/1/%s/authorize/' % (APP_ID), '/1/%s/%s' % (APP_ID, BUCKET)) # on another server, i.e. a mock
 NOTE_FETCH_LENGTH = 1000
 
 class SimplenoteLoginFailed(Exception):
@@ -56,13 +62,82 @@ class SimplenoteLoginFailed(Exception):
 class Simplenote(object):
     """ Class for interacting with the simplenote web service """
 
-    def __init__(self, username, password):
-        """ object constructor """
+    def __init__(self, username, password, transport=None, scheduler=None, token=None, api_url=None):
+        """ object constructor
+
+        Arguments:
+            - transport (Transport): optional connection pool, by default
+              a new one is created for this object
+            - scheduler (Scheduler): optional request scheduler (rate limit,
+              retries & concurrency), by default a new one is created
+            - token (string): optional API token from an earlier session, it's
+              used until the API rejects it (401), then renewed
+            - api_url (string): optional server to use instead of Simperium,
+              i.e. http://127.0.0.1:8080 (auth & data are both on it)
+
+        """
         self.username = username
         self.password = password
         self.header = 'X-Simperium-Token'
-        self.token = None
+        self.token = token
+        self.token_lock = threading.RLock()
+        if api_url:
+            self.auth_url = api_url.rstrip('/') + API_URL_PATHS[0]
+            self.data_url = api_url.rstrip('/') + API_URL_PATHS[1]
+        else:
+            self.auth_url = AUTH_URL
+            self.data_url = DATA_URL
         self.current = ""
+        self.mark = None
+        if transport is None:
+            transport = Transport(user_agent=custom_user_agent)
+        self.transport = transport
+        if scheduler is None:
+            scheduler = Scheduler()
+        self.scheduler = scheduler
+        self.stats = RequestStats() # latency & status of each request, by endpoint
+
+    def endpoint(self, request):
+        """ Name of the API endpoint a request is for (request stats) """
+        url = request.get_full_url()
+        if url.startswith(self.auth_url):
+            return 'auth'
+        if url.startswith(self.data_url + '/index'):
+            return 'index'
+        return 'note_' + {'GET': 'get', 'POST': 'update', 'DELETE': 'delete'}.get(request.get_method(), request.get_method().lower())
+
+    def send(self, request):
+        """ Send a request once (no retries), timed for the request stats """
+        started = time.monotonic()
+        status = 'error' # no response
+        try:
+            response = self.transport.urlopen(request, self.stats.retry)
+            status = response.getcode()
+            return response
+        except HTTPError as e:
+            status = e.code
+            raise
+        finally:
+            self.stats.observe(self.endpoint(request), status, time.monotonic() - started)
+
+    def urlopen(self, request):
+        """ Send a request when the scheduler allows, throttled requests
+        (429/503) are retried after Retry-After or a backoff. A request
+        with a rejected (401) token gets a new token and is sent once more.
+
+        """
+        try:
+            return self.scheduler.run(self.send, request, retried=self.stats.retry)
+        except HTTPError as e:
+            header = self.header.capitalize() # how urllib stores it
+            if e.code != 401 or not request.has_header(header):
+                raise
+            token = self.renew_token(request.get_header(header))
+            if token is None:
+                raise
+            request.add_header(self.header, token)
+            self.stats.retry('token')
+            return self.scheduler.run(self.send, request, retried=self.stats.retry)
 
     def authenticate(self, user, password):
         """ Method to get simplenote auth token
@@ -76,14 +151,14 @@ class Simplenote(object):
 
         """
 
-        request = Request(AUTH_URL)
+        request = Request(self.auth_url)
         request.add_header('X-Simperium-API-Key', API_KEY)
         if sys.version_info < (3, 3):
             request.add_data(json.dumps({'username': user, 'password': password}))
         else:
             request.data = json.dumps({'username': user, 'password': password}).encode()
         try:
-            res = urllib2.urlopen(request).read()
+            res = self.urlopen(request).read()
             token = json.loads(res.decode('utf-8'))["access_token"]
         except HTTPError:
             raise SimplenoteLoginFailed('Login to Simplenote API failed!')
@@ -101,13 +176,28 @@ class Simplenote(object):
             Simplenote API token as string
 
         """
-        if self.token == None:
-            self.token = self.authenticate(self.username, self.password)
+        with self.token_lock: # one login, however many workers are waiting
+            if self.token == None:
+                self.token = self.authenticate(self.username, self.password)
         try:
             return str(self.token,'utf-8')
         except TypeError:
             return self.token
 
+    def renew_token(self, rejected):
+        """ Method to replace a token the API rejected.
+
+        Workers that had the same token rejected share one new token.
+
+        Returns:
+            Simplenote API token as string (None if the login failed)
+
+        """
+        with self.token_lock:
+            if self.token is not None and self.get_token() == rejected:
+                self.token = None
+            return self.get_token()
+
     def get_note(self, noteid, version=None):
         """ Method to get a specific note
 
@@ -128,10 +218,10 @@ class Simplenote(object):
             params_version = '/v/' + str(version)
 
         params = '/i/%s%s' % (str(noteid), params_version)
-        request = Request(DATA_URL+params)
+        request = Request(self.data_url+params)
         request.add_header(self.header, self.get_token())
         try:
-            response = urllib2.urlopen(request)
+            response = self.urlopen(request)
         except HTTPError as e:
             return e, -1
         except IOError as e:
@@ -145,6 +235,31 @@ class Simplenote(object):
 
         return note, 0
 
+    def get_note_from_index(self, note):
+        """ Method to get a note using the index payload if possible
+
+        get_note_list() asks for data=true so index entries normally carry
+        the whole note, in which case no extra request is made. The note is
+        only fetched with get_note() when the payload has no content (i.e.
+        data=False or a cached entry) or is missing fields.
+
+        Arguments:
+            - note (dict): note object from get_note_list()
+
+        Returns:
+            A tuple `(note, status)`
+
+            - note (dict): note object
+            - status (int): 0 on success and -1 otherwise
+
+        """
+        if isinstance(note.get("content"), str) and "modifydate" in note and "createdate" in note:
+            if "tags" in note:
+                note["tags"] = sorted(note["tags"])
+            return note, 0
+
+        return self.get_note(note["key"])
+
     def update_note(self, note):
         """ Method to update a specific note object, if the note object does not
         have a "key" field, a new note is created
@@ -172,9 +287,9 @@ class Simplenote(object):
         # ccid = uuid.uuid4().hex
         if "version" in note:
             version = note.pop("version", None)
-            url = '%s/i/%s/v/%s?response=1' % (DATA_URL, noteid, version)
+            url = '%s/i/%s/v/%s?response=1' % (self.data_url, noteid, version)
         else:
-            url = '%s/i/%s?response=1' % (DATA_URL, noteid)
+            url = '%s/i/%s?response=1' % (self.data_url, noteid)
 
         # TODO: Could do with being consistent here. Everywhere else is Request(DATA_URL+params)
         note = self.__remove_simplenote_api_fields(note)
@@ -184,7 +299,7 @@ class Simplenote(object):
 
         response = ""
         try:
-            response = urllib2.urlopen(request)
+            response = self.urlopen(request)
         except IOError as e:
             return e, -1
         note = json.loads(response.read().decode('utf-8'))
@@ -217,7 +332,70 @@ class Simplenote(object):
         else:
             return "No string or valid note.", -1
 
-    def get_note_list(self, data=True, since=None, tags=[]):
+    def iter_note_list(self, data=True, since=None, tags=[], mark=None):
+        """ Generator version of get_note_list, pages are yielded as they
+        arrive so only one page of notes is held in memory
+
+        Arguments are the same as get_note_list(). The cursor (self.current)
+        and the mark of the next page (self.mark, None after the last page)
+        are updated before each page is yielded.
+
+        Yields:
+            A tuple `(notes, status)` for each page
+
+            - notes (list): the page of note objects (or the error)
+            - status (int): 0 on success and -1 otherwise, nothing more is
+              yielded after a failed page
+
+        """
+        # get the note index
+        params = '/index?limit=%s' % (str(NOTE_FETCH_LENGTH))
+
+        if since is not None:
+            params += '&since=%s' % (since)
+        # Fetching data is the default
+        if data:
+            params += '&data=true'
+
+        self.mark = mark
+        while True:
+            page_params = params
+            if self.mark is not None:
+                page_params += '&mark=%s' % (self.mark)
+
+            # perform the actual HTTP request
+            request = Request(self.data_url+page_params)
+            request.add_header(self.header, self.get_token())
+            try:
+                response = self.urlopen(request)
+                response_notes = json.loads(response.read().decode('utf-8'))
+            except IOError as e:
+                # A rejected/failed request has no cursor, keep the last known one
+                yield e, -1
+                return
+
+            # re-write for v1 consistency
+            note_objects = []
+            for n in response_notes["index"]:
+                # If data=False then can't do this bit... or not all of it, just have id and version. Add empty data object.
+                if not data:
+                    n['d'] = {}
+                note_object = self.__add_simplenote_api_fields(n['d'], n['id'], n['v'])
+                note_objects.append(note_object)
+
+            # Filter for tags a page at a time
+            if (len(tags) > 0):
+                note_objects = [n for n in note_objects if (len(set(n["tags"]).intersection(tags)) > 0)]
+
+            self.current = response_notes.get("current", self.current)
+            self.mark = response_notes.get("mark")
+            yield note_objects, 0
+
+            # get additional notes if bookmark was set in response
+            if self.mark is None:
+                return
+
+    def get_note_list(self, data=True, since=None, tags=[], mark=None, checkpoint=None):
         """ Method to get the note list
 
         The method can be passed optional arguments to limit the list to
@@ -234,6 +412,10 @@ class Simplenote(object):
             - since=cursor Simperium cursor as string: return only changes
               since this cursor
             - data=True If false only return keys/ids and versions
+            - mark=None Simperium index mark as string: start from this
+              page (i.e. resume an interrupted list)
+            - checkpoint=None function called after each page with
+              (page notes, next mark, cursor), the mark is None on the last page
 
         Returns:
             A tuple `(notes, status)`
@@ -243,102 +425,108 @@ class Simplenote(object):
             - status (int): 0 on success and -1 otherwise
 
         """
-        # initialize data
         status = 0
-        ret = []
-        response_notes = {}
-        notes = { "index" : [] }
-
-        # get the note index
-        params = '/index?limit=%s' % (str(NOTE_FETCH_LENGTH))
+        note_list = []
 
-        if since is not None:
-            params += '&since=%s' % (since)
-        # Fetching data is the default
-        if data:
-            params += '&data=true'
+        for notes, status in self.iter_note_list(data=data, since=since, tags=tags, mark=mark):
+            if status != 0:
+                break
+            note_list.extend(notes)
+            if checkpoint is not None:
+                checkpoint(notes, self.mark, self.current)
 
-        # perform initial HTTP request
-        request = Request(DATA_URL+params)
-        request.add_header(self.header, self.get_token())
-        try:
-            response = urllib2.urlopen(request)
-            response_notes = json.loads(response.read().decode('utf-8'))
-            # re-write for v1 consistency
-            note_objects = []
-            for n in response_notes["index"]:
-                # If data=False then can't do this bit... or not all of it, just have id and version. Add empty data object.
-                if not data:
-                    n['d'] = {}
-                note_object = self.__add_simplenote_api_fields(n['d'], n['id'], n['v'])
-                note_objects.append(note_object)
-            notes["index"].extend(note_objects)
-        except IOError:
-            status = -1
-
-        # get additional notes if bookmark was set in response
-        while "mark" in response_notes:
-            params += '&mark=%s' % response_notes["mark"]
-
-            # perform the actual HTTP request
-            request = Request(DATA_URL+params)
-            request.add_header(self.header, self.get_token())
-            try:
-                response = urllib2.urlopen(request)
-                response_notes = json.loads(response.read().decode('utf-8'))
-                # re-write for v1 consistency
-                note_objects = []
-                for n in response_notes["index"]:
-                    if not data:
-                        n['d'] = {}
-                    note_object = n['d']
-                    note_object = self.__add_simplenote_api_fields(n['d'], n['id'], n['v'])
-                    note_objects.append(note_object)
-                notes["index"].extend(note_objects)
-            except IOError:
-                status = -1
-        note_list = notes["index"]
-        self.current = response_notes["current"]
-        # Can only filter for tags at end, once all notes have been retrieved.
-        if (len(tags) > 0):
-            note_list = [n for n in note_list if (len(set(n["tags"]).intersection(tags)) > 0)]
         return note_list, status
 
-    def trash_note(self, note_id):
-        """ Method to move a note to the trash
+    def patch_note(self, note_id, fields, version=None):
+        """ Method to change some fields of a note, the others are left as
+        they are (no need to get the note first)
 
         Arguments:
-            - note_id (string): key of the note to trash
+            - note_id (string): key of the note to change
+            - fields (dict): Simperium fields to set, i.e. {"deleted": True}
+            - version (int): optional version the change is for, if the note
+              has changed since the API merges the change into the latest
+              version (a 412 means nothing was changed)
 
         Returns:
             A tuple `(note, status)`
 
-            - note (dict): the newly created note or an error message
+            - note (dict): the changed note or an error (HTTPError, code 412 on a version conflict)
             - status (int): 0 on success and -1 otherwise
 
         """
-        # get note
+        params = '/i/%s' % (str(note_id))
+        if version is not None:
+            params += '/v/%s' % (version)
+        request = Request(self.data_url+params+'?response=1', data=json.dumps(fields).encode('utf-8'))
+        request.add_header(self.header, self.get_token())
+        request.add_header('Content-Type', 'application/json')
+        try:
+            response = self.urlopen(request)
+        except IOError as e:
+            return e, -1
+        note = json.loads(response.read().decode('utf-8'))
+        note = self.__add_simplenote_api_fields(note, note_id, int(response.info().get("X-Simperium-Version")))
+        if "tags" in note:
+            note["tags"] = sorted(note["tags"])
+        return note, 0
+
+    def set_deleted(self, note_id, deleted, version=None):
+        """ trash_note() / restore_note()
+
+        With the version (i.e. from the index or the local cache) the
+        change is sent straight away, one request. Without it, or if the
+        note had changed since (the change was merged into a newer
+        version), the note is read & updated if it still needs it.
+
+        """
+        if version is not None:
+            note, status = self.patch_note(note_id, {"deleted": deleted, "modificationDate": time.time()}, version)
+            if status == 0:
+                if note["version"] == int(version) + 1 and bool(note.get("deleted")) == deleted:
+                    return note, status
+                # Merged with changes we haven't seen, check it
+            elif getattr(note, 'code', None) not in (409, 412):
+                return note, status
+            # A 412 is ok, nothing changed (i.e. already trashed/restored), check it
+
         note, status = self.get_note(note_id)
         if (status == -1):
             return note, status
-        # set deleted property, but only if not already trashed
-        # TODO: A 412 is ok, that's unmodified. Should handle this in update_note and
-        # then not worry about checking here
-        if not note["deleted"]:
-            note["deleted"] = True
+        if bool(note["deleted"]) != deleted:
+            note["deleted"] = deleted
             note["modificationDate"] = time.time()
             # update note
             return self.update_note(note)
         else:
-            return 0, note
-    
-    def restore_note(self, note_id):
+            return note, 0
+
+    def trash_note(self, note_id, version=None):
+        """ Method to move a note to the trash
+
+        Arguments:
+            - note_id (string): key of the note to trash
+            - version (int): optional latest known version of the note, saves
+              reading the note first
+
+        Returns:
+            A tuple `(note, status)`
+
+            - note (dict): the newly created note or an error message
+            - status (int): 0 on success and -1 otherwise
+
+        """
+        return self.set_deleted(note_id, True, version)
+
+    def restore_note(self, note_id, version=None):
         """ Method to restore a note from the trash
 
         Nick B Added - Opposite of trash_note
 
         Arguments:
-            - note_id (string): key of the note to trash
+            - note_id (string): key of the note to restore
+            - version (int): optional latest known version of the note, saves
+              reading the note first
 
         Returns:
             A tuple `(note, status)`
@@ -347,23 +535,14 @@ class Simplenote(object):
             - status (int): 0 on success and -1 otherwise
 
         """
-        # get note
-        note, status = self.get_note(note_id)
-        if (status == -1):
-            return note, status
-        if note["deleted"]:
-            note["deleted"] = False
-            note["modificationDate"] = time.time()
-            # update note
-            return self.update_note(note)
-        else:
-            return 0, note
+        return self.set_deleted(note_id, False, version)
 
-    def delete_note(self, note_id):
+    def delete_note(self, note_id, version=None):
         """ Method to permanently delete a note
 
         Arguments:
             - note_id (string): key of the note to trash
+            - version (int): optional latest known version of the note (see trash_note)
 
         Returns:
             A tuple `(note, status)`
@@ -373,15 +552,15 @@ class Simplenote(object):
 
         """
         # notes have to be trashed before deletion
-        note, status = self.trash_note(note_id)
+        note, status = self.trash_note(note_id, version)
         if (status == -1):
             return note, status
 
         params = '/i/%s' % (str(note_id))
-        request = Request(url=DATA_URL+params, method='DELETE')
+        request = Request(url=self.data_url+params, method='DELETE')
         request.add_header(self.header, self.get_token())
         try:
-            response = urllib2.urlopen(request)
+            response = self.urlopen(request)
         except IOError as e:
             return e, -1
         except HTTPError as e:
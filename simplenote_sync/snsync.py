@@ -17,7 +17,7 @@
 
     # Logic
     1. Get list of notes from Simplenote (LOOP1)
-    2. Add new Simplenotes to local SN DB (cache) and create txt file (with meta DB).
+    2. Add new Simplenotes to local SN DB (cache) and create txt file (with meta DB), content comes from the index.
     3. Existing notes: Compare & update based on modifieddate (update contents & modifieddate)
     4. Deleted on SN (move local files to trash)
     5. Deleted locally (mark deleted/trashed on SN)
@@ -26,7 +26,6 @@
     --
     IDEAS:
         - Markdown - use Simplenote markdown tag to create .md files
-        - delta (fast) sync - use the last sync time to limit the processing (sn_last_sync)
         - check file permissions of config file
         - Merge (difflib) conflicts instead of creating files (maybe?)
         - garbage collection - empty trash folder (every x days?)
@@ -35,7 +34,6 @@
         - pylint
             - R0912 Too many branches / R0914 Too many local vars - Both: Line 82
             - R01101 Too many nested blocks (line 216)
-            - W0612 Unused Var (lastsync) - See ^ideas^ this is for delta/fast sync.
             - W0612 Unused Var (args) - RTFM: I'm sure I did this for a reason :-/
     --
 
@@ -48,15 +46,25 @@ import os
 import sys
 import re
 import getopt
+import atexit
+import signal
+import threading
 
-from .simplenote import Simplenote
+from .simplenote import Simplenote, custom_user_agent
+from .transport import Transport
+from .scheduler import Scheduler
 from .config import Config
-from .db import Database
-from .notes import Note
+from .db import Database, DatabaseError
+from .notes import Note, NoteError
+from .engine import SyncEngine, SyncError
+from .accounts import Account, AccountError, account_configs, check_accounts, sync_accounts
+from . import metrics
+from .watch import Watcher
 from .version import __version__
 
 
 start_time = time.monotonic() # Simple Performance Monitoring
+stopping = threading.Event() # multi-account mode, start no more accounts
 
 logger = logging.getLogger("snsync")
 logger.setLevel(logging.DEBUG)
@@ -78,17 +86,198 @@ Usage: snsync [OPTIONS]
 OPTIONS:
  -h, --help             Help!
  -d, --dry-run          Dry Run Mode (no changes made/saved)
+ -p, --plan             Dry Run, print the sync plan (JSON) instead of the output
  -s, --silent           Silent Mode (no std output)
  -D, --download-only    Don't push local changes back/up to Simplenote
+ -f, --fast             Fast Sync, only fetch Simplenotes changed since the last sync
+ -F, --full             Full Sync, ignore the last sync cursor (default unless cfg_sync_fast)
+ -w, --watch, --daemon  Keep running, sync local changes as they happen & poll Simplenote for changes
  -c, --config=          Config file to read (default: ~/.snsync)
+ -A, --accounts         Sync every account of the config file(s) ([snsync:name] sections), -c can be repeated
+ -S, --search=          Search the synced notes (full-text), prints the best matching filenames & keys
 
 Version: %s
 ''' % __version__)
     sys.exit(0)
 
+def interrupted(signum, frame):
+    """
+        SIGTERM handler, exit cleanly so the atexit handlers run
+    """
+    logger.warning("Interrupted by signal %s", signum)
+    stopping.set()
+    sys.exit(1)
+
+def report(result, silent_mode):
+    """
+        End of play report
+    """
+    counters = result.counters
+
+    logger.info('Changes: %s', result.changes)
+    if not silent_mode:
+        print('Changes: %s' % result.changes)
+
+    if counters['modified'] > 0:
+        logger.info('Modified: %s', counters['modified'])
+        if not silent_mode:
+            print('- Modified: %s' % counters['modified'])
+
+    if counters['added'] > 0:
+        logger.info('Added: %s', counters['added'])
+        if not silent_mode:
+            print('- Added: %s' % counters['added'])
+
+    if counters['deleted'] > 0:
+        logger.info('Deleted: %s', counters['deleted'])
+        if not silent_mode:
+            print('- Deleted: %s' % counters['deleted'])
+
+    if counters['http_errors'] > 0:
+        logger.info('HTTP ERRORS: %s', counters['http_errors'])
+        if not silent_mode:
+            print('HTTP ERRORS: %s' % counters['http_errors'])
+
+    if counters['throttled'] > 0:
+        logger.info('Throttled (retried) requests: %s', counters['throttled'])
+
+    logger.debug('Timings: %s', ', '.join('%s %.3fs' % timing for timing in result.timings.items()))
+
+    # http://stackoverflow.com/a/26099345
+    logger.info('Time Taken: %s', datetime.timedelta(seconds=result.timings['total']))
+    if not silent_mode:
+        print('Time Taken: %s' % datetime.timedelta(seconds=result.timings['total']))
+
+def run_sync(engine, fast_sync, sync_start, silent_mode, show_plan=False):
+    """
+        Run a sync & report (or print the plan), returns False if it failed
+    """
+    try:
+        result = engine.sync(fast_sync, sync_start)
+    except SyncError as e:
+        logger.critical("%s", e)
+        if not silent_mode:
+            print(e)
+        export_metrics(engine, e.result)
+        return False
+    except DatabaseError as e:
+        logger.critical("%s", e)
+        if not silent_mode:
+            print(e)
+        engine.db.discard() # the next sync (watch mode) plans from what was committed
+        return False
+
+    if show_plan and result.plan is not None:
+        print(result.plan.to_json())
+
+    report(result, silent_mode)
+    export_metrics(engine, result)
+    return True
+
+def export_metrics(engine, result):
+    """
+        Save the sync metrics (cfg_metrics_json / cfg_metrics_prom), failed syncs too
+    """
+    if result is None:
+        return
+    metrics.export(result, engine.config.get_config('cfg_metrics_json'), engine.config.get_config('cfg_metrics_prom'), logger=logger)
+
+def search(db, query):
+    """
+        Print the notes matching query (best first): filename & key, tab separated. Exits
+    """
+    if not db.fts:
+        logger.critical("Search not available, SQLite has no FTS5")
+        sys.exit(1)
+
+    search_start = time.monotonic()
+    results = db.search(query)
+    logger.debug('Search: %s results in %.1fms', len(results), (time.monotonic() - search_start) * 1000)
+
+    for result in results:
+        print('%s\t%s' % (result['filename'], result['key']))
+
+    db.disconnect()
+    sys.exit(0 if results else 1) # like grep
+
+def main_accounts(config_files, fast_sync, dry_run, download_only, silent_mode):
+    """
+        Multi-account mode: sync each account once, sharing connections & the API rate budget. Exits
+    """
+    if not config_files:
+        config_files = [os.path.join(os.path.expanduser('~'), '.snsync')]
+    for config_file in config_files:
+        if not os.path.isfile(config_file):
+            logger.critical("Config file not found: %s", config_file)
+            if not silent_mode:
+                print('Config file not found: %s' % config_file)
+            sys.exit(1)
+
+    chandler.setLevel(logging.WARNING) # each account logs to its own cfg_log_path
+    config = Config(config_files[0]) # [snsync], the shared settings
+
+    try:
+        configs = account_configs(config_files)
+        check_accounts(configs)
+        parallel = int(config.get_config('cfg_sync_accounts'))
+    except AccountError as e:
+        logger.critical("%s", e)
+        if not silent_mode:
+            print(e)
+        sys.exit(1)
+    except ValueError:
+        logger.critical("Invalid cfg_sync_accounts")
+        if not silent_mode:
+            print('Invalid cfg_sync_accounts')
+        sys.exit(1)
+
+    # One pool of keep-alive connections & one rate budget for all the accounts
+    try:
+        transport = Transport(pool_size=config.get_config('cfg_http_pool_size'),
+                              timeout=config.get_config('cfg_http_timeout'),
+                              user_agent=custom_user_agent)
+        scheduler = Scheduler(rate=config.get_config('cfg_api_rate'),
+                              concurrency=config.get_config('cfg_sync_workers'),
+                              retries=config.get_config('cfg_api_retries'),
+                              logger=logger)
+    except ValueError:
+        logger.critical("Invalid cfg_http_pool_size, cfg_http_timeout, cfg_api_rate, cfg_api_retries or cfg_sync_workers")
+        if not silent_mode:
+            print('Invalid cfg_http_pool_size, cfg_http_timeout, cfg_api_rate, cfg_api_retries or cfg_sync_workers')
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, interrupted)
+
+    account_list = [Account(name, account_config) for name, account_config in configs]
+    if not silent_mode:
+        print('Syncing %s accounts, %s at a time' % (len(account_list), parallel))
+
+    done = sync_accounts(account_list, transport, scheduler, parallel, stopping,
+                         fast_sync=fast_sync, dry_run=dry_run, download_only=download_only)
+    transport.close()
+
+    failed = 0
+    for account in account_list:
+        if account not in done:
+            failed += 1
+            logger.warning('%s: not synced', account.name)
+            line = '%s: not synced' % account.name
+        elif account.error is not None:
+            failed += 1
+            logger.error('%s: %s', account.name, account.error)
+            line = '%s: %s' % (account.name, account.error)
+        else:
+            line = '%s: Changes: %s Time Taken: %s' % (account.name, account.result.changes, datetime.timedelta(seconds=account.result.timings['total']))
+        if not silent_mode:
+            print(line)
+
+    if not silent_mode:
+        print('Time Taken: %s' % datetime.timedelta(seconds=time.monotonic() - start_time))
+    sys.exit(1 if failed else 0)
+
 def main(argv=sys.argv[1:]):
     """
-        Main body, system argements, 2 loops.
+        Main body, system argements, logging & the sync engine.
     """
 
     # Default Vars
@@ -96,12 +285,18 @@ def main(argv=sys.argv[1:]):
     silent_mode = False
     config_file = None
     download_only = False
+    fast_sync = None # None = use config file setting
+    watch_mode = False
+    show_plan = False
+    search_query = None
+    config_files = [] # -c can be repeated for --accounts
+    accounts_mode = False
 
     # CMD Line options
     try:
         opts, args = getopt.getopt(argv,
-                                   'hdsDc:',
-                                   ['help', 'dry-run', 'silent', 'download-only', 'config='])
+                                   'hdpsDfFwc:S:A',
+                                   ['help', 'dry-run', 'plan', 'silent', 'download-only', 'fast', 'full', 'watch', 'daemon', 'config=', 'search=', 'accounts'])
     except Exception:
         logger.debug("Exception: %s", sys.exc_info()[1])
         usage()
@@ -111,19 +306,44 @@ def main(argv=sys.argv[1:]):
             usage()
         elif opt in ['-d', '--dry-run']:
             dry_run = True
+        elif opt in ['-p', '--plan']:
+            dry_run = True
+            show_plan = True
+            silent_mode = True # stdout is the plan
         elif opt in ['-s', '--silent']:
             silent_mode = True
         elif opt in ['-D', '--download-only']:
             download_only = True
+        elif opt in ['-f', '--fast']:
+            fast_sync = True
+        elif opt in ['-F', '--full']:
+            fast_sync = False
+        elif opt in ['-w', '--watch', '--daemon']:
+            watch_mode = True
         elif opt in ['-c', '--config']:
             config_file = arg
+            config_files.append(arg)
+        elif opt in ['-S', '--search']:
+            search_query = arg
+            silent_mode = True # stdout is the results
+        elif opt in ['-A', '--accounts']:
+            accounts_mode = True
         else:
             print('ERROR: Unhandled option')
             usage()
 
+    if accounts_mode:
+        if watch_mode or show_plan or search_query is not None:
+            print('ERROR: --accounts can\'t be used with --watch, --plan or --search')
+            sys.exit(1)
+        main_accounts(config_files, fast_sync, dry_run, download_only, silent_mode)
+
     config = Config(config_file) # Config Setup
 
-    note = Note(config, logger) # Local Notes Setup (folders)
+    try:
+        note = Note(config, logger) # Local Notes Setup (folders)
+    except NoteError:
+        sys.exit(1)
 
     log_file = config.get_config('cfg_log_path')
     log_level = config.get_config('cfg_log_level')
@@ -157,15 +377,25 @@ def main(argv=sys.argv[1:]):
                 print('Config file not found: %s' % config_file)
             sys.exit(1)
 
-    db = Database(config, logger) # DB setup
+    try:
+        db = Database(config, logger) # DB setup
+    except DatabaseError:
+        sys.exit(1)
+
+    if search_query is not None: # No sync, just look it up
+        search(db, search_query)
+
+    db.load_snapshot() # Note look-ups run against in memory copies of the tables
+
+    # DB writes are batched, save the finished work if we're interrupted (Ctrl-C / docker stop)
+    atexit.register(db.disconnect)
+    signal.signal(signal.SIGTERM, interrupted)
 
     # System Vars
-    filetime = datetime.datetime.now().strftime("%y%m%d-%H%M%S") # timestamp for files
     the_os = sys.platform
 
     # Uer config vars (DO NOT CHANGE THESE)
     path = config.get_config('cfg_nt_path')
-    trash_path = config.get_config('cfg_nt_trashpath')
     file_ext = config.get_config('cfg_nt_ext')
     sn_username = config.get_config('sn_username')
     sn_password = config.get_config('sn_password')
@@ -177,8 +407,30 @@ def main(argv=sys.argv[1:]):
             print('Simplenote Username/Password not set, probably no ~/.snsync config file.')
         sys.exit(1)
 
-    # Main simplenote object
-    simplenote = Simplenote(sn_username, sn_password)
+    # Main simplenote object, API requests share a pool of keep-alive connections
+    try:
+        transport = Transport(pool_size=config.get_config('cfg_http_pool_size'),
+                              timeout=config.get_config('cfg_http_timeout'),
+                              user_agent=custom_user_agent)
+    except ValueError:
+        logger.critical("Invalid cfg_http_pool_size or cfg_http_timeout")
+        if not silent_mode:
+            print('Invalid cfg_http_pool_size or cfg_http_timeout')
+        sys.exit(1)
+
+    # Requests are rate limited & throttled requests retried, concurrency drops when the API pushes back
+    try:
+        scheduler = Scheduler(rate=config.get_config('cfg_api_rate'),
+                              concurrency=config.get_config('cfg_sync_workers'),
+                              retries=config.get_config('cfg_api_retries'),
+                              logger=logger)
+    except ValueError:
+        logger.critical("Invalid cfg_api_rate, cfg_api_retries or cfg_sync_workers")
+        if not silent_mode:
+            print('Invalid cfg_api_rate, cfg_api_retries or cfg_sync_workers')
+        sys.exit(1)
+
+    simplenote = Simplenote(sn_username, sn_password, transport, scheduler, api_url=config.get_config('cfg_api_url'))
 
     if re.match('linux', the_os):
         logger.debug('OS: Linux')
@@ -190,344 +442,50 @@ def main(argv=sys.argv[1:]):
     if dry_run:
         logger.warning('DRY RUN Mode')
 
-    try:
-        notes = simplenote.get_note_list() # the mac daddy important bit!
-    except Exception:
-        logger.debug("Exception: %s", sys.exc_info()[1])
-        logger.critical("Simplenote Login Failed")
-        if not silent_mode:
-            print('Simplenote Login Failed')
-        sys.exit(1)
-
-    logger.debug('API Result: %s', notes)
+    if fast_sync is None:
+        fast_sync = config.get_config_bool('cfg_sync_fast')
 
-    if notes[1] == 0:  # success
-        notes = notes[0]
-    else:
-        logger.error('Simplenote LIST Request FAILED')
-        sys.exit()
-
-    # Counters!
-    counter_changes = 0
-    counter_modified = 0
-    counter_added = 0
-    counter_deleted = 0
-    counter_http_errors = 0
-
-    if download_only:
-        logger.info('Download Only Mode')
-        if not silent_mode:
-            print('Download Only Mode')
-
-    if not silent_mode:
-        print("Scanning %s Simplenotes" % len(notes))
+    engine = SyncEngine(config, db, note, simplenote, logger, dry_run=dry_run, download_only=download_only, silent=silent_mode)
 
-        # Progress bar
-        sys.stdout.write("[%s]" % (" " * len(notes)))
-        sys.stdout.flush()
-        sys.stdout.write("\b" * (len(notes)+1)) # return to start of line, after '['
-
-    # Loop 1
-    for n in notes:
-
-        db.commit() # Commit the last note
-
-        if not silent_mode:
-            time.sleep(0.05) # print doesn't work if too fast
-            sys.stdout.write("#")
-            sys.stdout.flush()
-
-        thisnote = db.find_sn_by_key(n['key'])
-
-        if thisnote:
-            # Existig Simple Note
-            thisfile = db.find_nf_by_key(n['key']) # Note File Meta
-            sn_modify = False # Set default status for simplenote
-            nf_modify = False # Set default status for notefile
-
-            if thisfile and n['deleted'] == 0: # Modified S-Notes
-                if os.path.isfile(path + "/" + thisfile['filename']):
-                    file_modifydate = os.path.getmtime(path + "/" + thisfile['filename'])
-
-                    sn_modifyseconds = str(n['modifydate']).split(".")[0] # Simple Note Modify Time
-                    logger.debug('SN Modified: %s [%s]', sn_modifyseconds, time.ctime(int(sn_modifyseconds)))
-
-                    sncache_modifyseconds = str(thisnote['modifydate']).split(".")[0] # Last known Simple Note Time
-                    logger.debug('SN (cached) Modified: %s [%s]', sncache_modifyseconds, time.ctime(int(sncache_modifyseconds)))
-
-                    nf_modifyseconds = str(file_modifydate).split(".")[0] # Note File modify Time
-                    logger.debug('NF Modified: %s [%s]', nf_modifyseconds, time.ctime(int(nf_modifyseconds)))
-
-                    if int(sn_modifyseconds) > int(sncache_modifyseconds):
-                        sn_modify = True
-                        logger.debug('SN %s is newer than NF %s', n['key'], thisfile['filename'])
-
-                    if int(nf_modifyseconds) > int(sn_modifyseconds):
-                        nf_modify = True
-                        logger.debug('NF %s is newer than SN %s', thisfile['filename'], n['key'])
-
-                    if nf_modify and sn_modify:
-                        logger.error('DUP! Modified Date Clash %s', thisfile['filename'])
-
-                        old_fqdn = path + "/" + thisfile['filename']
-                        new_fqdn = path + "/DUP_" + filetime + "_" + thisfile['filename']
-                        logger.info('Duplicate File Created %s', new_fqdn)
-
-                        nf_modify = False # Reset this, gonna move the old file
-
-                        logger.debug("DUP | Old: %s New: %s", old_fqdn, new_fqdn)
-                        if not dry_run:
-                            try:
-                                os.rename(old_fqdn, new_fqdn)
-                            except Exception:
-                                logger.error("Failed to move file  %s -> %s", old_fqdn, new_fqdn)
-                                logger.debug("Exception: %s", sys.exc_info()[1])
-
-                    if not nf_modify and not sn_modify:
-                        logger.debug('No changes required for %s [%s]', thisfile['filename'], n['key'])
-
-                    if sn_modify:
-                        logger.info('[SN] > [NF] | %s -> %s', n['key'], thisfile['filename'])
-                        nf_filename = thisfile['filename']
-
-                    if nf_modify:
-                        logger.info('[SN] < [NF] | %s <- %s', n['key'], thisfile['filename'])
-                        nf_filename = thisfile['filename']
-
-                else:
-                    logger.critical("Local File [%s] DELETED but not marked for deletion locally, assuming delete SN -> [%s]", thisfile['filename'], n['key'])
-                    counter_deleted += 1
-
-                    if not dry_run and not download_only:
-                        trash_note = simplenote.trash_note(n['key'])
-                        logger.debug('API Result: %s', trash_note)
-
-                        if trash_note[1] == 0:
-                            db.sn(trash_note[0])
-                            db.del_nf(n['key'])
-                            logger.info('SN Deleted [%s]', n['key'])
-                        else:
-                            logger.error('Simplenote DELETE Request Failed [%s]', n['key'])
-                            counter_http_errors += 1
-                            counter_deleted -= 1 # giveth and taketh away!
-
-            elif thisfile and n['deleted'] == 1: #  Seen and Deleted SN
-                if os.path.isfile(path + "/" + thisfile['filename']):
-                    logger.info('Deleting File: %s', thisfile['filename'])
-                    counter_deleted += 1
-
-                    if not dry_run:
-                        del thisfile['deleted'] # Remove old deleted meta
-                        thisfile['deleted'] = 1
-                        db.del_nf(n['key']) # delete nofile meta (forget the file)
-                        db.sn(n) # update simplenote cache
-
-                        old_fqdn = path + "/" + thisfile['filename']
-                        new_fqdn = path + "/" + trash_path + "/" + filetime + "_" + thisfile['filename']
-
-                        try:
-                            os.rename(old_fqdn, new_fqdn)
-                            logger.debug("TRASH | Old: %s New: %s", old_fqdn, new_fqdn)
-                        except Exception:
-                            logger.error("Failed to move file  %s -> %s", old_fqdn, new_fqdn)
-                            logger.debug("Exception: %s", sys.exc_info()[1])
-
-            else: # No file meta
-                if n['deleted'] == 0: # Exists in Simple note, but no meta
-                    logger.critical("File Meta AWOL - %s", n['key'])
-                    sn_modify = True # Generate new local file
-                else: # No Meta and Deleted in Simple Note
-                    logger.debug("No file meta for deleted file simplenote, probably never written to disk")
-
-            if sn_modify: # Simplenote has been modified!
-                counter_modified += 1
-                if not dry_run:
-                    thisnote_full = simplenote.get_note(n['key']) # Get the latest note
-                    logger.debug('API Result: %s', thisnote_full)
-
-                    if thisnote_full[1] == 0:
-                        try:
-                            nf_filename
-                        except Exception: # Catch critial AWOL Files
-                            nf_filename = note.get_filename(thisnote_full[0]['content'])
-
-                        # Generate new notefile meta
-                        nf_meta = {}
-                        nf_meta['filename'] = nf_filename
-                        nf_meta['key'] = n['key']
-                        nf_meta['createdate'] = n['createdate']
-                        nf_meta['modifydate'] = n['modifydate']
-                        nf_meta['deleted'] = n['deleted']
-
-                        db.sn(n) # Update simplenote Cache
-
-                        if nf_filename: 
-                            db.nf(nf_meta) # Update notefile meta
-                            thisnote_file = note.update(thisnote_full[0], nf_meta) # Write to file
-                        else:
-                            counter_modified -= 1
-                    else:
-                        logger.error('Simplenote DOWNLOAD Request FAILED [%s]', n['key'])
-                        counter_http_errors += 1
-                        counter_modified -= 1 # so far yet so close ;)
-
-            if nf_modify: # Local note has been modified!
-                counter_modified += 1
-                if not dry_run:
-                    notefile_full = note.open(nf_filename)
-
-                    nf = {}
-                    nf['key'] = n['key']
-                    nf['content'] = notefile_full['content']
-                    nf['modifydate'] = notefile_full['modifydate']
-                    nf['version'] = n['version']
-                    nf['tags'] = n['tags']
-                    nf['systemTags'] = n['systemTags']
-
-                    note_update = simplenote.update_note(nf)
-                    logger.debug('API Result: %s', note_update)
-
-                    if note_update[1] == 0:
-                        nf_meta = {} # update meta
-                        nf_meta['filename'] = nf_filename
-                        nf_meta['key'] = note_update[0]['key']
-                        nf_meta['createdate'] = note_update[0]['createdate']
-                        nf_meta['modifydate'] = note_update[0]['modifydate']
-                        nf_meta['deleted'] = note_update[0]['deleted']
-
-                        db.sn(note_update[0])
-                        db.nf(nf_meta)
-
-                        logger.info('SN Updated [%s] from %s', n['key'], nf_filename)
-                    else:
-                        logger.error('Simplenote UPDATE Request FAILED [%s] <- %s', n['key'], nf_filename)
-                        counter_http_errors += 1
-                        counter_modified -= 1
-
-
-        else:
-            # New Note Added/Found in Simplenote
-            logger.info('Adding SN NOTE: %s to Local DB', n['key'])
-            counter_added += 1
-
-            if dry_run:
-                thisnote = False
-            else:
-                thisnote = db.sn(n)
-
-            if thisnote:
-                if n['deleted'] == 0: # Don't save deleted notes!
-                    thisnote_full = simplenote.get_note(n['key'])
-                    logger.debug('API Result: %s', thisnote_full)
-
-                    if thisnote_full[1] == 0:  # success
-                        thisnote_file = note.new(thisnote_full[0])
-
-                        if thisnote_file:
-                            nf_meta = {}
-                            nf_meta['filename'] = thisnote_file
-                            nf_meta['key'] = n['key']
-                            nf_meta['createdate'] = n['createdate']
-                            nf_meta['modifydate'] = n['modifydate']
-                            nf_meta['deleted'] = n['deleted']
-                            db.nf(nf_meta)
-                        else:
-                            logger.error("Failed to write note: %s", n['key'])
-
-                    else:
-                        logger.error('Simplenote DOWNLOAD Request FAILED [%s]', n['key'])
-                        counter_http_errors += 1
-                        counter_added -= 1
-
-            else:
-                if not dry_run:
-                    logger.error('Failed to updated DB with %s', n['key'])
-
-    if not silent_mode:
-        sys.stdout.write("\n") # New Line for end of progress bar
-
-    # Loop 2
-    if not download_only:
-        if not silent_mode:
-            print("Scanning %s local files" % len(os.listdir(path)))
-            # Progress bar
-            sys.stdout.write("[%s]" % (" " * len(os.listdir(path))))
-            sys.stdout.flush()
-            sys.stdout.write("\b" * (len(os.listdir(path))+1)) # return to start of line, after '['
+    watcher = None
+    if watch_mode:
+        watcher = Watcher(path, file_ext, logger, folders=note.folders())
 
-        for notefile in os.listdir(path): # local search for new files
+    ok = run_sync(engine, fast_sync, start_time, silent_mode, show_plan)
 
+    if watch_mode:
+        try:
+            watch_interval = float(config.get_config('cfg_watch_interval'))
+        except ValueError:
+            logger.critical("Invalid cfg_watch_interval")
             if not silent_mode:
-                if not silent_mode:
-                    time.sleep(0.05) # print doesn't work if too fast
-                    sys.stdout.write("#")
-                    sys.stdout.flush()
-
-            if notefile.endswith(file_ext): # only work with .txt file (or whatever!)
-                logger.debug('Checking NF: %s', notefile)
-
-                nf_meta = db.find_nf_by_name(notefile) # Note File Meta
-
-                if not nf_meta: # If there's no meta, this must be a new file
-                    logger.info('NEW notefile for upload: %s', notefile)
-                    counter_added += 1
-
-                    if not dry_run:
-                        nf_meta = note.gen_meta(notefile)
-                        nf_detail = note.open(notefile)
-
-                        new_sn_object = {}
-                        new_sn_object['key'] = nf_meta['key']
-                        new_sn_object['createdate'] = nf_meta['createdate']
-                        new_sn_object['modifydate'] = nf_meta['modifydate']
-                        new_sn_object['content'] = nf_detail['content']
-
-                        new_sn = simplenote.add_note(new_sn_object) # Add the note!
-                        logger.debug('API Result: %s', new_sn)
-
-                        if new_sn[1] == 0:
-                            logger.debug('New Simplenote Created: %s', new_sn)
-                            db.sn(new_sn[0]) # Update simplenote Cache
-                            db.nf(nf_meta) # Update notefile meta
-                        else:
-                            logger.error('Simplenote ADD Request FAILED [%s]', new_sn)
-                            counter_http_errors += 1
-                            counter_added -= 1
-
-        if not silent_mode:
-            sys.stdout.write("\n") # New Line for end of progress bar
-
-        if not dry_run:
-            lastsync = db.update_snsync("sn_last_sync", time.time()) # record last sync
-        db.disconnect() # Saves the sqlite db.
-
-    # end of play report
-    counter_changes = counter_modified + counter_added + counter_deleted
-    logger.info('Changes: %s', counter_changes)
-    if not silent_mode:
-        print('Changes: %s' % counter_changes)
-
-    if counter_modified > 0:
-        logger.info('Modified: %s', counter_modified)
-        if not silent_mode:
-            print('- Modified: %s' % counter_modified)
+                print('Invalid cfg_watch_interval')
+            sys.exit(1)
 
-    if counter_added > 0:
-        logger.info('Added: %s', counter_added)
+        logger.info('Watch Mode: checking Simplenote every %ss', watch_interval)
         if not silent_mode:
-            print('- Added: %s' % counter_added)
+            print('Watching %s for changes, Ctrl-C to stop' % path)
+
+        next_poll = time.monotonic() + watch_interval
+        try:
+            while True:
+                changed = watcher.wait(max(0, next_poll - time.monotonic()))
+                if changed:
+                    if not engine.local_changes(changed):
+                        logger.debug('No local changes: %s', changed)
+                        continue
+                    logger.info('Local changes: %s', ', '.join(sorted(changed)))
+
+                ok = run_sync(engine, True, time.monotonic(), silent_mode, show_plan) # Simplenote changes since the last sync
+                next_poll = time.monotonic() + watch_interval
+        except KeyboardInterrupt:
+            logger.info('Watch Mode: stopped')
+            if not silent_mode:
+                print('Stopped watching %s' % path)
+        watcher.close()
 
-    if counter_deleted > 0:
-        logger.info('Deleted: %s', counter_deleted)
-        if not silent_mode:
-            print('- Deleted: %s' % counter_deleted)
+    transport.close()
+    db.disconnect() # Saves the sqlite db.
 
-    if counter_http_errors > 0:
-        logger.info('HTTP ERRORS: %s', counter_http_errors)
-        if not silent_mode:
-            print('HTTP ERRORS: %s' % counter_http_errors)
-
-    end_time = time.monotonic() # http://stackoverflow.com/a/26099345
-    logger.info('Time Taken: %s', datetime.timedelta(seconds=end_time - start_time))
-    if not silent_mode:
-        print('Time Taken: %s' % datetime.timedelta(seconds=end_time - start_time))
+    if not ok:
+        sys.exit(1)
@@ -0,0 +1,200 @@
+"""
+    HTTP transport for snsync - keep-alive connection pool with gzip
+"""
+# pylint: disable=W0718
+# pylint: disable=C0301
+
+import io
+import gzip
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS') # no side effects, can always be sent again
+
+
+def resendable(method, error, sent):
+    """
+        Can a request that failed on a reused (idle keep-alive) connection be sent again on a fresh one?
+
+        Only if it can't have been acted on: it never went out (the server
+        had already closed the connection), the server closed the connection
+        without a response, or the method is safe. A note update (POST) that
+        may have been applied is not sent twice.
+    """
+    if method in SAFE_METHODS or not sent:
+        return True
+    return isinstance(error, http.client.RemoteDisconnected)
+
+
+class Response:
+    """
+        Response object, enough of urllib's response for simplenote.py
+    """
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        """
+            Response body (already decompressed)
+        """
+        return self.body
+
+    def info(self):
+        """
+            Response headers
+        """
+        return self.headers
+
+    def getcode(self):
+        """
+            HTTP Status code
+        """
+        return self.status
+
+
+class Transport:
+    """
+        Pool of keep-alive HTTP(S) connections, one pool per host
+
+        Drop in replacement for urllib's urlopen(request): the same
+        HTTPError / URLError (IOError) exceptions are raised so callers
+        don't need to change their error handling, a read timeout is a
+        TimeoutError (also an IOError) as with urllib.
+    """
+
+    def __init__(self, pool_size=4, timeout=60, user_agent=None):
+        """
+            pool_size is the number of idle connections kept per host,
+            timeout (seconds) applies to connecting and each socket read.
+        """
+        self.pool_size = max(1, int(pool_size))
+        self.timeout = float(timeout)
+        self.user_agent = user_agent
+        self.lock = threading.Lock()
+        self.idle = {} # (scheme, host, port) -> [connection, ...]
+        self.requests = 0 # requests sent, for progress/stats
+        self.reconnects = 0 # requests resent on a fresh connection, for stats
+        self.proxies = urllib.request.getproxies()
+
+    def get_connection(self, origin):
+        """
+            Re-use an idle connection or open a new one, returns (conn, reused)
+        """
+        with self.lock:
+            conns = self.idle.get(origin)
+            if conns:
+                return conns.pop(), True
+
+        scheme, host, port = origin
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def put_connection(self, origin, conn):
+        """
+            Return a connection to the pool (or close it if the pool is full)
+        """
+        with self.lock:
+            conns = self.idle.setdefault(origin, [])
+            if len(conns) < self.pool_size:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def get_request_count(self):
+        """
+            Number of requests sent so far
+        """
+        return self.requests
+
+    def get_reconnect_count(self):
+        """
+            Number of requests resent because an idle connection had been closed
+        """
+        return self.reconnects
+
+    def close(self):
+        """
+            Close all idle connections
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def urlopen(self, request, retried=None):
+        """
+            Send a urllib Request, returns a Response (retried('reconnect') is called if it's resent on a fresh connection)
+        """
+        url = urllib.parse.urlsplit(request.full_url)
+
+        with self.lock:
+            self.requests += 1
+
+        if url.scheme in self.proxies and not urllib.request.proxy_bypass(url.hostname):
+            # Proxies are urllib's job, no pooling
+            return urllib.request.urlopen(request, timeout=self.timeout)
+
+        origin = (url.scheme, url.hostname, url.port)
+        path = url.path
+        if url.query:
+            path += '?' + url.query
+
+        headers = dict(request.header_items())
+        if self.user_agent is not None:
+            headers.setdefault('User-agent', self.user_agent)
+        headers['Accept-encoding'] = 'gzip'
+        if request.data is not None:
+            headers.setdefault('Content-type', 'application/x-www-form-urlencoded') # same as urllib
+
+        method = request.get_method()
+        for attempt in (1, 2):
+            conn, reused = self.get_connection(origin)
+            sent = False
+            try:
+                conn.request(method, path, body=request.data, headers=headers)
+                sent = True
+                resp = conn.getresponse()
+                body = resp.read()
+            except TimeoutError:
+                conn.close()
+                raise # the server may still act on it, never resent
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if reused and attempt == 1 and resendable(method, e, sent):
+                    with self.lock:
+                        self.reconnects += 1
+                    if retried is not None:
+                        retried('reconnect')
+                    continue # the server closed an idle keep-alive connection, try a fresh one
+                raise urllib.error.URLError(e)
+            break
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self.put_connection(origin, conn)
+
+        if resp.getheader('Content-Encoding', '').lower() == 'gzip':
+            try:
+                body = gzip.decompress(body)
+            except (OSError, EOFError) as e:
+                raise urllib.error.URLError(e)
+
+        if resp.status >= 400:
+            raise urllib.error.HTTPError(request.full_url, resp.status, resp.reason, resp.headers, io.BytesIO(body))
+
+        return Response(request.full_url, resp.status, resp.reason, resp.headers, body)
@@ -0,0 +1,190 @@
+"""
+    Note folder watcher for snsync (--watch), inotify on Linux otherwise polling
+"""
+# pylint: disable=W0718
+# pylint: disable=C0301
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+
+class Watcher:
+    """
+        Waits for note files to change
+
+        inotify (via ctypes, no extra modules) is used when the OS has it,
+        otherwise the folder is scanned every poll seconds.
+    """
+
+    def __init__(self, path, file_ext, logger, settle=0.5, poll=2.0, folders=('',)):
+        """
+            Files changing within settle seconds of each other are one change
+            (editors often write more than once). folders are under path
+            ('' is path itself, i.e. the tag folders of cfg_sync_tags).
+        """
+        self.path = path
+        self.folders = tuple(folders)
+        self.watches = {} # inotify: wd -> folder
+        self.file_ext = file_ext
+        self.log = logger
+        self.settle = settle
+        self.poll = poll
+        self.fd = None
+        self.files = None # polling: filename -> stat
+
+        if sys.platform.startswith('linux'):
+            self.fd = self.inotify_init()
+
+        if self.fd is None:
+            self.log.info("Watching %s (polling every %ss)", self.path, self.poll)
+            self.files = self.scan()
+        else:
+            self.log.info("Watching %s (inotify)", self.path)
+
+    def inotify_init(self):
+        """
+            inotify file descriptor watching the note folder(s), None if inotify isn't available
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            for folder in self.folders:
+                wd = libc.inotify_add_watch(fd, os.fsencode(os.path.join(self.path, folder)), WATCH_MASK)
+                if wd < 0:
+                    os.close(fd)
+                    raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+                self.watches[wd] = folder
+            return fd
+        except (OSError, AttributeError):
+            self.log.warning("inotify not available, falling back to polling")
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            return None
+
+    def scan(self):
+        """
+            Polling: note files & their stats
+        """
+        files = {}
+        for folder in self.folders:
+            try:
+                with os.scandir(os.path.join(self.path, folder)) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(self.file_ext) and entry.is_file():
+                            fstat = entry.stat()
+                            files[os.path.join(folder, entry.name)] = (fstat.st_ino, fstat.st_size, fstat.st_mtime_ns)
+            except OSError:
+                self.log.debug("Exception: %s", sys.exc_info()[1])
+        return files
+
+    def read_events(self, timeout):
+        """
+            inotify: names of the note files changed, waits up to timeout seconds for the first event (None if there were none)
+        """
+        changed = set()
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except InterruptedError:
+            return None
+        if not ready:
+            return None
+
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    changed.add('') # lost events, something changed
+                elif name.endswith(self.file_ext):
+                    changed.add(os.path.join(self.watches.get(wd, ''), name))
+
+        return changed
+
+    def poll_changes(self, timeout):
+        """
+            Polling: names of the note files changed, checks every poll seconds for up to timeout seconds
+        """
+        changed = set()
+        deadline = time.monotonic() + timeout
+
+        while not changed:
+            files = self.scan()
+            changed = set(name for name in set(files) | set(self.files) if files.get(name) != self.files.get(name))
+            self.files = files
+
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                break
+            time.sleep(min(self.poll, remaining))
+
+        return changed
+
+    def wait(self, timeout):
+        """
+            Wait up to timeout seconds for note files to change, returns the changed filenames (empty set if none)
+        """
+        if self.fd is None:
+            changed = self.poll_changes(timeout)
+            while changed: # let the writes settle
+                time.sleep(self.settle)
+                more = self.poll_changes(0)
+                if not more:
+                    break
+                changed |= more
+            return changed
+
+        changed = set()
+        deadline = time.monotonic() + timeout
+        while not changed: # events for other files don't count
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return changed
+            changed = self.read_events(remaining) or set()
+
+        while True: # let the writes settle
+            more = self.read_events(self.settle)
+            if more is None:
+                break
+            changed |= more
+        return changed
+
+    def close(self):
+        """
+            Stop watching
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,83 @@
+"""
+    Worker pool for snsync, runs Simplenote API requests concurrently
+"""
+# pylint: disable=W0718
+# pylint: disable=C0301
+
+import sys
+import collections
+import concurrent.futures
+
+
+class WorkerPool:
+    """
+        Bounded pool of threads for Simplenote API requests
+
+        Only the request itself runs on a worker thread, the callback (DB &
+        file updates) always runs on the calling thread in submission order,
+        so SQLite and the note files are only ever touched by one thread.
+    """
+
+    def __init__(self, workers, logger):
+        """
+            Pool setup, 1 worker means no threads (requests run inline)
+        """
+        self.log = logger
+
+        try:
+            self.workers = max(1, int(workers))
+        except ValueError:
+            self.log.warning("Invalid number of sync workers: %s, using 1", workers)
+            self.workers = 1
+
+        self.pending = collections.deque()
+        self.executor = None
+        if self.workers > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='snsync')
+        self.log.debug("Sync workers: %s", self.workers)
+
+    def call(self, request, args):
+        """
+            Run a request, exceptions become an API style (error, -1) result
+        """
+        try:
+            return request(*args)
+        except Exception as e:
+            self.log.debug("Exception: %s", sys.exc_info()[1])
+            return e, -1
+
+    def submit(self, request, args, callback):
+        """
+            Queue request(*args), callback(result) runs once it completes
+        """
+        if self.executor is None:
+            callback(self.call(request, args))
+            return
+
+        self.pending.append((self.executor.submit(self.call, request, args), callback))
+
+        # Bound the backlog, don't queue up the whole note list
+        while len(self.pending) > self.workers * 2:
+            self.complete()
+
+    def complete(self):
+        """
+            Wait for the oldest request and run its callback
+        """
+        future, callback = self.pending.popleft()
+        callback(future.result())
+
+    def drain(self):
+        """
+            Wait for all queued requests (and callbacks) to complete
+        """
+        while self.pending:
+            self.complete()
+
+    def shutdown(self):
+        """
+            Drain the queue and stop the worker threads
+        """
+        self.drain()
+        if self.executor is not None:
+            self.executor.shutdown()
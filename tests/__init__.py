@@ -0,0 +1,3 @@
+"""
+    snsync tests, run with: python -m pytest (or python -m unittest discover tests)
+"""
@@ -0,0 +1,61 @@
+"""
+    Test helpers: a config file & note folder in a temporary directory
+"""
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from unittest import mock
+
+from simplenote_sync.config import Config
+
+
+logger = logging.getLogger('snsync.tests')
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+class TempConfigTestCase(unittest.TestCase):
+    """
+        setUp() makes self.folder with notes/ & a config file (self.config_file), sn_* environment variables are ignored
+    """
+
+    settings = {} # extra cfg_ settings for the config file
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='snsync-test-')
+        self.addCleanup(shutil.rmtree, self.folder, True)
+
+        environ = mock.patch.dict(os.environ, clear=False)
+        environ.start()
+        self.addCleanup(environ.stop)
+        for name in list(os.environ):
+            if name.startswith('sn_'):
+                del os.environ[name]
+
+        self.path = os.path.join(self.folder, 'notes')
+        os.mkdir(self.path)
+        self.config_file = self.write_config()
+
+    def write_config(self, **settings):
+        """
+            (Re)write the config file, returns its path
+        """
+        values = {'cfg_sn_username': 'test@example.com', 'cfg_sn_password': 'test',
+                  'cfg_nt_path': self.path, 'cfg_db_path': os.path.join(self.folder, 'snsync.sqlite'),
+                  'cfg_log_path': 'DISABLED'}
+        values.update(self.settings)
+        values.update(settings)
+        config_file = os.path.join(self.folder, 'snsync.ini')
+        with open(config_file, 'w', encoding='utf-8') as f:
+            f.write('[snsync]\n')
+            for name, value in values.items():
+                f.write('%s = %s\n' % (name, value))
+        return config_file
+
+    def config(self):
+        """
+            Config of the config file
+        """
+        return Config(self.config_file)
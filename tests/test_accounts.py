@@ -0,0 +1,187 @@
+"""
+    Multi-account tests: account configs, their checks & syncing them against a local MockSimperium
+"""
+import os
+import threading
+from unittest import mock
+
+from simplenote_sync.accounts import Account, AccountError, account_configs, check_accounts, sync_accounts
+from simplenote_sync.config import Config
+from simplenote_sync.transport import Transport
+from simplenote_sync.scheduler import Scheduler
+from simplenote_sync.mockserver import MockSimperium
+
+from .support import TempConfigTestCase, logger
+
+
+class AccountsTestCase(TempConfigTestCase):
+    """
+        Multi-account config files, one notes folder, database & log for each account
+    """
+
+    def write_accounts(self, accounts, filename='accounts.ini', **shared):
+        """
+            Config file with shared [snsync] settings & a [snsync:name] section (dict of settings) for each account, returns its path
+        """
+        values = {'cfg_sn_username': 'test@example.com', 'cfg_sn_password': 'test',
+                  'cfg_nt_path': os.path.join(self.folder, '%(account)s'),
+                  'cfg_db_path': os.path.join(self.folder, '%(account)s.sqlite'),
+                  'cfg_log_path': os.path.join(self.folder, '%(account)s.log')}
+        values.update(shared)
+        config_file = os.path.join(self.folder, filename)
+        with open(config_file, 'w', encoding='utf-8') as f:
+            f.write('[snsync]\n')
+            for name, value in values.items():
+                f.write('%s = %s\n' % (name, value))
+            for account, settings in accounts.items():
+                f.write('\n[snsync:%s]\n' % account)
+                for name, value in settings.items():
+                    f.write('%s = %s\n' % (name, value))
+        return config_file
+
+
+class AccountConfigTest(AccountsTestCase):
+
+    def test_sections(self):
+        config_file = self.write_accounts({'alice': {'cfg_sn_username': 'alice@example.com'}, 'bob': {}})
+        configs = account_configs([config_file])
+        self.assertEqual([name for name, _ in configs], ['alice', 'bob'])
+
+        alice, bob = [config for _, config in configs]
+        self.assertEqual(alice.get_config('sn_username'), 'alice@example.com')
+        self.assertEqual(bob.get_config('sn_username'), 'test@example.com') # from [snsync]
+        self.assertEqual(alice.get_config('cfg_nt_path'), os.path.join(self.folder, 'alice'))
+        self.assertEqual(bob.get_config('cfg_db_path'), os.path.join(self.folder, 'bob.sqlite'))
+        check_accounts(configs)
+
+    def test_file_without_sections(self):
+        configs = account_configs([self.config_file])
+        self.assertEqual([name for name, _ in configs], ['snsync']) # named after the file
+        self.assertEqual(configs[0][1].get_config('cfg_nt_path'), self.path)
+        check_accounts(configs)
+
+    def test_files(self):
+        other = os.path.join(self.folder, 'other')
+        os.mkdir(other)
+        other_file = os.path.join(other, 'work.ini')
+        with open(other_file, 'w', encoding='utf-8') as f:
+            f.write('[snsync]\ncfg_sn_username = work@example.com\ncfg_sn_password = test\n')
+            f.write('cfg_nt_path = %s\ncfg_db_path = %s\n' % (os.path.join(other, 'notes'), os.path.join(other, 'snsync.sqlite')))
+        configs = account_configs([self.config_file, other_file])
+        self.assertEqual([name for name, _ in configs], ['snsync', 'work'])
+        check_accounts(configs)
+
+    def test_environment_ignored(self):
+        os.environ['sn_username'] = 'env@example.com'
+        os.environ['sn_nt_path'] = os.path.join(self.folder, 'env')
+        config_file = self.write_accounts({'alice': {}})
+        _, config = account_configs([config_file])[0]
+        self.assertEqual(config.get_config('sn_username'), 'test@example.com')
+        self.assertEqual(config.get_config('cfg_nt_path'), os.path.join(self.folder, 'alice'))
+        self.assertEqual(Config(config_file).get_config('sn_username'), 'env@example.com') # single account mode still uses them
+
+    def test_duplicates(self):
+        for option in ('cfg_nt_path', 'cfg_db_path', 'cfg_log_path', 'cfg_metrics_json', 'cfg_metrics_prom'):
+            with self.subTest(option=option):
+                shared = os.path.join(self.folder, 'shared')
+                config_file = self.write_accounts({'alice': {option: shared}, 'bob': {option: shared + '/../shared'}})
+                with self.assertRaises(AccountError) as raised:
+                    check_accounts(account_configs([config_file]))
+                self.assertIn(option, str(raised.exception))
+                self.assertIn('alice and bob', str(raised.exception))
+
+    def test_same_name(self):
+        config_file = self.write_accounts({'alice': {}})
+        other_file = self.write_accounts({'alice': {'cfg_nt_path': os.path.join(self.folder, 'other')}}, filename='other.ini')
+        with self.assertRaises(AccountError) as raised:
+            check_accounts(account_configs([config_file, other_file]))
+        self.assertIn('same account', str(raised.exception))
+
+    def test_disabled_not_shared(self):
+        config_file = self.write_accounts({'alice': {}, 'bob': {}}, cfg_log_path='DISABLED')
+        check_accounts(account_configs([config_file]))
+
+    def test_no_credentials(self):
+        config_file = self.write_accounts({'alice': {}, 'bob': {'cfg_sn_password': ''}})
+        with self.assertRaises(AccountError) as raised:
+            check_accounts(account_configs([config_file]))
+        self.assertIn('bob', str(raised.exception))
+
+    def test_no_accounts(self):
+        with self.assertRaises(AccountError):
+            check_accounts([])
+
+
+class SyncAccountsTest(AccountsTestCase):
+    """
+        Accounts synced together, sharing the connections & rate budget
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.mock = MockSimperium(password='test', logger=logger).start()
+        self.addCleanup(self.mock.stop)
+        self.mock.populate(5)
+
+        self.transport = Transport(pool_size=2)
+        self.addCleanup(self.transport.close)
+        self.transport.proxies = {}
+        self.scheduler = Scheduler(concurrency=2, logger=logger)
+
+    def accounts(self, settings):
+        """
+            Account of each [snsync:name] section
+        """
+        config_file = self.write_accounts(settings, cfg_api_url=self.mock.url, cfg_sync_workers=2)
+        configs = account_configs([config_file])
+        check_accounts(configs)
+        account_list = [Account(name, config) for name, config in configs]
+        for account in account_list:
+            for handler in account.log.handlers:
+                self.addCleanup(handler.close) # the log files are in self.folder
+        return account_list
+
+    def notes(self, name):
+        """
+            Note files of an account
+        """
+        return sorted(name for name in os.listdir(os.path.join(self.folder, name)) if name.endswith('.txt'))
+
+    def test_sync(self):
+        account_list = self.accounts({'alice': {}, 'bob': {}})
+        done = sync_accounts(account_list, self.transport, self.scheduler, parallel=2)
+
+        self.assertEqual(sorted(account.name for account in done), ['alice', 'bob'])
+        for account in account_list:
+            self.assertIsNone(account.error)
+            self.assertEqual(account.result.counters['added'], 5)
+            self.assertEqual(len(self.notes(account.name)), 5)
+            self.assertTrue(os.path.isfile(os.path.join(self.folder, account.name + '.log')))
+
+    def test_one_fails(self):
+        account_list = self.accounts({'alice': {'cfg_sn_password': 'wrong'}, 'bob': {}, 'carol': {}})
+        done = sync_accounts(account_list, self.transport, self.scheduler, parallel=1) # one at a time, alice first
+
+        self.assertEqual([account.name for account in done], ['alice', 'bob', 'carol'])
+        alice, bob, carol = account_list
+        self.assertEqual(alice.error, 'Simplenote Login Failed')
+        self.assertEqual(alice.result.error, 'Simplenote Login Failed')
+        self.assertEqual(self.notes('alice'), [])
+        for account in (bob, carol):
+            self.assertIsNone(account.error)
+            self.assertEqual(len(self.notes(account.name)), 5)
+
+    def test_stopped(self):
+        account_list = self.accounts({'alice': {}, 'bob': {}})
+        stop = threading.Event()
+        alice_sync = account_list[0].sync
+
+        def stopped_while_syncing(*args, **kwargs): # i.e. SIGTERM
+            stop.set()
+            return alice_sync(*args, **kwargs)
+
+        with mock.patch.object(account_list[0], 'sync', stopped_while_syncing):
+            done = sync_accounts(account_list, self.transport, self.scheduler, parallel=1, stop=stop)
+        self.assertEqual([account.name for account in done], ['alice']) # the one syncing finishes, no more start
+        self.assertEqual(len(self.notes('alice')), 5)
+        self.assertIsNone(account_list[1].result)
@@ -0,0 +1,353 @@
+"""
+    Database tests: batched writes, schema upgrades, the token cache & note search
+"""
+import os
+import stat
+import sqlite3
+from unittest import mock
+
+from simplenote_sync.db import Database, DatabaseError
+
+from .support import TempConfigTestCase, logger
+
+
+class BatchedWritesTest(TempConfigTestCase):
+    """
+        queue() / flush() / commit(), a failing write must not lose (or half apply) the others
+    """
+
+    settings = {'cfg_db_batch_size': 100, 'cfg_db_batch_seconds': 3600}
+
+    def setUp(self):
+        super().setUp()
+        self.db = Database(self.config(), logger)
+        self.addCleanup(self.db.disconnect)
+
+    def committed(self):
+        """
+            snsync meta names as another connection sees them
+        """
+        conn = sqlite3.connect(self.db.filename)
+        try:
+            return sorted(row[0] for row in conn.execute("SELECT name FROM snsync WHERE name LIKE 'test%'"))
+        finally:
+            conn.close()
+
+    def test_commit(self):
+        self.db.update_snsync('test_a', '1')
+        self.db.update_snsync('test_b', '2')
+        self.assertEqual(self.committed(), [])
+        self.db.commit()
+        self.assertEqual(self.committed(), ['test_a', 'test_b'])
+
+    def test_flush_does_not_commit(self):
+        self.db.update_snsync('test_a', '1')
+        self.assertTrue(self.db.flush())
+        self.assertEqual(self.db.get_snsync_meta('test_a'), '1')
+        self.assertEqual(self.committed(), [])
+
+    def test_failed_write_keeps_the_batch(self):
+        self.db.update_snsync('test_a', '1')
+        self.db.queue('INSERT INTO no_such_table (name) VALUES (?)', ('x',))
+        self.db.update_snsync('test_b', '2')
+
+        with self.assertRaises(DatabaseError):
+            self.db.commit()
+
+        self.assertEqual(len(self.db.pending), 3) # still queued, in order
+        self.assertEqual(self.db.pending[0][1], ('test_a', '1'))
+        self.assertEqual(self.committed(), []) # nothing half applied is committed
+        self.db.db.execute("SELECT count(*) FROM snsync WHERE name LIKE 'test%'")
+        self.assertEqual(self.db.db.fetchone()[0], 0) # rolled back to the savepoint
+
+    def test_integrity_error(self):
+        self.db.queue('INSERT INTO snsync (name, value) VALUES (?, ?)', ('test_a', '1'))
+        self.db.queue('INSERT INTO snsync (name, value) VALUES (?, ?)', ('test_a', '2')) # name is the primary key
+        with self.assertRaises(DatabaseError):
+            self.db.flush()
+        self.assertEqual(self.committed(), [])
+
+    def test_discard(self):
+        self.db.update_snsync('test_a', '1')
+        self.db.commit()
+        self.db.update_snsync('test_b', '2')
+        self.db.queue('INSERT INTO no_such_table (name) VALUES (?)', ('x',))
+        with self.assertRaises(DatabaseError):
+            self.db.commit()
+
+        self.db.discard()
+        self.assertEqual(self.db.pending, [])
+        self.db.update_snsync('test_c', '3')
+        self.db.commit()
+        self.assertEqual(self.committed(), ['test_a', 'test_c'])
+
+    def test_disconnect_after_failure(self):
+        self.db.update_snsync('test_a', '1')
+        self.db.commit()
+        self.db.queue('INSERT INTO no_such_table (name) VALUES (?)', ('x',))
+        self.db.disconnect() # no exception, the bad batch is dropped
+        self.assertIsNone(self.db.dbconn)
+        self.assertEqual(self.committed(), ['test_a'])
+
+
+class SchemaUpgradeTest(TempConfigTestCase):
+    """
+        Databases of older versions are upgraded (one schema at a time) to the current one, keeping their rows
+    """
+
+    def create_v2(self):
+        """
+            A version 2 database as older snsync releases left it
+        """
+        conn = sqlite3.connect(self.config().get_config('cfg_db_path'))
+        conn.execute('CREATE TABLE simplenote (key TEXT PRIMARY KEY, createdate BLOB, deleted TEXT, modifydate BLOB, systemtags TEXT, tags TEXT, version TEXT)')
+        conn.execute('CREATE TABLE notefile (key TEXT PRIMARY KEY, createdate TEXT, deleted TEXT, modifydate TEXT, filename TEXT)')
+        conn.execute('CREATE TABLE snsync (name TEXT PRIMARY KEY, value BLOB)')
+        conn.executemany('INSERT INTO simplenote VALUES (?, ?, ?, ?, ?, ?, ?)', [
+            ('key1', '1500000000.5', 'False', '1500000100.25', '[]', '["work"]', '12'),
+            ('key2', '1500000000', 'True', '1500000200', '["pinned"]', '[]', '3'),
+        ])
+        conn.executemany('INSERT INTO notefile VALUES (?, ?, ?, ?, ?)', [
+            ('key1', '1500000000.5', 'False', '1500000100.25', 'hello world.txt'),
+            ('key3', '1500000000', '0', '1500000300', self.path + '/full path.txt'), # old bug, full paths for new notes
+        ])
+        conn.executemany('INSERT INTO snsync VALUES (?, ?)', [
+            ('sn_last_sync', '1500000400'),
+            ('sn_journal_newkey', 'uploading.txt'), # an interrupted upload
+        ])
+        conn.execute('PRAGMA user_version=2')
+        conn.commit()
+        conn.close()
+
+    def columns(self, conn, table):
+        """
+            name -> declared type of each column of table
+        """
+        return dict((row[1], row[2]) for row in conn.execute('PRAGMA table_info(%s)' % table))
+
+    def indexes(self, conn):
+        """
+            Names of the indexes (not SQLite's own)
+        """
+        return sorted(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND name NOT LIKE 'sqlite_%'"))
+
+    def test_upgrade_from_v2(self):
+        self.create_v2()
+        db = Database(self.config(), logger)
+        db.disconnect()
+
+        conn = sqlite3.connect(db.filename)
+        self.addCleanup(conn.close)
+
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], 7)
+        self.assertEqual(self.columns(conn, 'simplenote'), {'key': 'TEXT', 'createdate': 'REAL', 'deleted': 'INTEGER', 'modifydate': 'REAL',
+                                                            'systemtags': 'TEXT', 'tags': 'TEXT', 'version': 'INTEGER'})
+        self.assertEqual(self.columns(conn, 'notefile'), {'key': 'TEXT', 'createdate': 'REAL', 'deleted': 'INTEGER', 'modifydate': 'REAL',
+                                                          'filename': 'TEXT', 'digest': 'TEXT'})
+        self.assertEqual(self.columns(conn, 'filestate'), {'filename': 'TEXT', 'inode': 'INTEGER', 'size': 'INTEGER', 'mtime_ns': 'INTEGER'})
+        self.assertEqual(self.columns(conn, 'outbox'), {'key': 'TEXT', 'op': 'TEXT', 'filename': 'TEXT', 'queued': 'REAL', 'attempts': 'INTEGER'})
+        self.assertEqual(self.indexes(conn), ['notefile_filename', 'simplenote_modifydate'])
+
+        tables = set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+        self.assertNotIn('simplenote_v2', tables)
+        self.assertNotIn('notefile_v2', tables)
+        if db.fts:
+            self.assertIn('notesearch', tables)
+
+        # Rows survive, converted
+        self.assertEqual(conn.execute('SELECT * FROM simplenote ORDER BY key').fetchall(), [
+            ('key1', 1500000000.5, 0, 1500000100.25, '[]', '["work"]', 12),
+            ('key2', 1500000000.0, 1, 1500000200.0, '["pinned"]', '[]', 3),
+        ])
+        self.assertEqual(conn.execute('SELECT key, createdate, deleted, modifydate, filename, digest FROM notefile ORDER BY key').fetchall(), [
+            ('key1', 1500000000.5, 0, 1500000100.25, 'hello world.txt', None),
+            ('key3', 1500000000.0, 0, 1500000300.0, 'full path.txt', None), # relative to cfg_nt_path again
+        ])
+        self.assertEqual(conn.execute("SELECT value FROM snsync WHERE name='sn_last_sync'").fetchone()[0], '1500000400')
+
+    def test_journal_becomes_outbox(self):
+        self.create_v2()
+        db = Database(self.config(), logger)
+        self.addCleanup(db.disconnect)
+
+        self.assertEqual([(entry['key'], entry['op'], entry['filename']) for entry in db.get_outbox()], [('newkey', 'add', 'uploading.txt')])
+        self.assertFalse(db.get_snsync_meta('sn_journal_newkey'))
+
+    def test_upgraded_matches_new(self):
+        self.create_v2()
+        upgraded = Database(self.config(), logger)
+        upgraded.disconnect()
+
+        self.write_config(cfg_db_path=self.folder + '/new.sqlite')
+        new = Database(self.config(), logger)
+        new.disconnect()
+
+        upgraded_conn = sqlite3.connect(upgraded.filename)
+        new_conn = sqlite3.connect(new.filename)
+        self.addCleanup(upgraded_conn.close)
+        self.addCleanup(new_conn.close)
+
+        for table in ('simplenote', 'notefile', 'snsync', 'filestate', 'outbox'):
+            self.assertEqual(list(upgraded_conn.execute('PRAGMA table_info(%s)' % table)), list(new_conn.execute('PRAGMA table_info(%s)' % table)), table)
+        self.assertEqual(self.indexes(upgraded_conn), self.indexes(new_conn))
+        self.assertEqual(upgraded_conn.execute('PRAGMA user_version').fetchone(), new_conn.execute('PRAGMA user_version').fetchone())
+
+
+class TokenCacheTest(TempConfigTestCase):
+    """
+        The cached API token is a credential, the DB & SQLite's files next to it are private
+    """
+
+    settings = {'cfg_db_journal': 'wal'}
+
+    def mode(self, filename):
+        return stat.S_IMODE(os.stat(filename).st_mode)
+
+    def test_private(self):
+        umask = os.umask(0o022)
+        try:
+            db = Database(self.config(), logger)
+            self.addCleanup(db.disconnect)
+            db.update_snsync('test_a', '1')
+            db.commit()
+        finally:
+            os.umask(umask)
+
+        files = [db.filename, db.filename + '-wal', db.filename + '-shm']
+        self.assertEqual([self.mode(filename) for filename in files], [0o644] * 3)
+
+        db.save_token('test@example.com', 'secret')
+        db.commit()
+        self.assertEqual([self.mode(filename) for filename in files], [0o600] * 3)
+        self.assertEqual(db.get_token('test@example.com'), 'secret')
+
+    def test_private_journal(self):
+        self.config_file = self.write_config(cfg_db_journal='persist') # the -journal file stays between transactions
+        umask = os.umask(0o022)
+        try:
+            db = Database(self.config(), logger)
+            self.addCleanup(db.disconnect)
+            db.update_snsync('test_a', '1')
+            db.commit()
+        finally:
+            os.umask(umask)
+
+        files = [db.filename, db.filename + '-journal']
+        self.assertEqual([self.mode(filename) for filename in files], [0o644] * 2)
+
+        db.save_token('test@example.com', 'secret')
+        db.commit()
+        self.assertEqual([self.mode(filename) for filename in files], [0o600] * 2)
+
+
+class NoFTS5(sqlite3.Connection):
+    """
+        Connection of an SQLite built without FTS5
+    """
+
+    def execute(self, sql, *args):
+        if 'fts5' in sql:
+            raise sqlite3.OperationalError('no such module: fts5')
+        return super().execute(sql, *args)
+
+
+class SearchTest(TempConfigTestCase):
+    """
+        The notesearch (FTS5) index & search()
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.db = Database(self.config(), logger)
+        self.addCleanup(self.db.disconnect)
+
+    def found(self, query):
+        """
+            Keys of the notes matching query, best first
+        """
+        return [result['key'] for result in self.db.search(query)]
+
+    def test_search(self):
+        self.assertTrue(self.db.fts)
+        self.db.search_add('a', 'Shopping.txt', 'Shopping\napples, pears\n', ['home'])
+        self.db.search_add('b', 'Work.txt', 'Work\nthe quarterly report\n', '["work"]') # tags as cached
+        self.assertEqual(self.found('apples'), ['a'])
+        self.assertEqual(self.found('quarter*'), ['b'])
+        self.assertEqual(self.found('tags:work'), ['b'])
+        self.assertEqual(self.found('bananas'), [])
+        self.assertEqual(self.db.search('pears')[0]['snippet'], 'Shopping\napples, [pears]\n')
+        self.assertEqual(self.db.search_keys(), {'a', 'b'})
+
+    def test_ranking(self):
+        # bm25 weights: filename 10, tags 5, content 1
+        self.db.search_add('content', 'Notes.txt', 'Notes\nthe garden needs water\n', [])
+        self.db.search_add('tags', 'Plans.txt', 'Plans\nseeds & pots\n', ['garden'])
+        self.db.search_add('filename', 'Garden.txt', 'Garden\nroses\n', [])
+        self.assertEqual(self.found('garden'), ['filename', 'tags', 'content'])
+
+        ranks = [result['rank'] for result in self.db.search('garden')]
+        self.assertEqual(ranks, sorted(ranks)) # bm25, lower is better
+
+    def test_limit(self):
+        for i in range(30):
+            self.db.search_add('k%s' % i, 'Note %s.txt' % i, 'Note %s\nhello\n' % i, [])
+        self.assertEqual(len(self.db.search('hello')), 20)
+        self.assertEqual(len(self.db.search('hello', limit=5)), 5)
+
+    def test_update(self):
+        self.db.search_add('a', 'Shopping.txt', 'Shopping\napples\n', [])
+        self.db.search_add('a', 'Shopping.txt', 'Shopping\nbread\n', []) # replaced, not added
+        self.assertEqual(self.found('apples'), [])
+        self.assertEqual(self.found('bread'), ['a'])
+        self.assertEqual(len(self.db.search('shopping')), 1)
+
+        self.db.search_rename('a', 'Groceries.txt')
+        self.assertEqual([result['filename'] for result in self.db.search('bread')], ['Groceries.txt'])
+
+    def test_delete(self):
+        self.db.search_add('a', 'Shopping.txt', 'Shopping\napples\n', [])
+        self.db.search_add('b', 'Apples.txt', 'Apples\nto buy\n', [])
+        self.db.search_del('a')
+        self.assertEqual(self.found('apples'), ['b'])
+        self.db.del_nf('b') # a forgotten file
+        self.assertEqual(self.found('apples'), [])
+
+    def test_not_fts5_syntax(self):
+        self.db.search_add('a', 'Meeting.txt', 'Meeting\nco-op at 10:30\n', [])
+        self.assertEqual(self.found('co-op'), ['a']) # a syntax error, searched for as words
+        self.assertEqual(self.found('10:30'), ['a'])
+        self.assertEqual(self.found('"'), [])
+
+    def test_committed(self):
+        self.db.search_add('a', 'Shopping.txt', 'Shopping\napples\n', [])
+        self.db.commit()
+        self.db.disconnect()
+
+        db = Database(self.config(), logger)
+        self.addCleanup(db.disconnect)
+        self.assertEqual([result['key'] for result in db.search('apples')], ['a'])
+
+    def test_no_fts5(self):
+        self.db.disconnect()
+        os.remove(self.db.filename)
+        connect = sqlite3.connect
+
+        with mock.patch('sqlite3.connect', lambda *args, **kwargs: connect(*args, factory=NoFTS5, **kwargs)):
+            with self.assertLogs(logger, 'WARNING') as logs:
+                db = Database(self.config(), logger)
+            self.addCleanup(db.disconnect)
+
+            self.assertIn('SQLite FTS5 not available, note search disabled', '\n'.join(logs.output))
+            self.assertFalse(db.fts)
+            self.assertFalse(db.search_add('a', 'Shopping.txt', 'Shopping\napples\n', []))
+            self.assertFalse(db.search_del('a'))
+            self.assertEqual(db.search('apples'), [])
+            self.assertEqual(db.search_keys(), set())
+            db.update_snsync('test_a', '1')
+            db.commit() # the rest works
+            db.disconnect()
+
+        db = Database(self.config(), logger) # an SQLite with FTS5 adds the index
+        self.addCleanup(db.disconnect)
+        self.assertTrue(db.fts)
+        self.assertEqual(db.search('apples'), [])
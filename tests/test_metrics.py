@@ -0,0 +1,167 @@
+"""
+    Metrics tests: latency histograms, JSON & Prometheus textfile export
+"""
+import os
+import re
+import json
+import stat
+import unittest
+from unittest import mock
+
+from simplenote_sync import metrics, snsync
+from simplenote_sync.engine import SyncResult
+from simplenote_sync.mockserver import MockSimperium
+from simplenote_sync.version import __version__
+
+from .support import TempConfigTestCase, logger
+
+
+SAMPLE = re.compile(r'^([a-z_]+)(\{(?:[a-z_]+="(?:[^"\\]|\\.)*",?)+\})? (-?[0-9.e+-]+)$') # name{labels} value
+
+
+def sync_result(error=None):
+    """
+        SyncResult of a small sync, 3 requests
+    """
+    result = SyncResult(True)
+    result.counters.update({'added': 2, 'modified': 1, 'http_errors': 1, 'requests': 3})
+    result.operations['download'] = 3
+    result.timings['total'] = 1.5
+    stats = metrics.RequestStats()
+    stats.observe('auth', 200, 0.04)
+    stats.observe('index', 200, 0.3)
+    stats.observe('note_get', 'error', 70.0)
+    stats.retry('throttled')
+    result.requests = stats.as_dict()
+    result.retries = {'throttled': 1, 'token': 0, 'reconnect': 0}
+    result.error = error
+    return result
+
+
+def samples(text):
+    """
+        Prometheus text: {(name, labels): value}, labels as a frozenset of (label, value)
+    """
+    values = {}
+    for line in text.splitlines():
+        if line.startswith('#'):
+            continue
+        name, labels, value = SAMPLE.match(line).groups()
+        labels = frozenset(re.findall(r'([a-z_]+)="((?:[^"\\]|\\.)*)"', labels or ''))
+        values[(name, labels)] = float(value)
+    return values
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_buckets(self):
+        histogram = metrics.Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.as_dict(), {'count': 4, 'sum': 5.65, 'buckets': {'0.1': 2, '1.0': 3, '+Inf': 4}}) # le, cumulative
+
+    def test_request_stats(self):
+        stats = metrics.RequestStats()
+        stats.observe('index', 200, 0.2)
+        stats.observe('index', 429, 0.1)
+        stats.retry('throttled')
+        self.assertEqual(stats.request_count(), 2)
+        self.assertAlmostEqual(stats.seconds('index'), 0.3)
+        self.assertEqual(stats.seconds('auth'), 0.0)
+        self.assertEqual(stats.as_dict()['statuses'], {'index': {'200': 1, '429': 1}})
+        self.assertEqual(stats.as_dict()['retries'], {'throttled': 1})
+
+        stats.reset()
+        self.assertEqual(stats.request_count(), 0)
+        self.assertEqual(stats.as_dict(), {'latency': {}, 'statuses': {}, 'retries': {}})
+
+
+class FormatTest(unittest.TestCase):
+
+    def test_json(self):
+        exported = json.loads(metrics.to_json(sync_result(), labels={'account': 'alice'}))
+        self.assertEqual(exported['account'], 'alice')
+        self.assertEqual(exported['version'], __version__)
+        self.assertEqual(exported['changes'], 3)
+        self.assertIsNone(exported['error'])
+        self.assertEqual(exported['requests']['statuses']['note_get'], {'error': 1})
+        self.assertEqual(exported['requests']['latency']['index']['buckets']['0.5'], 1)
+
+    def test_prometheus(self):
+        text = metrics.to_prometheus(sync_result())
+        values = samples(text) # every line parses
+
+        for name in set(name for name, _ in values):
+            base = re.sub('_(bucket|sum|count)$', '', name)
+            self.assertIn('# HELP %s ' % base, text)
+            self.assertRegex(text, '# TYPE %s (gauge|histogram)\n' % base)
+
+        self.assertEqual(values[('snsync_last_sync_success', frozenset())], 1)
+        self.assertEqual(values[('snsync_sync_changes', frozenset({('change', 'added')}))], 2)
+        self.assertEqual(values[('snsync_api_responses', frozenset({('endpoint', 'note_get'), ('status', 'error')}))], 1)
+        self.assertEqual(values[('snsync_api_retries', frozenset({('reason', 'throttled')}))], 1)
+
+        duration = 'snsync_api_request_duration_seconds'
+        self.assertEqual(values[(duration + '_bucket', frozenset({('endpoint', 'note_get'), ('le', '60.0')}))], 0)
+        self.assertEqual(values[(duration + '_bucket', frozenset({('endpoint', 'note_get'), ('le', '+Inf')}))], 1)
+        self.assertEqual(values[(duration + '_count', frozenset({('endpoint', 'index')}))], 1)
+        self.assertEqual(values[(duration + '_sum', frozenset({('endpoint', 'auth')}))], 0.04)
+
+    def test_prometheus_labels(self):
+        values = samples(metrics.to_prometheus(sync_result(error='Simplenote Login Failed'), labels={'account': 'a "b" \\ c'}))
+        for _, labels in values:
+            self.assertIn(('account', 'a \\"b\\" \\\\ c'), labels) # on every sample, escaped
+        self.assertEqual(values[('snsync_last_sync_success', frozenset({('account', 'a \\"b\\" \\\\ c')}))], 0)
+
+
+class ExportTest(TempConfigTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.json_path = os.path.join(self.folder, 'snsync.json')
+        self.prom_path = os.path.join(self.folder, 'snsync.prom')
+
+    def test_export(self):
+        self.assertTrue(metrics.export(sync_result(), self.json_path, self.prom_path, labels={'account': 'alice'}))
+        with open(self.json_path, encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['account'], 'alice')
+        with open(self.prom_path, encoding='utf-8') as f:
+            self.assertIn('snsync_last_sync_success{account="alice"} 1\n', f.read())
+        self.assertEqual(stat.S_IMODE(os.stat(self.prom_path).st_mode), 0o644) # node_exporter can read it
+
+    def test_replaced(self):
+        with open(self.prom_path, 'w', encoding='utf-8') as f:
+            f.write('old\n')
+        inode = os.stat(self.prom_path).st_ino
+
+        self.assertTrue(metrics.export(sync_result(), prom_path=self.prom_path))
+        self.assertNotEqual(os.stat(self.prom_path).st_ino, inode) # a new file renamed over it, not rewritten in place
+        self.assertEqual(sorted(os.listdir(self.folder)), ['notes', 'snsync.ini', 'snsync.prom'])
+
+    def test_not_written(self):
+        with open(self.prom_path, 'w', encoding='utf-8') as f:
+            f.write('old\n')
+
+        with mock.patch('os.replace', side_effect=OSError('disk full')):
+            with self.assertLogs(logger, 'ERROR'):
+                self.assertFalse(metrics.export(sync_result(), self.json_path, self.prom_path, logger=logger))
+
+        with open(self.prom_path, encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'old\n') # the last complete file stays
+        self.assertEqual(sorted(os.listdir(self.folder)), ['notes', 'snsync.ini', 'snsync.prom']) # no temporary files
+
+    def test_failed_sync(self):
+        server = MockSimperium(password='right', logger=logger).start()
+        self.addCleanup(server.stop)
+        self.write_config(cfg_api_url=server.url, cfg_metrics_json=self.json_path, cfg_metrics_prom=self.prom_path)
+
+        with self.assertRaises(SystemExit) as exited:
+            snsync.main(['-s', '-c', self.config_file])
+        self.assertEqual(exited.exception.code, 1)
+
+        with open(self.json_path, encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['error'], 'Simplenote Login Failed')
+        with open(self.prom_path, encoding='utf-8') as f:
+            values = samples(f.read())
+        self.assertEqual(values[('snsync_last_sync_success', frozenset())], 0)
+        self.assertEqual(values[('snsync_api_responses', frozenset({('endpoint', 'auth'), ('status', '401')}))], 1)
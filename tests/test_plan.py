@@ -0,0 +1,285 @@
+"""
+    Planner tests: the operations planned for each Simplenote / note file state, on fake db & note objects
+"""
+import types
+import unittest
+
+from simplenote_sync.plan import (Planner, SyncPlan, Operation, DOWNLOAD, UPLOAD, TRASH_LOCAL, TRASH_REMOTE, CONFLICT, CACHE,
+                                  RENAME, MOVE, SKIP)
+from simplenote_sync.notes import file_state
+
+from .support import logger
+
+
+FILETIME = '20260101120000'
+
+
+def fstat(inode, mtime, size=10):
+    """
+        Enough of an os.stat() result for the planner
+    """
+    return types.SimpleNamespace(st_ino=inode, st_size=size, st_mtime=float(mtime), st_mtime_ns=int(mtime) * 10**9)
+
+
+class FakeDatabase:
+    """
+        Database lookups the planner makes, over dicts
+    """
+
+    def __init__(self, simplenotes=None, notefiles=None, filestate=None):
+        self.simplenotes = simplenotes or {} # key -> simplenote row
+        self.notefiles = notefiles or {} # key -> notefile row
+        self.filestate = filestate or {} # filename -> file_state()
+
+    def get_filestate(self):
+        return dict(self.filestate)
+
+    def find_sn_by_key(self, key):
+        return self.simplenotes.get(key, False)
+
+    def find_nf_by_key(self, key):
+        return self.notefiles.get(key, False)
+
+    def find_nf_by_name(self, filename):
+        for notefile in self.notefiles.values():
+            if notefile['filename'] == filename:
+                return notefile
+        return False
+
+
+class FakeNote:
+    """
+        Note folder as the planner sees it, tags are cfg_sync_tags
+    """
+
+    def __init__(self, tags=(), files=None):
+        self.tag_folders = dict((tag, tag) for tag in tags)
+        self.files = files or {} # filename -> fstat(), files outside the scanned folders
+        self.contents = {} # filename -> digest
+
+    def folders(self):
+        return list(self.tag_folders.values()) or ['']
+
+    def folder(self, tags):
+        if not self.tag_folders:
+            return ''
+        for tag in tags:
+            if tag in self.tag_folders:
+                return self.tag_folders[tag]
+        return None
+
+    def stat(self, filename):
+        return self.files.get(filename, False)
+
+    def open(self, filename):
+        if filename not in self.contents:
+            return False
+        return {'digest': self.contents[filename]}
+
+    def gen_meta(self, filename, fstat=None): # pylint: disable=W0613
+        return {'key': 'new-' + filename, 'filename': filename, 'deleted': 0}
+
+
+def simplenote(key='key1', modifydate=2000, deleted=0, version=2, tags=()):
+    """
+        Simplenote list entry
+    """
+    return {'key': key, 'modifydate': modifydate, 'deleted': deleted, 'version': version, 'tags': list(tags)}
+
+
+def cached(key='key1', modifydate=1000, version=1):
+    """
+        simplenote row (the cache, as of the last sync)
+    """
+    return {'key': key, 'modifydate': modifydate, 'deleted': 0, 'version': version}
+
+
+def notefile(key='key1', filename='note.txt', digest=None):
+    """
+        notefile row
+    """
+    return {'key': key, 'filename': filename, 'modifydate': 1000, 'deleted': 0, 'digest': digest}
+
+
+SYNCED = fstat(1, 1000) # as it was at the last sync
+TOUCHED = fstat(1, 3000, size=12) # changed after the last sync, after the Simplenote too
+
+# name, Simplenote, cached simplenote row, notefile row, local files, expected (kind, filename, target, new) operations
+CASES = [
+    ('new', simplenote(), None, None, {},
+     [(DOWNLOAD, None, None, True)]),
+    ('new, trashed', simplenote(deleted=1), None, None, {},
+     [(CACHE, None, None, False)]),
+    ('file meta AWOL', simplenote(), cached(), None, {},
+     [(DOWNLOAD, None, None, False)]),
+    ('file meta AWOL, trashed', simplenote(deleted=1), cached(), None, {},
+     []),
+    ('unchanged', simplenote(modifydate=1000), cached(), notefile(), {'note.txt': SYNCED},
+     []),
+    ('file newer, but untouched since the last sync', simplenote(modifydate=500), cached(modifydate=500), notefile(), {'note.txt': SYNCED},
+     []),
+    ('Simplenote modified', simplenote(), cached(), notefile(), {'note.txt': SYNCED},
+     [(DOWNLOAD, 'note.txt', None, False)]),
+    ('file modified', simplenote(modifydate=1000), cached(), notefile(), {'note.txt': TOUCHED},
+     [(UPLOAD, 'note.txt', None, False)]),
+    ('file older than the Simplenote', simplenote(), cached(), notefile(), {'note.txt': fstat(1, 1500, size=12)},
+     [(DOWNLOAD, 'note.txt', None, False)]),
+    ('modified on both sides', simplenote(), cached(), notefile(), {'note.txt': TOUCHED},
+     [(CONFLICT, 'note.txt', 'DUP_' + FILETIME + '_note.txt', False), (DOWNLOAD, 'note.txt', None, False)]),
+    ('trashed on Simplenote', simplenote(deleted=1), cached(), notefile(), {'note.txt': SYNCED},
+     [(TRASH_LOCAL, 'note.txt', None, False)]),
+    ('trashed on Simplenote, file gone', simplenote(deleted=1), cached(), notefile(), {},
+     []),
+    ('deleted locally', simplenote(modifydate=1000), cached(), notefile(), {},
+     [(TRASH_REMOTE, 'note.txt', None, False)]),
+    ('deleted locally, other new files', simplenote(modifydate=1000), cached(), notefile(), {'other.txt': fstat(2, 1000)},
+     [(TRASH_REMOTE, 'note.txt', None, False)]),
+    ('renamed', simplenote(modifydate=1000), cached(), notefile(), {'renamed.txt': SYNCED},
+     [(RENAME, 'note.txt', 'renamed.txt', False)]),
+    ('renamed & Simplenote modified', simplenote(), cached(), notefile(), {'renamed.txt': SYNCED},
+     [(RENAME, 'note.txt', 'renamed.txt', False), (DOWNLOAD, 'renamed.txt', None, False)]),
+    ('renamed & trashed on Simplenote', simplenote(deleted=1), cached(), notefile(), {'renamed.txt': SYNCED},
+     [(RENAME, 'note.txt', 'renamed.txt', False), (TRASH_LOCAL, 'renamed.txt', None, False)]),
+]
+
+
+class PlanNoteTest(unittest.TestCase):
+
+    def planner(self, sn_row, nf_row, files, note=None):
+        db = FakeDatabase({'key1': sn_row} if sn_row else {}, {'key1': nf_row} if nf_row else {}, {'note.txt': file_state(SYNCED)})
+        return Planner(db, note or FakeNote(), logger, dict(files), FILETIME)
+
+    def test_cases(self):
+        for name, n, sn_row, nf_row, files, expected in CASES:
+            with self.subTest(name):
+                ops = self.planner(sn_row, nf_row, files).plan_note(n)
+                self.assertEqual([(op.kind, op.filename, op.target, op.new) for op in ops], expected)
+                for op in ops:
+                    self.assertEqual(op.key, 'key1')
+                    self.assertIs(op.note, n)
+
+    def test_unchanged_is_in_sync(self):
+        planner = self.planner(cached(), notefile(), {'note.txt': SYNCED})
+        self.assertEqual(planner.plan_note(simplenote(modifydate=1000)), [])
+        self.assertEqual(planner.in_sync, {'note.txt': file_state(SYNCED)})
+        self.assertEqual(list(planner.local_operations(planner.local_files.items())), [])
+
+    def test_conflict_uploads_the_duplicate(self):
+        planner = self.planner(cached(), notefile(), {'note.txt': TOUCHED})
+        conflict, download = planner.plan_note(simplenote())
+
+        self.assertEqual(conflict.fstat, TOUCHED)
+        self.assertEqual(conflict.meta['filename'], 'note.txt')
+        self.assertEqual(download.meta['filename'], 'note.txt') # the Simplenote version replaces the file
+        self.assertEqual(planner.local_files['DUP_' + FILETIME + '_note.txt'], TOUCHED)
+        self.assertEqual(planner.in_sync, {})
+
+        # Loop 2: the duplicate is a new note, the original isn't
+        uploads = list(planner.local_operations(sorted(planner.local_files.items())))
+        self.assertEqual([(op.kind, op.filename, op.new) for op in uploads], [(UPLOAD, 'DUP_' + FILETIME + '_note.txt', True)])
+        self.assertEqual(uploads[0].fstat, TOUCHED)
+
+    def test_touched_and_remote_edit(self):
+        planner = self.planner(cached(), notefile(digest='abc'), {'note.txt': TOUCHED})
+        planner.note.contents['note.txt'] = 'abc' # same bytes, only the mtime changed
+        ops = planner.plan_note(simplenote())
+        self.assertEqual([(op.kind, op.filename, op.target) for op in ops], [(DOWNLOAD, 'note.txt', None)])
+        self.assertNotIn('DUP_' + FILETIME + '_note.txt', planner.local_files)
+
+    def test_edited_and_remote_edit(self):
+        planner = self.planner(cached(), notefile(digest='abc'), {'note.txt': TOUCHED})
+        planner.note.contents['note.txt'] = 'def'
+        self.assertEqual([op.kind for op in planner.plan_note(simplenote())], [CONFLICT, DOWNLOAD])
+
+    def test_touched_only(self):
+        planner = self.planner(cached(), notefile(digest='abc'), {'note.txt': TOUCHED})
+        planner.note.contents['note.txt'] = 'abc'
+        self.assertEqual([op.kind for op in planner.plan_note(simplenote(modifydate=1000))], [UPLOAD]) # the Executor skips it
+
+    def test_conflict_in_tag_folder(self):
+        planner = self.planner(cached(), notefile(filename='work/note.txt'), {'work/note.txt': TOUCHED}, FakeNote(tags=['work']))
+        ops = planner.plan_note(simplenote(tags=['work']))
+        self.assertEqual([(op.kind, op.target) for op in ops], [(CONFLICT, 'work/DUP_' + FILETIME + '_note.txt'), (DOWNLOAD, None)])
+
+    def test_trashed_file_is_not_new(self):
+        planner = self.planner(cached(), notefile(), {'note.txt': SYNCED})
+        planner.plan_note(simplenote(deleted=1))
+        self.assertNotIn('note.txt', planner.local_files)
+
+    def test_renamed_file_is_not_new(self):
+        planner = self.planner(cached(), notefile(), {'renamed.txt': SYNCED})
+        planner.plan_note(simplenote(modifydate=1000))
+        self.assertEqual(list(planner.local_operations(planner.local_files.items())), [])
+
+    def test_renamed_by_content(self):
+        planner = self.planner(cached(), notefile(digest='abc'), {'copied.txt': fstat(5, 1000)})
+        planner.note.contents['copied.txt'] = 'abc'
+        ops = planner.plan_note(simplenote(modifydate=1000))
+        self.assertEqual([(op.kind, op.target) for op in ops], [(RENAME, 'copied.txt')])
+
+    def test_rename_claimed_once(self):
+        db = FakeDatabase({'key1': cached('key1'), 'key2': cached('key2')},
+                          {'key1': notefile('key1', 'a.txt'), 'key2': notefile('key2', 'b.txt')},
+                          {'a.txt': file_state(SYNCED), 'b.txt': file_state(SYNCED)}) # hard links, same state
+        planner = Planner(db, FakeNote(), logger, {'renamed.txt': SYNCED}, FILETIME)
+        self.assertEqual([op.kind for op in planner.plan_note(simplenote('key1', modifydate=1000))], [RENAME])
+        self.assertEqual([op.kind for op in planner.plan_note(simplenote('key2', modifydate=1000))], [TRASH_REMOTE])
+
+
+class TagFolderTest(unittest.TestCase):
+    """
+        Selective sync (cfg_sync_tags): each synced tag is a folder
+    """
+
+    def planner(self, nf_row, files, outside=None):
+        db = FakeDatabase({'key1': cached()}, {'key1': nf_row} if nf_row else {}, {nf_row['filename']: file_state(SYNCED)} if nf_row else {})
+        return Planner(db, FakeNote(tags=['work', 'home'], files=outside), logger, dict(files), FILETIME)
+
+    def kinds(self, ops):
+        return [(op.kind, op.filename, op.target) for op in ops]
+
+    def test_new_without_synced_tag(self):
+        planner = Planner(FakeDatabase(), FakeNote(tags=['work']), logger, {}, FILETIME)
+        self.assertEqual(self.kinds(planner.plan_note(simplenote(tags=['other']))), [(SKIP, None, None)])
+
+    def test_synced_tag_added(self):
+        ops = self.planner(None, {}).plan_note(simplenote(tags=['work']))
+        self.assertEqual([(op.kind, op.new) for op in ops], [(DOWNLOAD, True)])
+
+    def test_tag_removed(self):
+        planner = self.planner(notefile(filename='work/note.txt'), {'work/note.txt': SYNCED})
+        self.assertEqual(self.kinds(planner.plan_note(simplenote(modifydate=1000, tags=[]))), [(TRASH_LOCAL, 'work/note.txt', None)])
+
+    def test_retagged(self):
+        planner = self.planner(notefile(filename='work/note.txt'), {'work/note.txt': SYNCED})
+        ops = planner.plan_note(simplenote(modifydate=1000, tags=['home']))
+        self.assertEqual(self.kinds(ops), [(MOVE, 'work/note.txt', 'home/note.txt')])
+        self.assertIn('home/note.txt', planner.in_sync)
+
+    def test_retagged_name_taken(self):
+        planner = self.planner(notefile(filename='work/note.txt'), {'work/note.txt': SYNCED, 'home/note.txt': fstat(9, 1000)})
+        ops = planner.plan_note(simplenote(modifydate=1000, tags=['home']))
+        self.assertEqual(self.kinds(ops), [(MOVE, 'work/note.txt', 'home/' + FILETIME + '_note.txt')])
+
+    def test_folder_no_longer_synced(self):
+        planner = self.planner(notefile(filename='old/note.txt'), {}, {'old/note.txt': SYNCED})
+        self.assertEqual(self.kinds(planner.plan_note(simplenote(modifydate=1000, tags=['old']))), [(SKIP, 'old/note.txt', None)])
+        ops = planner.plan_note(simplenote(modifydate=1000, tags=['old', 'work'])) # now tagged work, it moves there
+        self.assertEqual(self.kinds(ops), [(MOVE, 'old/note.txt', 'work/note.txt')])
+
+
+class SyncPlanTest(unittest.TestCase):
+
+    def test_add_keeps_the_summary(self):
+        n = dict(simplenote(), content='a long note ' * 100)
+        plan = SyncPlan()
+        plan.add(Operation(DOWNLOAD, 'key1', 'note.txt', note=n, meta=notefile(), fstat=SYNCED, reason='Simplenote modified'))
+
+        op = plan.operations[0]
+        self.assertIsNone(op.note)
+        self.assertIsNone(op.meta)
+        self.assertIsNone(op.fstat)
+        self.assertEqual(op.as_dict(), {'op': DOWNLOAD, 'key': 'key1', 'filename': 'note.txt', 'new': False, 'version': 2,
+                                        'reason': 'Simplenote modified'})
+        self.assertEqual(plan.counts()[DOWNLOAD], 1)
+        self.assertNotIn('long note', plan.to_json())
@@ -0,0 +1,202 @@
+"""
+    Request scheduler tests (rate limit, Retry-After, backoff & adaptive concurrency) on a fake clock
+"""
+import io
+import time
+import email.utils
+import unittest
+import urllib.error
+from unittest import mock
+
+from simplenote_sync.scheduler import Scheduler, retry_after_seconds
+
+
+class FakeClock:
+    """
+        Time only moves when someone waits
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.waits = []
+
+    def __call__(self):
+        return self.now
+
+
+class FakeScheduler(Scheduler):
+    """
+        Scheduler whose timed waits move the fake clock on instead of sleeping
+    """
+
+    def __init__(self, clock, **kwargs):
+        super().__init__(clock=clock, **kwargs)
+
+    def pause(self, seconds):
+        self.clock.waits.append(round(seconds, 6))
+        self.clock.now += seconds
+
+
+def throttled_error(retry_after=None):
+    """
+        HTTP 429, as urllib raises it
+    """
+    headers = {} if retry_after is None else {'Retry-After': retry_after}
+    return urllib.error.HTTPError('http://example.com/', 429, 'Too Many Requests', headers, io.BytesIO(b''))
+
+
+class RateLimitTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        clock = FakeClock()
+        scheduler = FakeScheduler(clock, rate=2, burst=3)
+        for _ in range(7):
+            scheduler.acquire()
+            scheduler.release()
+        self.assertEqual(len(clock.waits), 4) # the burst of 3 goes straight away
+        self.assertAlmostEqual(clock.now - 1000.0, 2.0) # then 2 a second
+
+    def test_tokens_refill(self):
+        clock = FakeClock()
+        scheduler = FakeScheduler(clock, rate=1)
+        scheduler.acquire()
+        scheduler.release()
+        clock.now += 5 # idle, only burst (1) tokens build up
+        scheduler.acquire()
+        scheduler.release()
+        scheduler.acquire()
+        scheduler.release()
+        self.assertEqual(clock.waits, [1.0])
+
+    def test_no_limit(self):
+        clock = FakeClock()
+        scheduler = FakeScheduler(clock, rate=0)
+        for _ in range(100):
+            scheduler.acquire()
+            scheduler.release()
+        self.assertEqual(clock.waits, [])
+
+
+class RetryAfterTest(unittest.TestCase):
+
+    def test_seconds(self):
+        self.assertEqual(retry_after_seconds('7'), 7.0)
+        self.assertEqual(retry_after_seconds('-3'), 0.0)
+        self.assertIsNone(retry_after_seconds(''))
+        self.assertIsNone(retry_after_seconds(None))
+        self.assertIsNone(retry_after_seconds('soon'))
+
+    def test_http_date(self):
+        when = email.utils.formatdate(time.time() + 120, usegmt=True)
+        self.assertAlmostEqual(retry_after_seconds(when), 120, delta=5)
+        self.assertEqual(retry_after_seconds('Thu, 01 Jan 1970 00:00:00 GMT'), 0.0) # in the past
+
+    def test_pauses_everyone(self):
+        clock = FakeClock()
+        scheduler = FakeScheduler(clock, rate=0, concurrency=4)
+        scheduler.acquire()
+        self.assertEqual(scheduler.throttled(0, '7'), 7.0)
+        scheduler.acquire() # any request, not just the throttled one
+        self.assertEqual(clock.waits, [7.0])
+        self.assertEqual(clock.now, 1007.0)
+
+    def test_run_retries(self):
+        clock = FakeClock()
+        scheduler = FakeScheduler(clock, rate=0, retries=5)
+        send = mock.Mock(side_effect=[throttled_error('2'), throttled_error('3'), 'response'])
+        retried = mock.Mock()
+
+        self.assertEqual(scheduler.run(send, 'request', retried=retried), 'response')
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(retried.call_args_list, [mock.call('throttled')] * 2)
+        self.assertEqual(clock.waits, [2.0, 3.0])
+        self.assertEqual(scheduler.throttled_count, 2)
+        self.assertEqual(scheduler.active, 0)
+
+    def test_run_gives_up(self):
+        clock = FakeClock()
+        scheduler = FakeScheduler(clock, rate=0, retries=2)
+        send = mock.Mock(side_effect=throttled_error('1'))
+        with self.assertRaises(urllib.error.HTTPError):
+            scheduler.run(send, 'request')
+        self.assertEqual(send.call_count, 3) # first try & 2 retries
+        self.assertEqual(scheduler.active, 0)
+
+    def test_run_other_errors(self):
+        scheduler = FakeScheduler(FakeClock(), rate=0)
+        error = urllib.error.HTTPError('http://example.com/', 404, 'Not Found', {}, io.BytesIO(b''))
+        send = mock.Mock(side_effect=error)
+        with self.assertRaises(urllib.error.HTTPError):
+            scheduler.run(send, 'request')
+        self.assertEqual(send.call_count, 1) # not retried
+        self.assertEqual(scheduler.throttled_count, 0)
+
+
+class BackoffTest(unittest.TestCase):
+
+    def test_exponential_with_jitter(self):
+        scheduler = FakeScheduler(FakeClock(), backoff=1.0, max_backoff=60.0)
+        for attempt in range(5):
+            scheduler.acquire()
+            delay = scheduler.throttled(attempt)
+            self.assertGreaterEqual(delay, 2 ** attempt / 2)
+            self.assertLessEqual(delay, 2 ** attempt)
+
+    def test_capped(self):
+        scheduler = FakeScheduler(FakeClock(), backoff=1.0, max_backoff=60.0)
+        with mock.patch('random.uniform', side_effect=lambda low, high: high):
+            for attempt in (6, 10, 30):
+                scheduler.acquire()
+                self.assertEqual(scheduler.throttled(attempt), 60.0)
+
+    def test_retry_after_wins(self):
+        scheduler = FakeScheduler(FakeClock(), backoff=1.0, max_backoff=60.0)
+        scheduler.acquire()
+        self.assertEqual(scheduler.throttled(10, '90'), 90.0) # the server knows best, even past max_backoff
+
+
+class ConcurrencyTest(unittest.TestCase):
+
+    def test_down_then_up(self):
+        clock = FakeClock()
+        scheduler = FakeScheduler(clock, rate=0, concurrency=8)
+        self.assertEqual(scheduler.limit, 8)
+
+        for expected in (4, 2, 1, 1): # halved on each throttle, never below 1
+            scheduler.acquire()
+            scheduler.throttled(0, '0')
+            self.assertEqual(scheduler.limit, expected)
+
+        # + 1 after limit * 4 successes in a row
+        for expected in (2, 3, 4, 5, 6, 7, 8):
+            for _ in range(scheduler.limit * 4):
+                scheduler.acquire()
+                scheduler.release()
+            self.assertEqual(scheduler.limit, expected)
+
+        for _ in range(100):
+            scheduler.acquire()
+            scheduler.release()
+        self.assertEqual(scheduler.limit, 8) # never above concurrency
+
+    def test_failures_dont_raise(self):
+        scheduler = FakeScheduler(FakeClock(), rate=0, concurrency=4)
+        scheduler.acquire()
+        scheduler.throttled(0, '0')
+        for _ in range(20):
+            scheduler.acquire()
+            scheduler.release(ok=False)
+        self.assertEqual(scheduler.limit, 2)
+
+    def test_limit_blocks(self):
+        scheduler = FakeScheduler(FakeClock(), rate=0, concurrency=2)
+        scheduler.acquire()
+        scheduler.acquire()
+        self.assertEqual(scheduler.active, 2)
+        with mock.patch.object(scheduler.cond, 'wait', side_effect=RuntimeError('would block')) as wait:
+            with self.assertRaises(RuntimeError):
+                scheduler.acquire()
+            wait.assert_called_once_with()
+        scheduler.release()
+        scheduler.acquire() # room again
+        self.assertEqual(scheduler.active, 2)
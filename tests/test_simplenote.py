@@ -0,0 +1,84 @@
+"""
+    Simplenote API tests, against a local MockSimperium
+"""
+import unittest
+from unittest import mock
+
+from simplenote_sync.simplenote import Simplenote
+from simplenote_sync.transport import Transport
+from simplenote_sync.scheduler import Scheduler
+from simplenote_sync.mockserver import MockSimperium
+
+from .support import logger
+
+
+class TrashNoteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = MockSimperium(logger=logger).start()
+        self.addCleanup(self.mock.stop)
+        self.mock.populate(2)
+        self.key = sorted(self.mock.notes)[0]
+
+        transport = Transport(pool_size=1)
+        self.addCleanup(transport.close)
+        transport.proxies = {}
+        self.simplenote = Simplenote('test@example.com', 'test', transport, Scheduler(logger=logger), api_url=self.mock.url)
+        self.simplenote.get_token()
+
+    def requests(self, function, *args):
+        """
+            function(*args) & the number of API requests it took
+        """
+        before = self.mock.counters['requests']
+        result = function(*args)
+        return result, self.mock.counters['requests'] - before
+
+    def edit(self, content):
+        """
+            A change made elsewhere, returns the new version
+        """
+        data = dict(self.mock.get(self.key)[1], content=content)
+        return self.mock.put(self.key, data)
+
+    def test_current_version(self):
+        version = self.mock.get(self.key)[0]
+        (note, status), requests = self.requests(self.simplenote.trash_note, self.key, version)
+        self.assertEqual(status, 0)
+        self.assertEqual(requests, 1)
+        self.assertTrue(note['deleted'])
+        self.assertEqual(note['version'], version + 1)
+
+    def test_stale_version(self):
+        version = self.mock.get(self.key)[0]
+        self.edit('edited elsewhere')
+        (note, status), requests = self.requests(self.simplenote.trash_note, self.key, version)
+        self.assertEqual(status, 0)
+        self.assertEqual(requests, 2) # merged, then checked
+        self.assertTrue(note['deleted'])
+        self.assertTrue(self.mock.get(self.key)[1]['deleted'])
+        self.assertEqual(self.mock.get(self.key)[1]['content'], 'edited elsewhere') # the other change is kept
+
+    def test_stale_version_not_trashed(self):
+        version = self.mock.get(self.key)[0]
+        merged = {'key': self.key, 'version': self.edit('restored elsewhere'), 'deleted': False}
+        with mock.patch.object(self.simplenote, 'patch_note', return_value=(merged, 0)):
+            (note, status), requests = self.requests(self.simplenote.trash_note, self.key, version)
+        self.assertEqual(status, 0)
+        self.assertEqual(requests, 2) # get & update
+        self.assertTrue(note['deleted'])
+        self.assertTrue(self.mock.get(self.key)[1]['deleted'])
+
+    def test_restore(self):
+        version = self.mock.get(self.key)[0]
+        note, status = self.simplenote.trash_note(self.key, version)
+        (note, status), requests = self.requests(self.simplenote.restore_note, self.key, note['version'])
+        self.assertEqual(status, 0)
+        self.assertEqual(requests, 1)
+        self.assertFalse(note['deleted'])
+
+    def test_no_version(self):
+        (note, status), requests = self.requests(self.simplenote.trash_note, self.key)
+        self.assertEqual(status, 0)
+        self.assertEqual(requests, 2)
+        self.assertTrue(note['deleted'])
@@ -0,0 +1,514 @@
+"""
+    End to end sync tests: SyncEngine against a local MockSimperium
+"""
+import io
+import os
+import json
+import time
+import uuid
+import sqlite3
+import contextlib
+import urllib.error
+from unittest import mock
+
+from simplenote_sync import snsync
+from simplenote_sync.db import Database
+from simplenote_sync.notes import Note
+from simplenote_sync.simplenote import Simplenote
+from simplenote_sync.transport import Transport
+from simplenote_sync.scheduler import Scheduler
+from simplenote_sync.engine import SyncEngine, SyncListFailed, SyncLoginFailed
+from simplenote_sync.mockserver import MockSimperium, mock_note
+
+from .support import TempConfigTestCase, logger
+
+
+class SyncTestCase(TempConfigTestCase):
+    """
+        A small corpus on MockSimperium & an engine to sync it with
+    """
+
+    notes = 12
+
+    def setUp(self):
+        super().setUp()
+        self.mock = MockSimperium(logger=logger).start()
+        self.addCleanup(self.mock.stop)
+        self.mock.populate(self.notes)
+
+        self.config_file = self.write_config(cfg_api_url=self.mock.url, cfg_sync_workers=2)
+        self.transport = Transport(pool_size=2)
+        self.addCleanup(self.transport.close)
+        self.transport.proxies = {}
+        self.connect()
+
+    def connect(self, dry_run=False):
+        """
+            Database & engine, as a new snsync run sets them up
+        """
+        config = self.config()
+        self.note = Note(config, logger)
+        self.db = Database(config, logger)
+        self.addCleanup(self.db.disconnect)
+        self.db.load_snapshot()
+
+        simplenote = Simplenote(config.get_config('sn_username'), config.get_config('sn_password'),
+                                self.transport, Scheduler(concurrency=2, logger=logger), api_url=self.mock.url)
+        self.engine = SyncEngine(config, self.db, self.note, simplenote, logger, dry_run=dry_run, silent=True)
+
+    def files(self):
+        """
+            Note files (not the trash): filename -> content
+        """
+        files = {}
+        for name in os.listdir(self.path):
+            if name.endswith('.txt'):
+                with open(os.path.join(self.path, name), encoding='utf-8') as f:
+                    files[name] = f.read()
+        return files
+
+    def trash(self):
+        """
+            Filenames in the trash folder
+        """
+        trash = os.path.join(self.path, self.config().get_config('cfg_nt_trashpath'))
+        return sorted(os.listdir(trash)) if os.path.isdir(trash) else []
+
+    def contents(self, deleted=False):
+        """
+            Contents of the notes on the mock server, (not) in the trash
+        """
+        return sorted(data['content'] for _, data, _ in self.mock.notes.values() if bool(data['deleted']) == deleted)
+
+    def versions(self):
+        """
+            key -> version of every note on the mock server
+        """
+        return dict((key, note[0]) for key, note in self.mock.notes.items())
+
+    def filename(self, key):
+        """
+            Note file of a Simplenote
+        """
+        return self.db.find_nf_by_key(key)['filename']
+
+    def full_sync(self):
+        result = self.engine.sync(False)
+        self.assertEqual(result.counters['added'], self.notes)
+        self.assertEqual(result.changes, self.notes)
+        return result
+
+
+class SyncTest(SyncTestCase):
+    """
+        Full, no-op & incremental syncs
+    """
+
+    def test_full_sync(self):
+        result = self.full_sync()
+        self.assertEqual(result.operations['download'], self.notes)
+        self.assertEqual(result.counters['http_errors'], 0)
+
+        files = self.files()
+        self.assertEqual(len(files), self.notes)
+        self.assertEqual(sorted(files.values()), self.contents())
+        self.assertEqual(files[self.filename('mock00000000')], self.mock.get('mock00000000')[1]['content'])
+        self.assertEqual(self.versions(), dict.fromkeys(self.mock.notes, 1)) # nothing uploaded
+
+    def test_dry_run_plan(self):
+        self.connect(dry_run=True)
+        result = self.engine.sync(False)
+
+        self.assertEqual(result.plan.counts()['download'], self.notes)
+        for op in result.plan:
+            self.assertIsNone(op.note) # only what's reported is kept
+            self.assertIsNone(op.meta)
+        plan = json.loads(result.plan.to_json())
+        self.assertEqual(sorted((op['key'], op['version'], op['new']) for op in plan['operations']),
+                         [(key, 1, True) for key in sorted(self.mock.notes)])
+        self.assertEqual(self.files(), {})
+
+    def test_no_op_syncs(self):
+        self.full_sync()
+        files = self.files()
+        versions = self.versions()
+        requests = self.mock.counters['requests']
+
+        for fast_sync in (False, True):
+            result = self.engine.sync(fast_sync)
+            self.assertEqual(result.changes, 0)
+            self.assertEqual(sum(result.operations.values()), 0)
+
+        self.assertEqual(self.files(), files)
+        self.assertEqual(self.versions(), versions)
+        self.assertEqual(self.trash(), [])
+        self.assertEqual(self.mock.counters['requests'] - requests, 2) # just the index, no note requests
+
+    def test_incremental_sync(self):
+        self.full_sync()
+        now = time.time()
+
+        # Simplenote: one note edited, one trashed
+        _, data = self.mock.get('mock00000001')
+        data['content'] += 'remote edit\n'
+        data['modificationDate'] = now
+        self.mock.put('mock00000001', data)
+        _, data = self.mock.get('mock00000002')
+        data['deleted'] = True
+        data['modificationDate'] = now
+        self.mock.put('mock00000002', data)
+        trashed = self.filename('mock00000002')
+
+        # Note folder: one file edited, one deleted & one added
+        edited = os.path.join(self.path, self.filename('mock00000003'))
+        with open(edited, 'a', encoding='utf-8') as f:
+            f.write('local edit\n')
+        os.utime(edited, (now + 60, now + 60))
+        os.remove(os.path.join(self.path, self.filename('mock00000004')))
+        with open(os.path.join(self.path, 'added locally.txt'), 'w', encoding='utf-8') as f:
+            f.write(mock_note('added locally\nhello\n')['content'])
+
+        result = self.engine.sync(True)
+
+        self.assertEqual(result.counters['modified'], 2)
+        self.assertEqual(result.counters['added'], 1)
+        self.assertEqual(result.counters['deleted'], 2)
+        self.assertEqual(result.changes, 5)
+        self.assertEqual((result.operations['download'], result.operations['upload'],
+                          result.operations['trash-local'], result.operations['trash-remote']), (1, 2, 1, 1))
+
+        files = self.files()
+        self.assertEqual(len(files), self.notes - 2 + 1)
+        self.assertTrue(files[self.filename('mock00000001')].endswith('remote edit\n'))
+        self.assertNotIn(trashed, files)
+        self.assertEqual([name.endswith('_' + trashed) for name in self.trash()], [True])
+
+        self.assertTrue(self.mock.get('mock00000003')[1]['content'].endswith('local edit\n'))
+        self.assertEqual(self.mock.get('mock00000003')[0], 2)
+        self.assertTrue(self.mock.get('mock00000004')[1]['deleted'])
+        self.assertIn('added locally\nhello\n', self.contents())
+        self.assertEqual(len(self.mock.notes), self.notes + 1)
+        self.assertEqual(sorted(files.values()), self.contents()) # both sides agree again
+
+        self.assertEqual(self.engine.sync(True).changes, 0)
+
+    def touch(self, key, seconds=60):
+        """
+            Change a note file's mtime (not its content)
+        """
+        filename = os.path.join(self.path, self.filename(key))
+        when = time.time() + seconds
+        os.utime(filename, (when, when))
+        return filename
+
+    def test_touched_not_uploaded(self):
+        self.full_sync()
+        self.touch('mock00000001')
+        requests = self.mock.counters['requests']
+
+        result = self.engine.sync(True)
+
+        self.assertEqual(result.changes, 0)
+        self.assertEqual(result.operations['upload'], 1) # planned, skipped on the digest
+        self.assertEqual(self.mock.get('mock00000001')[0], 1)
+        self.assertEqual(self.mock.counters['requests'] - requests, 1) # just the index
+        self.assertEqual(self.engine.sync(True).operations['upload'], 0) # the new mtime is remembered
+
+    def test_touched_and_remote_edit(self):
+        self.full_sync()
+        _, data = self.mock.get('mock00000001')
+        data['content'] += 'remote edit\n'
+        data['modificationDate'] = time.time()
+        self.mock.put('mock00000001', data)
+        self.touch('mock00000001', 120) # newer than the remote edit
+
+        result = self.engine.sync(True)
+
+        self.assertEqual(result.operations['conflict'], 0)
+        self.assertEqual(result.operations['download'], 1)
+        self.assertEqual(result.counters['added'], 0)
+        files = self.files()
+        self.assertEqual([name for name in files if name.startswith('DUP_')], [])
+        self.assertTrue(files[self.filename('mock00000001')].endswith('remote edit\n'))
+        self.assertEqual(len(self.mock.notes), self.notes) # no duplicate note uploaded
+        self.assertEqual(self.mock.get('mock00000001')[0], 2)
+
+
+class ResumeTest(SyncTestCase):
+    """
+        A sync interrupted part way through the Simplenote list carries on from its checkpoint
+    """
+
+    def interrupted_sync(self, pages):
+        """
+            Full sync that loses the connection after pages pages of the list (5 notes a page)
+        """
+        iter_note_list = self.engine.simplenote.iter_note_list
+
+        def cut_short(*args, **kwargs):
+            for number, page in enumerate(iter_note_list(*args, **kwargs)):
+                if number == pages:
+                    yield urllib.error.URLError('connection lost'), -1
+                    return
+                yield page
+
+        with mock.patch.object(self.engine.simplenote, 'iter_note_list', cut_short):
+            with self.assertRaises(SyncListFailed):
+                self.engine.sync(False)
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('simplenote_sync.simplenote.NOTE_FETCH_LENGTH', 5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_checkpoint_has_no_content(self):
+        self.interrupted_sync(2)
+
+        resume = self.db.get_resume()
+        self.assertEqual((resume['pages'], resume['mark']), (2, 'mock00000009'))
+        self.assertEqual(list(self.db.iter_resume_pages(resume)), [[('mock%08x' % i, 1) for i in range(0, 5)],
+                                                                  [('mock%08x' % i, 1) for i in range(5, 10)]])
+        self.db.db.execute('SELECT value FROM snsync WHERE name LIKE ?', ('sn_resume_page_%',))
+        for row in self.db.db.fetchall():
+            self.assertNotIn('content', row[0])
+            self.assertEqual(len(json.loads(row[0])), 5)
+        self.assertEqual(len(self.files()), 10)
+
+    def test_resume(self):
+        self.interrupted_sync(2)
+        self.db.disconnect()
+
+        # As if the last download of page 2 hadn't finished
+        conn = sqlite3.connect(self.db.filename)
+        filename = conn.execute('SELECT filename FROM notefile WHERE key=?', ('mock00000009',)).fetchone()[0]
+        conn.execute('DELETE FROM simplenote WHERE key=?', ('mock00000009',))
+        conn.execute('DELETE FROM notefile WHERE key=?', ('mock00000009',))
+        conn.commit()
+        conn.close()
+        os.remove(os.path.join(self.path, filename))
+
+        self.connect()
+        requests = self.mock.counters['requests']
+        result = self.engine.sync(False)
+
+        self.assertEqual(result.counters['added'], 3) # the unfinished note & the last page
+        self.assertEqual(self.mock.counters['requests'] - requests, 2) # GET of the unfinished note & the last page of the list
+        self.assertEqual(sorted(self.files().values()), self.contents())
+        self.assertFalse(self.db.get_resume())
+        self.assertEqual(self.engine.sync(False).changes, 0)
+
+    def test_resume_deleted_note(self):
+        self.interrupted_sync(1)
+        self.db.disconnect()
+        conn = sqlite3.connect(self.db.filename)
+        conn.execute('DELETE FROM simplenote WHERE key=?', ('mock00000004',))
+        conn.execute('DELETE FROM notefile WHERE key=?', ('mock00000004',))
+        conn.commit()
+        conn.close()
+        self.mock.delete('mock00000004') # gone for good while we were away
+
+        self.connect()
+        result = self.engine.sync(False)
+        self.assertNotIn('mock00000004', [n['key'] for n in self.db.find_sn_all()])
+        self.assertEqual(result.counters['http_errors'], 0)
+
+
+class TokenTest(SyncTestCase):
+    """
+        The API token is cached in the DB (cfg_token_cache) & renewed when it expires
+    """
+
+    def test_cached_token(self):
+        self.full_sync()
+        self.assertEqual(self.mock.counters['logins'], 1)
+
+        self.connect() # a new run
+        result = self.engine.sync(False)
+        self.assertEqual(self.mock.counters['logins'], 1)
+        self.assertEqual(result.retries['token'], 0)
+
+    def test_expired_token(self):
+        self.full_sync()
+        self.mock.token = uuid.uuid4().hex
+
+        self.connect()
+        result = self.engine.sync(False)
+        self.assertEqual(result.changes, 0)
+        self.assertEqual(self.mock.counters['logins'], 2)
+        self.assertEqual(result.retries['token'], 1) # sent once more, with the new token
+        self.assertEqual(self.db.get_token('test@example.com'), self.mock.token)
+
+    def test_login_refused_mid_sync(self):
+        patcher = mock.patch('simplenote_sync.simplenote.NOTE_FETCH_LENGTH', 5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        iter_note_list = self.engine.simplenote.iter_note_list
+
+        def password_changed(*args, **kwargs):
+            for number, page in enumerate(iter_note_list(*args, **kwargs)):
+                if number == 1:
+                    self.mock.token = uuid.uuid4().hex
+                    self.mock.password = 'changed'
+                yield page
+
+        with mock.patch.object(self.engine.simplenote, 'iter_note_list', password_changed):
+            with self.assertRaises(SyncLoginFailed) as raised:
+                self.engine.sync(False)
+
+        self.assertEqual(raised.exception.result.error, 'Simplenote Login Failed')
+        self.assertTrue(self.db.get_resume()) # the next sync carries on from the checkpoint
+
+
+class OutboxTest(SyncTestCase):
+    """
+        Local changes Simplenote didn't get (outbox) are sent first thing next sync
+    """
+
+    def local_changes(self):
+        """
+            One file edited, one deleted & one added, returns the keys (update, trash, add)
+        """
+        now = time.time()
+        edited = os.path.join(self.path, self.filename('mock00000003'))
+        with open(edited, 'a', encoding='utf-8') as f:
+            f.write('local edit\n')
+        os.utime(edited, (now + 60, now + 60))
+        os.remove(os.path.join(self.path, self.filename('mock00000004')))
+        with open(os.path.join(self.path, 'added locally.txt'), 'w', encoding='utf-8') as f:
+            f.write(mock_note('added locally\nhello\n')['content'])
+        return 'mock00000003', 'mock00000004', self.note.gen_meta('added locally.txt')['key']
+
+    def outbox(self):
+        """
+            key -> (op, attempts) of the queued changes
+        """
+        return dict((entry['key'], (entry['op'], entry['attempts'])) for entry in self.db.get_outbox())
+
+    def assert_sent(self, added):
+        """
+            Each local change made it to Simplenote once, the outbox is empty
+        """
+        self.assertEqual(self.outbox(), {})
+        self.assertTrue(self.mock.get('mock00000003')[1]['content'].endswith('local edit\n'))
+        self.assertEqual(self.mock.get('mock00000003')[0], 2)
+        self.assertTrue(self.mock.get('mock00000004')[1]['deleted'])
+        self.assertEqual(self.mock.get(added)[1]['content'], 'added locally\nhello\n')
+        self.assertEqual(len(self.mock.notes), self.notes + 1)
+        self.assertEqual(self.engine.sync(True).changes, 0)
+
+    def test_failed_requests(self):
+        self.full_sync()
+        updated, trashed, added = self.local_changes()
+
+        failed = (urllib.error.URLError('connection lost'), -1)
+        with mock.patch.object(self.engine.simplenote, 'update_note', return_value=failed), \
+             mock.patch.object(self.engine.simplenote, 'trash_note', return_value=failed), \
+             mock.patch.object(self.engine.simplenote, 'add_note', return_value=failed):
+            result = self.engine.sync(True)
+
+        self.assertEqual(result.counters['http_errors'], 3)
+        self.assertEqual(self.outbox(), {updated: ('update', 1), trashed: ('trash', 1), added: ('add', 1)})
+        self.assertEqual(self.mock.get(updated)[0], 1)
+        self.assertFalse(self.mock.get(trashed)[1]['deleted'])
+
+        self.connect() # the next run
+        result = self.engine.sync(True)
+        self.assertEqual(result.counters['http_errors'], 0)
+        self.assert_sent(added)
+
+    def test_crash(self):
+        self.full_sync()
+        updated, trashed, added = self.local_changes()
+
+        # Queued as the requests went out, the answers never came back (the add got there)
+        self.db.outbox_add(updated, 'update', self.filename(updated))
+        self.db.outbox_add(trashed, 'trash', self.filename(trashed))
+        self.db.outbox_add(added, 'add', 'added locally.txt')
+        self.mock.put(added, mock_note('added locally\nhello\n'))
+        self.db.disconnect()
+
+        self.connect(dry_run=True)
+        self.assertEqual(self.outbox(), {updated: ('update', 0), trashed: ('trash', 0), added: ('add', 0)})
+        plan = list(self.engine.sync(True).plan)
+        self.assertEqual([(op.kind, op.key, op.reason) for op in plan[:3]],
+                         [('upload', updated, 'queued'), ('trash-remote', trashed, 'queued'), ('upload', added, 'queued')]) # first thing
+        self.db.disconnect()
+
+        self.connect()
+        result = self.engine.sync(True)
+        self.assertEqual(result.counters['http_errors'], 0)
+        self.assert_sent(added)
+
+
+class SearchTest(SyncTestCase):
+    """
+        The search index follows the synced notes, snsync -S looks it up
+    """
+
+    def found(self, query):
+        """
+            Keys of the notes matching query, best first
+        """
+        return [result['key'] for result in self.db.search(query)]
+
+    def snsync_search(self, query):
+        """
+            snsync -S query: exit code & output lines
+        """
+        self.db.disconnect()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), self.assertRaises(SystemExit) as exited:
+            snsync.main(['-S', query, '-c', self.config_file])
+        return exited.exception.code, output.getvalue().splitlines()
+
+    def test_index(self):
+        self.full_sync()
+        self.assertEqual(self.db.search_keys(), set(self.mock.notes))
+        self.assertEqual(self.found('000003')[0], 'mock00000003') # the title
+        self.assertTrue(self.db.get_snsync_meta('sn_search_built'))
+
+    def test_incremental(self):
+        self.full_sync()
+        now = time.time()
+
+        _, data = self.mock.get('mock00000001')
+        data['content'] += 'zebrafish\n'
+        data['modificationDate'] = now
+        self.mock.put('mock00000001', data)
+        _, data = self.mock.get('mock00000002')
+        data['deleted'] = True
+        data['modificationDate'] = now
+        self.mock.put('mock00000002', data)
+        os.remove(os.path.join(self.path, self.filename('mock00000004')))
+        edited = os.path.join(self.path, self.filename('mock00000003'))
+        with open(edited, 'a', encoding='utf-8') as f:
+            f.write('axolotl\n')
+        os.utime(edited, (now + 60, now + 60))
+
+        self.engine.sync(True)
+        self.assertEqual(self.found('zebrafish'), ['mock00000001'])
+        self.assertEqual(self.found('axolotl'), ['mock00000003'])
+        self.assertEqual(self.db.search_keys(), set(self.mock.notes) - {'mock00000002', 'mock00000004'})
+
+    def test_built_once(self):
+        self.full_sync()
+        self.db.db.execute('DELETE FROM notesearch') # notes synced before there was an index
+        self.db.db.execute('DELETE FROM snsync WHERE name=?', ('sn_search_built',))
+        self.db.commit()
+
+        self.engine.sync(True)
+        self.assertEqual(self.db.search_keys(), set(self.mock.notes))
+        with mock.patch.object(self.db, 'search_keys') as search_keys:
+            self.engine.sync(True)
+        search_keys.assert_not_called()
+
+    def test_search_flag(self):
+        self.full_sync()
+        self.assertEqual(self.snsync_search('000003'), (0, ['%s\t%s' % (self.filename('mock00000003'), 'mock00000003')]))
+        self.assertEqual(self.snsync_search('no-such-words'), (1, []))
+
+    def test_search_flag_no_fts5(self):
+        self.full_sync()
+        with mock.patch('simplenote_sync.db.Database.create_search', return_value=False):
+            self.assertEqual(self.snsync_search('000003'), (1, []))
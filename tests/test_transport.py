@@ -0,0 +1,110 @@
+"""
+    Keep-alive transport tests, against a local MockSimperium
+"""
+import json
+import time
+import unittest
+import http.client
+import urllib.error
+import urllib.request
+from unittest import mock
+
+from simplenote_sync.mockserver import MockSimperium, AUTH_PATH, DATA_PATH
+from simplenote_sync.transport import Transport, resendable
+
+from .support import logger
+
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = MockSimperium(throttle=0.0, logger=logger).start()
+        self.addCleanup(self.mock.stop)
+        self.transport = Transport(pool_size=2, timeout=10)
+        self.addCleanup(self.transport.close)
+        self.transport.proxies = {}
+
+    def login(self):
+        request = urllib.request.Request(self.mock.url + AUTH_PATH, data=json.dumps({'username': 'user', 'password': 'x'}).encode('utf-8'))
+        return json.loads(self.transport.urlopen(request).read().decode('utf-8'))['access_token']
+
+    def get(self, path, token):
+        return self.transport.urlopen(urllib.request.Request(self.mock.url + DATA_PATH + path, headers={'X-Simperium-Token': token}))
+
+    def test_keep_alive(self):
+        token = self.login()
+        for _ in range(3):
+            self.assertEqual(self.get('/index', token).getcode(), 200)
+        self.assertEqual(self.transport.get_request_count(), 4)
+        self.assertEqual(sum(len(conns) for conns in self.transport.idle.values()), 1) # one connection did it all
+
+    def test_gzip(self):
+        self.mock.put('key1', {'content': 'hello ' * 100})
+        response = self.get('/i/key1', self.login())
+        self.assertEqual(response.info().get('Content-Encoding'), 'gzip')
+        self.assertEqual(json.loads(response.read().decode('utf-8'))['content'], 'hello ' * 100)
+
+    def test_http_error(self):
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            self.get('/i/nosuchkey', self.login())
+        self.assertEqual(raised.exception.code, 404)
+        self.assertEqual(json.loads(raised.exception.read().decode('utf-8')), {'error': 'not found'})
+
+    def test_reconnect(self):
+        token = self.login()
+        for conns in self.transport.idle.values():
+            for conn in conns:
+                conn.sock.close() # as if the server dropped the idle connection
+        retried = mock.Mock()
+
+        response = self.transport.urlopen(urllib.request.Request(self.mock.url + DATA_PATH + '/index', headers={'X-Simperium-Token': token}), retried=retried)
+        self.assertEqual(response.getcode(), 200)
+        self.assertEqual(self.transport.get_reconnect_count(), 1)
+        retried.assert_called_once_with('reconnect')
+
+    def test_fresh_connection_errors(self):
+        self.mock.stop()
+        with self.assertRaises(urllib.error.URLError):
+            self.login() # not resent, a new connection failing is an error
+        self.assertEqual(self.transport.get_reconnect_count(), 0)
+
+    def test_reconnect_post(self):
+        token = self.login()
+        for conns in self.transport.idle.values():
+            for conn in conns:
+                conn.sock.close() # dropped before the request went out, safe to send again
+        self.mock.put('key1', {'content': 'hello'})
+
+        request = urllib.request.Request(self.mock.url + DATA_PATH + '/i/key1', data=b'{"content": "changed"}',
+                                         headers={'X-Simperium-Token': token})
+        self.assertEqual(self.transport.urlopen(request).getcode(), 200)
+        self.assertEqual(self.transport.get_reconnect_count(), 1)
+        self.assertEqual(self.mock.get('key1'), (2, {'content': 'changed'}))
+
+    def test_timeout_not_resent(self):
+        token = self.login()
+        self.mock.put('key1', {'content': 'hello'})
+        self.transport.timeout = 0.1
+        for conns in self.transport.idle.values():
+            for conn in conns:
+                conn.sock.settimeout(0.1)
+        self.mock.latency = 0.5 # the update is applied, after the client gave up
+        retried = mock.Mock()
+
+        request = urllib.request.Request(self.mock.url + DATA_PATH + '/i/key1', data=b'{"content": "changed"}',
+                                         headers={'X-Simperium-Token': token})
+        with self.assertRaises(TimeoutError):
+            self.transport.urlopen(request, retried=retried)
+        retried.assert_not_called()
+        self.assertEqual(self.transport.get_reconnect_count(), 0)
+
+        time.sleep(1.0)
+        self.assertEqual(self.mock.get('key1'), (2, {'content': 'changed'})) # applied once
+        self.assertEqual(self.mock.counters['requests'], 2) # login & the update
+
+    def test_closed_without_response(self):
+        self.assertTrue(resendable('POST', http.client.RemoteDisconnected('closed'), True))
+        self.assertTrue(resendable('POST', BrokenPipeError(), False))
+        self.assertTrue(resendable('GET', ConnectionResetError(), True))
+        self.assertFalse(resendable('POST', ConnectionResetError(), True)) # may have been applied
+        self.assertFalse(resendable('DELETE', http.client.IncompleteRead(b''), True))
@@ -0,0 +1,111 @@
+"""
+    Watch mode tests: the polling Watcher & the snsync --watch loop
+"""
+import os
+import time
+import threading
+from unittest import mock
+
+from simplenote_sync import snsync
+from simplenote_sync.watch import Watcher
+from simplenote_sync.transport import Transport
+from simplenote_sync.mockserver import MockSimperium
+
+from .support import TempConfigTestCase, logger
+
+
+class PollingWatcherTest(TempConfigTestCase):
+    """
+        inotify off, the folder is scanned every poll seconds
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.write('existing.txt', 'existing')
+        patch = mock.patch.object(Watcher, 'inotify_init', return_value=None)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.watcher = Watcher(self.path, '.txt', logger, settle=0.2, poll=0.05)
+        self.addCleanup(self.watcher.close)
+
+    def write(self, name, text):
+        """
+            Write a note file, with a new mtime even on a coarse clock
+        """
+        filename = os.path.join(self.path, name)
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(text)
+        mtime = time.time() + len(text)
+        os.utime(filename, (mtime, mtime))
+
+    def later(self, seconds, function, *args):
+        """
+            function(*args) on a timer, while the test waits
+        """
+        timer = threading.Timer(seconds, function, args)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_polling_fallback(self):
+        self.assertIsNone(self.watcher.fd)
+        self.assertEqual(list(self.watcher.files), ['existing.txt'])
+
+    def test_no_changes(self):
+        start = time.monotonic()
+        self.assertEqual(self.watcher.wait(0.2), set())
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_added_modified_deleted(self):
+        self.write('added.txt', 'added')
+        self.assertEqual(self.watcher.wait(1), {'added.txt'})
+
+        self.write('existing.txt', 'modified')
+        self.assertEqual(self.watcher.wait(1), {'existing.txt'})
+
+        os.remove(os.path.join(self.path, 'added.txt'))
+        self.assertEqual(self.watcher.wait(1), {'added.txt'})
+
+    def test_other_files_ignored(self):
+        self.write('notes.swp', 'editor swap file')
+        self.assertEqual(self.watcher.wait(0.2), set())
+
+    def test_change_while_waiting(self):
+        self.later(0.1, self.write, 'added.txt', 'added')
+        self.assertEqual(self.watcher.wait(2), {'added.txt'})
+
+    def test_settle(self):
+        # an editor saving twice, then a second file inside the settle time: one change
+        self.later(0.1, self.write, 'first.txt', 'first')
+        self.later(0.2, self.write, 'first.txt', 'first, saved again')
+        self.later(0.3, self.write, 'second.txt', 'second')
+        self.assertEqual(self.watcher.wait(2), {'first.txt', 'second.txt'})
+        self.assertEqual(self.watcher.wait(0.1), set())
+
+    def test_settled_changes_apart(self):
+        self.later(0.1, self.write, 'first.txt', 'first')
+        self.later(1.0, self.write, 'second.txt', 'second')
+        self.assertEqual(self.watcher.wait(2), {'first.txt'})
+        self.assertEqual(self.watcher.wait(2), {'second.txt'})
+
+
+class WatchModeTest(TempConfigTestCase):
+    """
+        snsync --watch against MockSimperium
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.mock = MockSimperium(logger=logger).start()
+        self.addCleanup(self.mock.stop)
+        self.mock.populate(3)
+        self.config_file = self.write_config(cfg_api_url=self.mock.url, cfg_sync_workers=2, cfg_watch_interval=60)
+
+    def test_ctrl_c(self):
+        close = mock.patch.object(Transport, 'close', autospec=True, side_effect=Transport.close)
+        stop = mock.patch.object(Watcher, 'wait', side_effect=KeyboardInterrupt)
+        with close as transport_close, stop, mock.patch.object(Watcher, 'close', autospec=True, side_effect=Watcher.close) as watcher_close:
+            snsync.main(['-w', '-c', self.config_file]) # no traceback or exit code
+
+        transport_close.assert_called_once()
+        watcher_close.assert_called_once()
+        self.assertEqual(len([name for name in os.listdir(self.path) if name.endswith('.txt')]), 3)